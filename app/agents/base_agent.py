@@ -1,9 +1,18 @@
 class BaseAgent:
-    def __init__(self, name: str):
+    def __init__(self, name: str, model_key: str = None):
         self.name = name
+        # Agent whose model spec this agent runs on (see config.model_for)
+        self.model_key = model_key
 
     def load_model(self):
-        raise NotImplementedError("Must override load_model()")
+        """
+        Returns ``(model, processor, config)`` from the model registry. Agents
+        call this per request rather than keeping the model, so the registry
+        can unload it when another model needs the memory.
+        """
+        from app.utils.model_loader import load_agent_model
+
+        return load_agent_model(self.model_key)
 
     def respond(self, *args, **kwargs):
         raise NotImplementedError("Must override respond()")
\ No newline at end of file
@@ -1,54 +1,74 @@
 from app.agents.base_agent import BaseAgent
-from app.utils.model_loader import load_medgemma_model
+from app.utils.model_loader import apply_chat_template
 from app.utils.prompt_builder import build_icd10_prompt
 from app.graph.types import State
-from app.utils.logger import get_logger
-from app.utils.helper import clean_json_response
-import json
+from app.utils.logger import get_logger, payload_summary
+from app.utils.helper import parse_json_response
 from PIL import Image
 from typing import Optional
 from langsmith.run_helpers import traceable
-from mlx_vlm.prompt_utils import apply_chat_template
-from mlx_vlm import generate
-import numpy as np
+from app.utils.predictor import generate_response
+from app.utils.deadline import RequestCancelled
+from app.utils.stream_parser import make_stream_callback
+from app.utils.constrained_decoding import ICD10_SCHEMA
+from app.config.config import config
+from app.utils.icd10_index import get_icd10_index
+from app.utils.icd10_retriever import get_icd10_retriever
 
 logger = get_logger(__name__)
 
 class ICD10Agent(BaseAgent):
     def __init__(self):
-        super().__init__(name="ICD10Agent")
-        self.model, self.processor, self.config = load_medgemma_model()
+        super().__init__(name="ICD10Agent", model_key="icd10")
+        # Loaded up front so the first request does not wait for the weights
+        self.load_model()
 
     @traceable
     def respond(self, state: State) -> str:
 
-        logger.info(f"Called respond with state: {state}")
         clinical_note = state.payload["clinical_note"] if "clinical_note" in state.payload else None
-        image = [state.payload["image"] if "image" in state.payload else  Image.fromarray(np.zeros((224, 224, 3), dtype=np.uint8))] 
+        image = [state.payload["image"]] if state.payload.get("image") is not None else None
 
-        prompt = build_icd10_prompt(clinical_note, image)
+        retriever = get_icd10_retriever() if config.ICD10_RETRIEVAL_ENABLED and clinical_note else None
+        candidates = retriever.shortlist(clinical_note, config.ICD10_RETRIEVAL_TOP_K) if retriever else None
+
+        prompt = build_icd10_prompt(clinical_note, image, candidates)
+        model, processor, model_config = self.load_model()
         formatted_prompt = apply_chat_template(
-            self.processor, self.config, prompt, num_images=1
+            processor, model_config, prompt, num_images=len(image) if image else 0
+        )
+        logger.debug("Generating ICD-10 codes for clinical note: %s", payload_summary(clinical_note))
+        on_chunk = make_stream_callback(state.payload.get("on_event"))
+        options = {"on_chunk": on_chunk} if on_chunk else {}
+        return generate_response(
+            model, processor, formatted_prompt, image,
+            agent="icd10", json_schema=ICD10_SCHEMA, max_tokens=config.ICD10_MAX_TOKENS, **options
         )
-        logger.info(f"Generating ICD-10 codes for clinical note: {clinical_note}")
-        return generate(self.model, self.processor, formatted_prompt, image)
     
 
     def run(self, state: State) -> State:
-        logger.info("Running ICD10Agent with state: %s", state)
+        logger.debug("Running ICD10Agent with state: %s", payload_summary(state))
         try:
             raw_result = self.respond(state).text
-            logger.info("ICD10Agent response: %s", raw_result)
-            parsed_result = clean_json_response(raw_result)
-            cleaned_result = json.loads(parsed_result)
+            logger.debug("ICD10Agent response: %s", payload_summary(raw_result))
+            parsed = parse_json_response(raw_result)
+            # A single code may come back as an object rather than a one-element array
+            codes = [parsed] if isinstance(parsed, dict) else parsed
+            # Same as clean_json_response: codes without a description are dropped
+            cleaned_result = [code for code in codes if isinstance(code, dict) and code.get("description")]
+            index = get_icd10_index() if config.ICD10_VALIDATION_ENABLED else None
+            if index is not None:
+                cleaned_result = index.normalize(cleaned_result)
             
-            logger.info("Returning from icd10 agent with : %s", cleaned_result)
+            logger.info("Returning %d ICD-10 code(s)", len(cleaned_result))
             return State(
                 type="icd10",
                 payload=state.payload,  # preserve existing payload
                 result=cleaned_result,             # add new result
                 error=None 
             )
+        except RequestCancelled:
+            raise
         except Exception as e:
             return {
                 "payload": state.payload,
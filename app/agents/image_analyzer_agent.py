@@ -1,46 +1,53 @@
 from app.agents.base_agent import BaseAgent
-from app.utils.model_loader import load_medgemma_model
+from app.utils.model_loader import apply_chat_template
 from app.utils.prompt_builder import build_image_analyzer_prompt
 from PIL import Image
 from app.graph.types import State
 import requests
-from app.utils.logger import get_logger
-from app.utils.helper import clean_json_response
-import json
+from app.utils.logger import get_logger, payload_summary
+from app.utils.helper import parse_json_response
 from langsmith.run_helpers import traceable
-from mlx_vlm.prompt_utils import apply_chat_template
-from mlx_vlm import generate
+from app.utils.predictor import generate_response
+from app.utils.stream_parser import make_stream_callback
+from app.utils.constrained_decoding import RADIOLOGY_SCHEMA
+from app.config.config import config
 
 logger = get_logger(__name__)
 
 class ImageAnalyzerAgent(BaseAgent):
     def __init__(self):
-        super().__init__(name="ImageAnalyzerAgent")
-        self.model, self.processor, self.config = load_medgemma_model()
+        super().__init__(name="ImageAnalyzerAgent", model_key="image_analysis")
+        # Loaded up front so the first request does not wait for the weights
+        self.load_model()
 
     @traceable
     def respond(self, state: dict) -> str:
         image = state.payload.get("image", None)
         note = state.payload.get("note", None)
-        logger.info(f"Generating image analysis for image: {image} with note: {note}")
-        prompt = build_image_analyzer_prompt(image, note)
+        logger.debug("Generating image analysis for image: %s with note: %s", payload_summary(image), payload_summary(note))
+        prompt = build_image_analyzer_prompt(image, note, state.payload.get("image_metadata"))
+        model, processor, model_config = self.load_model()
         formatted_prompt = apply_chat_template(
-            self.processor, self.config, prompt, num_images=1
+            processor, model_config, prompt, num_images=1
+        )
+        on_chunk = make_stream_callback(state.payload.get("on_event"))
+        options = {"on_chunk": on_chunk} if on_chunk else {}
+        return generate_response(
+            model, processor, formatted_prompt, image,
+            agent="image_analysis", json_schema=RADIOLOGY_SCHEMA, max_tokens=config.IMAGE_ANALYSIS_MAX_TOKENS, **options
         )
-        return generate(self.model, self.processor, formatted_prompt, image)
     
     def run(self, state: State) -> State:
         """
         Run the agent with the provided image.
         """
-        logger.info(f"Running {self.name} with state: {state}")
+        logger.debug("Running %s with state: %s", self.name, payload_summary(state))
         raw_result = self.respond(state).text
 
-        logger.info("image analysis agent response: %s", raw_result)
-        parsed_result = clean_json_response(raw_result)
-        cleaned_result = json.loads(parsed_result)
+        logger.debug("image analysis agent response: %s", payload_summary(raw_result))
+        cleaned_result = parse_json_response(raw_result)
             
-        logger.info("Cleaned result: %s", cleaned_result)
+        logger.debug("Cleaned result: %s", payload_summary(cleaned_result))
         return State(
             type="image_analysis",
             payload=state.payload,  # preserve existing payload
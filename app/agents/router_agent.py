@@ -1,69 +1,199 @@
 # app/agents/router_agent.py
-from PIL import Image
 import base64
 import io
-from app.utils.logger import get_logger
-from app.graph.types import State
+import math
+import re
+from typing import Optional
+from app.utils.logger import get_logger, payload_summary
+from app.graph.types import State, RoutingDecision
+from app.config.config import config
 from app.utils.prompt_builder import build_router_prompt
 from langsmith.run_helpers import traceable
 from app.agents.base_agent import BaseAgent
-from app.utils.model_loader import load_medgemma_model
-from mlx_vlm.prompt_utils import apply_chat_template
-from mlx_vlm import generate
-import numpy as np
+from app.utils.model_loader import apply_chat_template
+from app.utils.predictor import generate_response
 
 
 logger = get_logger(__name__)
 
+# "Doctor: ...", "[00:12] Patient - ...", "Speaker 2: ..."
+SPEAKER_PATTERN = re.compile(
+    r"^\s*(?:\[?\d{1,2}:\d{2}(?::\d{2})?\]?\s*)?"
+    r"(doctor|dr\.?(?: \w+)?|physician|clinician|provider|nurse|patient|pt|mother|father|parent|caregiver|speaker ?\d+)"
+    r"\s*[:\-]",
+    re.IGNORECASE | re.MULTILINE,
+)
+SECTION_PATTERN = re.compile(
+    r"^\s*(chief complaint|history(?: of present illness| & symptoms| and symptoms)?|hpi|past medical history|pmh"
+    r"|physical exam(?:ination)?|review of systems|ros|diagnos[ie]s|impression|assessment|plan|medications|allergies"
+    r"|vitals?|labs?)\s*:",
+    re.IGNORECASE | re.MULTILINE,
+)
+PRONOUN_PATTERN = re.compile(r"\b(i|i'm|you|your|my|me|we)\b", re.IGNORECASE)
+BULLET_PATTERN = re.compile(r"^\s*(?:[-*\u2022]|\d+[.)])\s+", re.MULTILINE)
+
+# Below this length a note sent with an image is treated as a question about the image
+IMAGE_QUESTION_MAX_CHARS = 300
+
+
+def rule_based_route(note: Optional[str], has_image: bool) -> Optional[RoutingDecision]:
+    """
+    Deterministic routing for inputs whose shape makes the answer obvious.
+
+    Returns:
+        Optional[RoutingDecision]: The decision, or None if no rule applies.
+    """
+    note = (note or "").strip()
+    speakers = {m.group(1).lower() for m in SPEAKER_PATTERN.finditer(note)}
+    speaker_lines = len(SPEAKER_PATTERN.findall(note))
+    sections = {m.group(1).lower() for m in SECTION_PATTERN.finditer(note)}
+
+    if has_image:
+        if not note:
+            return RoutingDecision(agent="image_analysis", confidence=1.0, tier="rules")
+        if len(note) <= IMAGE_QUESTION_MAX_CHARS and not speakers and len(sections) < 2:
+            return RoutingDecision(agent="image_analysis", confidence=0.95, tier="rules")
+        return None
+
+    if not note:
+        return None
+    if len(speakers) >= 2 and speaker_lines >= 2:
+        return RoutingDecision(agent="soap", confidence=0.97, tier="rules")
+    if len(sections) >= 2 and speaker_lines == 0:
+        return RoutingDecision(agent="icd10", confidence=0.97, tier="rules")
+    return None
+
+
+def plan_fanout(note: Optional[str], has_image: bool) -> Optional[RoutingDecision]:
+    """
+    A note that is a document in its own right (an admission note, a
+    transcript) sent with an image gets both analyses: ``image_analysis`` and
+    the agent the note alone routes to, run as parallel branches.
+
+    Returns:
+        Optional[RoutingDecision]: The fan-out decision, or None for a single agent.
+    """
+    note = (note or "").strip()
+    if not has_image or not note or rule_based_route(note, has_image) is not None:
+        return None
+    text_decision = rule_based_route(note, False) or classify_text(note)
+    return RoutingDecision(
+        agent="image_analysis",
+        confidence=text_decision.confidence,
+        tier=text_decision.tier,
+        agents=["image_analysis", text_decision.agent],
+    )
+
+
+def classify_text(note: str) -> RoutingDecision:
+    """
+    Lightweight local classifier separating transcripts (soap) from clinical
+    notes (icd10). A logistic score over a handful of surface features:
+    speaker-prefixed lines, conversational pronouns and questions push towards
+    a transcript; section headers and bullet lists push towards a clinical note.
+    """
+    lines = [line for line in note.splitlines() if line.strip()] or [note]
+    words = max(1, len(note.split()))
+
+    speaker_ratio = len(SPEAKER_PATTERN.findall(note)) / len(lines)
+    pronoun_rate = 100.0 * len(PRONOUN_PATTERN.findall(note)) / words
+    question_rate = note.count("?") / len(lines)
+    section_count = len({m.group(1).lower() for m in SECTION_PATTERN.finditer(note)})
+    bullet_ratio = len(BULLET_PATTERN.findall(note)) / len(lines)
+
+    z = (
+        -0.5
+        + 6.0 * speaker_ratio
+        + 0.6 * pronoun_rate
+        + 2.0 * question_rate
+        - 1.2 * section_count
+        - 2.5 * bullet_ratio
+    )
+    p_soap = 1.0 / (1.0 + math.exp(-z))
+    if p_soap >= 0.5:
+        return RoutingDecision(agent="soap", confidence=round(p_soap, 3), tier="classifier")
+    return RoutingDecision(agent="icd10", confidence=round(1.0 - p_soap, 3), tier="classifier")
+
+
 class RouterAgent(BaseAgent):
     def __init__(self):
-        super().__init__(name="RouterAgent")
-        self.model, self.processor, self.config = load_medgemma_model()
+        super().__init__(name="RouterAgent", model_key="router")
+        # Loaded up front so the first request does not wait for the weights
+        self.load_model()
 
     @traceable
     def respond(self, state: dict) -> str:
-        image = [state.payload["image"] if "image" in state.payload else  Image.fromarray(np.zeros((224, 224, 3), dtype=np.uint8))] 
+        image = [state.payload["image"]] if state.payload.get("image") is not None else None
         note = state.payload.get("note", None)
-        logger.info(f"Identifying next agent for image: {image} with note: {note}")
+        logger.debug("Identifying next agent for image: %s with note: %s", payload_summary(image), payload_summary(note))
         prompt = build_router_prompt(note, image)
-        logger.info(f"RouterAgent prompt: {prompt}")
+        model, processor, model_config = self.load_model()
         # Apply chat template
         formatted_prompt = apply_chat_template(
-            self.processor, self.config, prompt, num_images=1
+            processor, model_config, prompt, num_images=len(image) if image else 0
+        )
+        logger.debug("Formatted prompt for RouterAgent: %s", payload_summary(formatted_prompt))
+        return generate_response(
+            model, processor, formatted_prompt, image, agent="router", max_tokens=config.ROUTER_MAX_TOKENS
         )
-        logger.info(f"Formatted prompt for RouterAgent: {formatted_prompt}")
-        return generate(self.model, self.processor, formatted_prompt, image)
     
     
-    def run(self, state: State) -> State:
+    def route(self, state: State) -> RoutingDecision:
         """
-        Run the agent with the provided image.
+        Tiered routing: deterministic rules, then the local text classifier,
+        and only for low-confidence inputs a full LLM generation.
         """
-        logger.info(f"Running {self.name} with state: {state}")
-        
+        note = state.payload.get("note", None)
+        has_image = state.payload.get("image", None) is not None
+
+        if config.FANOUT_ENABLED:
+            decision = plan_fanout(note, has_image)
+            if decision is not None:
+                return decision
+
+        decision = rule_based_route(note, has_image)
+        if decision is None and not has_image and note and note.strip():
+            decision = classify_text(note)
+        if decision is not None and decision.confidence >= config.ROUTER_CONFIDENCE_THRESHOLD:
+            return decision
+
         response = self.respond(state).text.lower().strip()
         logger.info("RouterAgent response: %s", response)
+        if response not in ("icd10", "soap", "image_analysis"):
+            raise ValueError(f"Unknown response from RouterAgent: {response}")
+        # The LLM gives no calibrated score; report agreement with the cheaper tiers instead
+        agrees = decision is not None and decision.agent == response
+        return RoutingDecision(agent=response, confidence=decision.confidence if agrees else 0.5, tier="llm")
 
-        if response == "icd10":
-            state.payload["clinical_note"] = state.payload.get("note", "")
-            state.type = "icd10"
-        elif response == "soap":
-            state.payload["transcript"] = state.payload.get("note", "")
-            state.type = "soap"
-        elif response == "image_analysis":
-            state.type = "image_analysis"
-            state.payload["image"] = state.payload.get("image", None)
-            state.payload["clinical_note"] = state.payload.get("note", "")
-        else:
-            logger.error(f"Unknown response from RouterAgent: {response}")
-            state.error = f"Unknown response from RouterAgent: {response}"
+    def run(self, state: State) -> State:
+        """
+        Run the agent with the provided image.
+        """
+        logger.debug("Running %s with state: %s", self.name, payload_summary(state))
+
+        try:
+            decision = self.route(state)
+        except ValueError as e:
+            logger.error("%s", e)
+            state.error = str(e)
             return state
+        response = decision.agent
+        logger.info("RouterAgent decision: %s", decision)
+
+        # A fan-out prepares the payload of every branch
+        for agent in decision.agents or [response]:
+            if agent == "icd10":
+                state.payload["clinical_note"] = state.payload.get("note", "")
+            elif agent == "soap":
+                state.payload["transcript"] = state.payload.get("note", "")
+            elif agent == "image_analysis":
+                state.payload["image"] = state.payload.get("image", None)
+                state.payload["clinical_note"] = state.payload.get("note", "")
+        state.type = response
         return State(
             type=state.type,
             payload=state.payload,  # preserve existing payload
             result=response,            # add this line (or appropriate value)
-            error=None              # no error
+            error=None,             # no error
+            routing=decision
         )
-
-    
-
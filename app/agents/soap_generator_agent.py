@@ -1,50 +1,109 @@
 from app.agents.base_agent import BaseAgent
-from app.utils.model_loader import load_medgemma_model
-from app.utils.prompt_builder import build_soap_generator_prompt
+from app.utils.model_loader import apply_chat_template, count_tokens
+from app.utils.prompt_builder import build_soap_chunk_prompt, build_soap_generator_prompt, build_soap_reduce_prompt
 from app.graph.types import State
 from PIL import Image
 from typing import Optional
-from app.utils.logger import get_logger
-from app.utils.helper import clean_json_response
-import json
+from app.utils.logger import get_logger, payload_summary
+from app.utils.helper import parse_json_response
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
 from langsmith.run_helpers import traceable
-from mlx_vlm.prompt_utils import apply_chat_template
-from mlx_vlm import generate
-import numpy as np
+from app.utils.predictor import generate_response
+from app.utils.result_cache import result_cache, text_cache_key
+from app.utils.stream_parser import make_stream_callback
+from app.utils.constrained_decoding import SOAP_FACTS_SCHEMA, SOAP_SCHEMA
+from app.utils.transcript_chunker import SOAP_SECTIONS, chunk_transcript, merge_facts
+from app.config.config import config
 
 logger = get_logger(__name__)
 
 class SoapGeneratorAgent(BaseAgent):
     def __init__(self):
-        super().__init__(name="SoapGeneratorAgent")
-        self.model, self.processor, self.config = load_medgemma_model()
+        super().__init__(name="SoapGeneratorAgent", model_key="soap")
+        # Loaded up front so the first request does not wait for the weights
+        self.load_model()
 
     def respond(self, state: dict) -> str:
-        logger.info(f"Called respond with state: {state}")
-        print(f"State payload: {state.payload}")
-        print(f"Transcript: {state.payload.get('transcript', 'No transcript found')}")
         transcript = state.payload["transcript"] if "transcript" in state.payload else ""
-        image = [state.payload["image"] if "image" in state.payload else  Image.fromarray(np.zeros((224, 224, 3), dtype=np.uint8))] 
-        logger.info(f"Generating SOAP note for transcript: {transcript}")
-        prompt = build_soap_generator_prompt(transcript, image)
+        image = [state.payload["image"]] if state.payload.get("image") is not None else None
+        logger.debug("Generating SOAP note for transcript: %s", payload_summary(transcript))
+        model, processor, model_config = self.load_model()
+        if config.SOAP_MAP_REDUCE_ENABLED and count_tokens(processor, transcript) >= config.SOAP_MAP_REDUCE_MIN_TOKENS:
+            facts = self.extract_facts(transcript, bypass_cache=bool(state.payload.get("cache_bypass")))
+            prompt, step = build_soap_reduce_prompt(facts), "soap_reduce"
+        else:
+            prompt, step = build_soap_generator_prompt(transcript, image), "soap"
         formatted_prompt = apply_chat_template(
-            self.processor, self.config, prompt, num_images=1
+            processor, model_config, prompt, num_images=len(image) if image else 0
         )
-        return generate(self.model, self.processor, formatted_prompt, image)
+        on_chunk = make_stream_callback(state.payload.get("on_event"))
+        options = {"on_chunk": on_chunk} if on_chunk else {}
+        return generate_response(
+            model, processor, formatted_prompt, image,
+            agent=step, json_schema=SOAP_SCHEMA, max_tokens=config.SOAP_MAX_TOKENS, **options
+        )
+
+    def extract_facts(self, transcript: str, bypass_cache: bool = False) -> dict:
+        """
+        Map step for long transcripts: splits the transcript into overlapping
+        chunks of speaker turns, extracts each chunk's S/O/A/P facts (the
+        chunks run concurrently, so the batcher decodes them together) and
+        merges them, dropping duplicates.
+
+        Chunk facts are cached by chunk text, so a transcript that grew since
+        the last request only runs the chunks at its tail.
+        """
+        model, processor, model_config = self.load_model()
+        chunks = chunk_transcript(
+            transcript, lambda text: count_tokens(processor, text),
+            config.SOAP_CHUNK_TOKENS, config.SOAP_CHUNK_OVERLAP_TOKENS,
+        )
+        keys = [text_cache_key(chunk, "soap_map", self.model_key) for chunk in chunks]
+        facts = [None] * len(chunks)
+        if config.RESULT_CACHE_ENABLED and not bypass_cache:
+            facts = [result_cache.get(key) for key in keys]
+        pending = [i for i, found in enumerate(facts) if found is None]
+        logger.info("Long transcript: %d chunks, %d cached", len(chunks), len(chunks) - len(pending))
+
+        def extract(chunk: str) -> Optional[dict]:
+            formatted_prompt = apply_chat_template(processor, model_config, build_soap_chunk_prompt(chunk), num_images=0)
+            response = generate_response(
+                model, processor, formatted_prompt, None,
+                agent="soap_map", json_schema=SOAP_FACTS_SCHEMA, max_tokens=config.SOAP_MAP_MAX_TOKENS,
+            )
+            try:
+                parsed = parse_json_response(response.text)
+            except Exception as e:
+                logger.warning("Could not parse the facts of a transcript chunk: %s", e)
+                return None
+            if not isinstance(parsed, dict):
+                return None
+            return {section: [str(fact) for fact in parsed.get(section) or []] for section in SOAP_SECTIONS}
+
+        if pending:
+            with ThreadPoolExecutor(max(1, min(config.SOAP_MAP_CONCURRENCY, len(pending))), thread_name_prefix="soap-map") as pool:
+                # Each chunk runs in a copy of this context (correlation id, metrics node)
+                futures = {i: pool.submit(contextvars.copy_context().run, extract, chunks[i]) for i in pending}
+                for i, future in futures.items():
+                    facts[i] = future.result()
+                    if facts[i] is not None and config.RESULT_CACHE_ENABLED:
+                        result_cache.put(keys[i], facts[i])
+
+        return merge_facts(found for found in facts if found is not None)
 
     @traceable
     def run(self, state: State) -> State:
         """
         Run the agent with the provided clinical note.
         """
-        logger.info(f"Running {self.name} with state: {state}")
+        logger.debug("Running %s with state: %s", self.name, payload_summary(state))
         raw_result = self.respond(state).text
 
-        logger.info("soap_generated agent response: %s", raw_result)
-        parsed_result = clean_json_response(raw_result)
-        cleaned_result = json.loads(parsed_result)
+        logger.debug("soap_generated agent response: %s", payload_summary(raw_result))
+        cleaned_result = parse_json_response(raw_result)
             
-        logger.info("Cleaned result: %s", cleaned_result)
+        logger.debug("Cleaned result: %s", payload_summary(cleaned_result))
         return State(
             type="soap",
             payload=state.payload,  # preserve existing payload
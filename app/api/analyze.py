@@ -1,11 +1,19 @@
-from fastapi import APIRouter, UploadFile, File, Form
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, UploadFile, File, Form, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
 from PIL import Image
+import asyncio
 import io
+import json
+import time
 
-from app.graph.graph_builder import build_graph
+from app.graph.graph_builder import get_graph
 from app.graph.types import State
-from app.utils.helper import convert_uploadfile_to_image  # helper function to handle image
+from app.utils.deadline import (
+    DEADLINE, DEADLINE_HEADER, DISCONNECTED, Cancellation, RequestCancelled,
+    cancellation_scope, request_deadline, request_scope,
+)
+from app.utils.dispatcher import get_dispatcher
+from app.utils.image_ingest import ingest_upload
 from app.api.schemas import (
     ICD10Response, 
     SOAPResponse, 
@@ -13,79 +21,316 @@ from app.api.schemas import (
     ErrorResponse, 
     ICD10Code, 
     AnalyzeResponse, 
+    MultiAgentResponse,
     SOAPNote,
     RadiologyReport
 )
-from app.utils.logger import get_logger
+from app.utils.logger import get_logger, payload_summary
+from app.utils.model_loader import model_registry
+from app.utils.inference_worker import get_inference_pool, QueueFullError, WorkerUnavailableError
+from app.utils.predictor import batcher_stats
+from app.utils.prompt_cache import prefix_cache
+from app.utils.result_cache import input_fingerprint, result_cache
+from app.utils.single_flight import SingleFlight
+from app.utils.speculative import speculative_controller
+from app.config.config import config
 
 logger = get_logger(__name__)
 
 router = APIRouter()
-graph = build_graph()
+
+# How often a request waiting on the model checks whether its client is gone
+DISCONNECT_POLL_SECONDS = 0.5
+
+# Identical /analyze requests in flight
+analyze_flights = SingleFlight("analyze")
+
+
+def build_analyze_response(raw_output):
+    """
+    Converts the raw graph output into one of the API response models.
+    """
+    # Ensure output is always a State
+    if isinstance(raw_output, dict):
+        output = State(**raw_output)
+    elif isinstance(raw_output, State):
+        output = raw_output
+    else:
+        return ErrorResponse(error="Unexpected output type from graph.")
+    
+    # Pick the correct model based on type
+    if output.error:
+        return ErrorResponse(error=output.error)
+
+    if output.type == "icd10":
+        # Example output.result expected: [{"code": "...", "description": "..."}]
+        # codes = [ICD10Code(**c) for c in output.result]
+        codes = [ICD10Code(code=c.code, description=c.description) for c in output.result]
+        return ICD10Response(agent="icd10", result=codes)
+
+    elif output.type == "soap":
+        # Example output.result expected: {"Subjective": "...", "Objective": "...", "Assessment": "...", "Plan": "..."}
+        soap_note = SOAPNote(
+            Subjective=output.result.get("Subjective", ""),
+            Objective=output.result.get("Objective", ""),
+            Assessment=output.result.get("Assessment", ""),
+            Plan=output.result.get("Plan", "")
+        )
+        return SOAPResponse(agent="soap", result=soap_note)
+
+    elif output.type == "multi":
+        results, errors = {}, {}
+        for agent, entry in output.result.items():
+            response = build_analyze_response(
+                State(type=agent, payload={}, result=entry["result"], error=entry["error"])
+            )
+            if isinstance(response, ErrorResponse):
+                errors[agent] = response.error
+            else:
+                results[agent] = response
+        return MultiAgentResponse(results=results, errors=errors)
+
+    elif output.type == "image_analysis":
+        # Example output.result expected: {"technique": "...", "findings": "...", "impression": "...", "recommendations": "..."}
+        radiology_report = RadiologyReport(
+            technique=output.result.get("technique", ""),
+            findings=output.result.get("findings", ""),
+            impression=output.result.get("impression", ""),
+            recommendations=output.result.get("recommendations", ""),
+            answer_to_user_question=output.result.get("answer_to_user_question", None)
+        )
+        return ImageAnalysisResponse(agent="image_analysis", result=output.result)
+
+    else:
+        return ErrorResponse(error="Unknown analysis type.")
+
+
+async def build_initial_state(note: str, image: UploadFile, no_cache: bool = False) -> State:
+    logger.info("Received inputs - note: %d chars, image: %s", len(note or ""), bool(image and image.filename))
+    state = State(type=None, payload={}, result=None, error=None)
+
+    if note:
+        state.payload["note"] = note
+
+    if no_cache:
+        state.payload["cache_bypass"] = True
+
+    if image and image.filename:
+        state.payload["image"], metadata = await ingest_upload(image)
+        if metadata:
+            state.payload["image_metadata"] = metadata
+
+    logger.debug("Initial state: %s", payload_summary(state))
+    return state
+
+
+def run_graph(state: State):
+    with request_scope(state):
+        if config.SERVING_PROCESSES:
+            return get_dispatcher().call("app.api.analyze:run_graph", state)
+        return get_graph().invoke(state)
+
+
+def run_graph_streaming(state: State, emit):
+    """
+    Runs the graph step by step, emitting the routing decision as soon as the
+    router node finishes. Agents stream their own tokens through
+    ``payload["on_event"]``. Returns the final state.
+    """
+    with request_scope(state):
+        if config.SERVING_PROCESSES:
+            return get_dispatcher().call("app.api.analyze:run_graph_streaming", state, emit=emit)
+
+        final = None
+        routed = False
+        for value in get_graph().stream(state, stream_mode="values"):
+            final = value
+            routing = value.get("routing") if isinstance(value, dict) else None
+            if routing is not None and not routed:
+                routed = True
+                routing = routing.model_dump() if hasattr(routing, "model_dump") else routing
+                emit({"event": "routing", **routing})
+        return final
+
+
+async def wait_for_disconnect(request: Request):
+    """Returns once the client of ``request`` disconnects."""
+    while not await request.is_disconnected():
+        await asyncio.sleep(DISCONNECT_POLL_SECONDS)
+
+
+async def coalesce_key(state: State) -> str:
+    """
+    Key under which identical requests share their work: the input
+    fingerprint (normalized note, image pixels), and whether the result
+    cache is bypassed.
+    """
+    if state.payload.get("image") is not None:
+        # Hashing the pixels of a large image would hold up the event loop
+        fingerprint = await asyncio.to_thread(input_fingerprint, state.payload)
+    else:
+        fingerprint = input_fingerprint(state.payload)
+    return f"{fingerprint}:{int(bool(state.payload.get('cache_bypass')))}"
+
+
+def cancelled_response(e: RequestCancelled) -> JSONResponse:
+    # 499: nobody is left to read it, but the access log shows why the request ended
+    status_code = 499 if e.reason == DISCONNECTED else 504
+    return JSONResponse(status_code=status_code, content={"error": str(e)})
+
+
+def _sse(event: dict) -> str:
+    return f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+
+
+@router.get("/queue")
+def queue_stats():
+    stats = {**get_inference_pool().stats(), "batching": batcher_stats(), "coalescing": analyze_flights.stats()}
+    if config.SERVING_PROCESSES:
+        stats["serving"] = get_dispatcher().stats()
+    return stats
+
+
+@router.get("/cache")
+def cache_stats():
+    return {"prefix": prefix_cache.stats(), "result": result_cache.stats()}
+
+
+@router.get("/models")
+def model_stats():
+    return {**model_registry.stats(), "speculative": speculative_controller.stats()}
+
 
 @router.post("/analyze")
-async def analyze(note: str = Form(None), image: UploadFile = File(None)):
+async def analyze(
+    request: Request,
+    response: Response,
+    note: str = Form(None),
+    image: UploadFile = File(None),
+    no_cache: bool = Form(False),
+):
+    """
+    Routes the input to an agent and returns its result. The request must
+    finish within ``X-Request-Timeout`` seconds (at most, and by default,
+    ``INFERENCE_TIMEOUT_SECONDS``); the model stops working on it when that
+    passes or the client disconnects.
+
+    A request identical to one still running (see ``coalesce_key``) waits for
+    that one's result instead of starting its own, and is answered with
+    ``X-Coalesced: true``.
+    """
     if not note and not image:
         return JSONResponse(status_code=400, content={"error": "No input provided."})
 
     try:
-        logger.info(f"Recieved inputs - Note: {note}, Image: {image.filename if image else 'None'}")
-        state = State(type=None, payload={}, result=None, error=None)
-        logger.info(f"Initial state: {state}")
+        state = await build_initial_state(note, image, no_cache)
+        state.deadline = request_deadline(request.headers.get(DEADLINE_HEADER))
+        key = await coalesce_key(state) if config.COALESCE_ENABLED else None
 
-        if note:
-            state.payload["note"] = note
+        pool = get_inference_pool()
+        # No pool timeout: the flight's cancellation carries the deadline, which a later
+        # identical request may extend, and each request stops waiting at its own deadline
+        flight, coalesced = analyze_flights.attach(key, state.deadline, lambda: pool.submit(run_graph, state))
+        disconnected = asyncio.ensure_future(wait_for_disconnect(request))
+        reason = DISCONNECTED
+        try:
+            done, _ = await asyncio.wait(
+                {flight.task, disconnected}, timeout=max(0.0, state.deadline - time.time()), return_when=asyncio.FIRST_COMPLETED
+            )
+            if flight.task not in done:
+                if disconnected in done:
+                    logger.info("Client disconnected; leaving its request")
+                    return cancelled_response(RequestCancelled(DISCONNECTED))
+                reason = DEADLINE
+                return JSONResponse(status_code=504, content={"error": "Analysis timed out."})
+            raw_output = flight.task.result()
+        except QueueFullError as e:
+            logger.warning("Rejecting request: %s", e)
+            return JSONResponse(status_code=429, content={"error": str(e)}, headers={"Retry-After": "5"})
+        except WorkerUnavailableError as e:
+            return JSONResponse(status_code=503, content={"error": str(e)})
+        except asyncio.TimeoutError:
+            return JSONResponse(status_code=504, content={"error": "Analysis timed out."})
+        except RequestCancelled as e:
+            return cancelled_response(e)
+        finally:
+            disconnected.cancel()
+            # The model work stops once no request is waiting for it
+            analyze_flights.leave(flight, reason)
 
-        if image and image.filename:
-            contents = await image.read()
-            pil_image = convert_uploadfile_to_image(contents)
-            state.payload["image"] = pil_image
+        response.headers["X-Queue-Depth"] = str(pool.queue_depth())
+        if coalesced:
+            response.headers["X-Coalesced"] = "true"
+        return build_analyze_response(raw_output)
 
-        logger.info(f"Initial state: {state}")
+    except Exception as e:
+        return ErrorResponse(error=str(e))
 
-        raw_output = graph.invoke(state)
 
-        # Ensure output is always a State
-        if isinstance(raw_output, dict):
-            output = State(**raw_output)
-        elif isinstance(raw_output, State):
-            output = raw_output
-        else:
-            return ErrorResponse(error="Unexpected output type from graph.")
-        
-        # Pick the correct model based on type
-        if output.error:
-            return ErrorResponse(error=output.error)
-
-        if output.type == "icd10":
-            # Example output.result expected: [{"code": "...", "description": "..."}]
-            # codes = [ICD10Code(**c) for c in output.result]
-            codes = [ICD10Code(code=c.code, description=c.description) for c in output.result]
-            return ICD10Response(agent="icd10", result=codes)
-
-        elif output.type == "soap":
-            # Example output.result expected: {"Subjective": "...", "Objective": "...", "Assessment": "...", "Plan": "..."}
-            soap_note = SOAPNote(
-                Subjective=output.result.get("Subjective", ""),
-                Objective=output.result.get("Objective", ""),
-                Assessment=output.result.get("Assessment", ""),
-                Plan=output.result.get("Plan", "")
-            )
-            return SOAPResponse(agent="soap", result=soap_note)
-
-        elif output.type == "image_analysis":
-            # Example output.result expected: {"technique": "...", "findings": "...", "impression": "...", "recommendations": "..."}
-            radiology_report = RadiologyReport(
-                technique=output.result.get("technique", ""),
-                findings=output.result.get("findings", ""),
-                impression=output.result.get("impression", ""),
-                recommendations=output.result.get("recommendations", ""),
-                answer_to_user_question=output.result.get("answer_to_user_question", None)
-            )
-            return ImageAnalysisResponse(agent="image_analysis", result=output.result)
+@router.post("/analyze/stream")
+async def analyze_stream(
+    request: Request, note: str = Form(None), image: UploadFile = File(None), no_cache: bool = Form(False)
+):
+    """
+    Server-sent events variant of /analyze. Emits, in order: ``routing``, then
+    ``token`` events as the agent decodes, ``field`` (SOAP / radiology sections)
+    or ``item`` (ICD-10 codes) events as each one closes, and finally
+    ``result`` with the same body /analyze returns (or ``error``). Closing
+    the stream cancels the request.
+    """
+    if not note and not image:
+        return JSONResponse(status_code=400, content={"error": "No input provided."})
+
+    try:
+        state = await build_initial_state(note, image, no_cache)
+    except Exception as e:
+        return JSONResponse(status_code=400, content={"error": str(e)})
 
+    loop = asyncio.get_running_loop()
+    events: asyncio.Queue = asyncio.Queue()
+
+    def emit(event: dict):
+        loop.call_soon_threadsafe(events.put_nowait, event)
+
+    state.payload["on_event"] = emit
+    state.deadline = request_deadline(request.headers.get(DEADLINE_HEADER))
+    cancellation = Cancellation(state.deadline)
+    try:
+        with cancellation_scope(cancellation):
+            job = get_inference_pool().enqueue(run_graph_streaming, state, emit)
+    except QueueFullError as e:
+        logger.warning("Rejecting request: %s", e)
+        return JSONResponse(status_code=429, content={"error": str(e)}, headers={"Retry-After": "5"})
+    except WorkerUnavailableError as e:
+        return JSONResponse(status_code=503, content={"error": str(e)})
+    # Runs after every event the worker scheduled before finishing
+    job.add_done_callback(lambda _: events.put_nowait(None))
+
+    async def event_stream():
+        try:
+            while True:
+                try:
+                    event = await asyncio.wait_for(events.get(), timeout=max(0.0, cancellation.remaining()))
+                except asyncio.TimeoutError:
+                    cancellation.cancel(DEADLINE)
+                    yield _sse({"event": "error", "error": "Analysis timed out."})
+                    return
+                if event is None:
+                    break
+                yield _sse(event)
+        finally:
+            # The client closed the stream (or it timed out) while the model was still working
+            if not job.done():
+                cancellation.cancel(DISCONNECTED)
+                job.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+        try:
+            result = build_analyze_response(job.result())
+        except Exception as e:
+            result = ErrorResponse(error=str(e))
+        if isinstance(result, ErrorResponse):
+            yield _sse({"event": "error", "error": result.error})
         else:
-            return ErrorResponse(error="Unknown analysis type.")
+            yield _sse({"event": "result", "data": result.model_dump()})
 
-    except Exception as e:
-        return ErrorResponse(error=str(e))
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
@@ -0,0 +1,290 @@
+import asyncio
+import base64
+import io
+import json
+import os
+import tempfile
+import time
+from typing import Optional
+
+from fastapi import APIRouter, Request
+from fastapi.responses import StreamingResponse
+
+from app.api.analyze import build_analyze_response
+from app.api.schemas import ErrorResponse
+from app.config.config import config
+from app.graph.graph_builder import branch_result, branch_state, fanout_agents, join_branches, run_node
+from app.graph.types import State
+from app.utils.deadline import (
+    DEADLINE, DEADLINE_HEADER, DISCONNECTED, Cancellation, RequestCancelled, cancellation_scope, request_deadline
+)
+from app.utils.image_ingest import load_image
+from app.utils.inference_worker import get_inference_pool, QueueFullError
+from app.utils.logger import get_logger, get_correlation_id, set_correlation_id
+
+logger = get_logger(__name__)
+
+router = APIRouter()
+
+# Request bodies above this size are spooled to disk instead of memory
+SPOOL_MAX_BYTES = 4 * 1024 * 1024
+# Backoff while the inference queue is full; the item fails after its timeout
+RETRY_BACKOFF_SECONDS = (0.05, 0.1, 0.2, 0.5, 1.0)
+
+
+def _read_image(item: dict) -> tuple:
+    if item.get("image_base64"):
+        return load_image(io.BytesIO(base64.b64decode(item["image_base64"])))
+
+    path = item.get("image_path")
+    if not path:
+        return None, {}
+    if not config.BULK_IMAGE_ROOT:
+        raise ValueError("image_path is disabled; set BULK_IMAGE_ROOT or send image_base64.")
+    root = os.path.realpath(config.BULK_IMAGE_ROOT)
+    full_path = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, full_path]) != root:
+        raise ValueError("image_path must be inside BULK_IMAGE_ROOT.")
+    with open(full_path, "rb") as f:
+        return load_image(f)
+
+
+def parse_item(line: bytes, no_cache: bool = False) -> tuple:
+    """
+    Parses one NDJSON line (``{"id", "note", "image_base64" | "image_path"}``)
+    into the item's id and the initial graph state.
+    """
+    item = json.loads(line)
+    if not isinstance(item, dict):
+        raise ValueError("Each line must be a JSON object.")
+
+    state = State(type=None, payload={}, result=None, error=None)
+    if item.get("note"):
+        state.payload["note"] = str(item["note"])
+    image, metadata = _read_image(item)
+    if image is not None:
+        state.payload["image"] = image
+    if metadata:
+        state.payload["image_metadata"] = metadata
+    if not state.payload:
+        raise ValueError("No input provided.")
+    if no_cache or item.get("no_cache"):
+        state.payload["cache_bypass"] = True
+    return item.get("id"), state
+
+
+def merge_update(state: State, output) -> State:
+    """
+    Applies a node's output to ``state`` the way the compiled graph does: only
+    the fields the node set replace the current ones.
+    """
+    if isinstance(output, State):
+        update = {name: getattr(output, name) for name in output.model_fields_set}
+    else:
+        update = dict(output)
+    current = {name: getattr(state, name) for name in State.model_fields}
+    return State(**{**current, **update})
+
+
+async def _run_node(name: str, state: State) -> State:
+    pool = get_inference_pool()
+    # The node runs under this, so it stops when the item's deadline passes or the batch is abandoned
+    cancellation = Cancellation(state.deadline)
+    attempt = 0
+    while True:
+        try:
+            with cancellation_scope(cancellation):
+                output = await pool.submit(run_node, name, state, timeout=max(0.0, cancellation.remaining()))
+            return merge_update(state, output)
+        except QueueFullError:
+            if cancellation.remaining() <= 0:
+                raise
+            await asyncio.sleep(RETRY_BACKOFF_SECONDS[min(attempt, len(RETRY_BACKOFF_SECONDS) - 1)])
+            attempt += 1
+        except asyncio.TimeoutError:
+            cancellation.cancel(DEADLINE)
+            raise
+        except asyncio.CancelledError:
+            cancellation.cancel(DISCONNECTED)
+            raise
+
+
+class AgentGroups:
+    """
+    Collects routed items per agent and releases each group to the inference
+    pool together, so items with the same prompt template reach the batcher
+    (and the prompt prefix cache) back to back. A group is released when it
+    has ``max_size`` items or ``linger`` seconds after its first item.
+    """
+
+    def __init__(self, max_size: int, linger: float):
+        self.max_size = max(1, max_size)
+        self.linger = linger
+        self._groups = {}
+        self._timers = {}
+
+    def add(self, agent: str, state: State) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        group = self._groups.setdefault(agent, [])
+        group.append((state, future))
+        if len(group) >= self.max_size:
+            self.flush(agent)
+        elif agent not in self._timers:
+            self._timers[agent] = loop.call_later(self.linger, self.flush, agent)
+        return future
+
+    def flush(self, agent: str):
+        timer = self._timers.pop(agent, None)
+        if timer is not None:
+            timer.cancel()
+        group = self._groups.pop(agent, [])
+        if group:
+            logger.info("Releasing a group of %d %s item(s)", len(group), agent)
+        for state, future in group:
+            task = asyncio.ensure_future(_run_node(agent, state))
+            task.add_done_callback(lambda t, f=future: _chain(t, f))
+            # An abandoned item stops its node too
+            future.add_done_callback(lambda f, t=task: t.cancel() if f.cancelled() else None)
+
+    def cancel(self):
+        for timer in self._timers.values():
+            timer.cancel()
+        for group in self._groups.values():
+            for _, future in group:
+                future.cancel()
+        self._timers.clear()
+        self._groups.clear()
+
+
+def _chain(task: asyncio.Task, future: asyncio.Future):
+    if future.done():
+        return
+    if task.cancelled():
+        future.cancel()
+    elif task.exception() is not None:
+        future.set_exception(task.exception())
+    else:
+        future.set_result(task.result())
+
+
+async def process_item(index: int, line: bytes, groups: AgentGroups, no_cache: bool, timeout: Optional[str] = None) -> dict:
+    item_id = None
+    # Each item runs in its own task, so this only tags the item's records
+    set_correlation_id(f"{get_correlation_id() or 'batch'}:{index}")
+    try:
+        # Image decoding happens here, off the event loop
+        item_id, state = await asyncio.to_thread(parse_item, line, no_cache)
+        # Every item gets the whole timeout, from when it was read
+        state.deadline = request_deadline(timeout)
+        state = await _run_node("router", state)
+        agents = fanout_agents(state) if state.error is None else None
+        if agents:
+            outputs = await asyncio.gather(
+                *(groups.add(agent, branch_state(state, agent)) for agent in agents), return_exceptions=True
+            )
+            results = {}
+            for agent, output in zip(agents, outputs):
+                if isinstance(output, (RequestCancelled, asyncio.TimeoutError, asyncio.CancelledError)):
+                    # The item's deadline or the batch itself ended, not just this branch
+                    raise output
+                if isinstance(output, BaseException):
+                    logger.warning("%s branch of item %d failed: %s", agent, index, output)
+                    output = {"result": None, "error": str(output) or type(output).__name__}
+                results.update(branch_result(agent, output))
+            state = join_branches(state, results)
+        elif state.error is None and state.type is not None:
+            state = await groups.add(state.type, state)
+
+        result = build_analyze_response(state)
+        if isinstance(result, ErrorResponse):
+            return {"index": index, "id": item_id, "status": "error", "error": result.error}
+        routing = state.routing.model_dump() if state.routing is not None else None
+        return {"index": index, "id": item_id, "status": "ok", **result.model_dump(), "routing": routing}
+    except asyncio.CancelledError:
+        raise
+    except asyncio.TimeoutError:
+        return {"index": index, "id": item_id, "status": "error", "error": "Analysis timed out."}
+
+    except Exception as e:
+        return {"index": index, "id": item_id, "status": "error", "error": str(e) or type(e).__name__}
+
+
+async def _spool(request: Request):
+    body = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    async for chunk in request.stream():
+        body.write(chunk)
+    body.seek(0)
+    return body
+
+
+@router.post("/analyze/batch")
+async def analyze_batch(request: Request, no_cache: bool = False):
+    """
+    Bulk analysis. The body is NDJSON, one item per line:
+    ``{"id": ..., "note": "...", "image_base64": "..."}`` (or ``image_path``
+    relative to ``BULK_IMAGE_ROOT``). Results are streamed back as NDJSON in
+    completion order, ``{"index", "id", "status": "ok", "agent", "result",
+    "routing"}`` or ``{"index", "id", "status": "error", "error"}``, followed
+    by a ``{"done": true, ...}`` summary line. A failing item does not stop
+    the others. ``X-Request-Timeout`` applies to each item.
+
+    At most ``BULK_MAX_IN_FLIGHT`` items are parsed, queued or waiting to be
+    written at any time; routed items are grouped per agent before they are
+    sent to the inference pool.
+    """
+    body = await _spool(request)
+    timeout = request.headers.get(DEADLINE_HEADER)
+
+    async def results():
+        slots = asyncio.Semaphore(config.BULK_MAX_IN_FLIGHT)
+        lines: asyncio.Queue = asyncio.Queue()
+        groups = AgentGroups(config.BATCH_MAX_SIZE, config.BULK_GROUP_LINGER_MS / 1000.0)
+        tasks = set()
+        started = time.perf_counter()
+
+        async def produce():
+            index = 0
+            for line in body:
+                if not line.strip():
+                    continue
+                await slots.acquire()
+                task = asyncio.ensure_future(process_item(index, line, groups, no_cache, timeout))
+                task.add_done_callback(lambda t: lines.put_nowait(None if t.cancelled() else t.result()))
+                tasks.add(task)
+                index += 1
+            return index
+
+        producer = asyncio.ensure_future(produce())
+        written = errors = 0
+        try:
+            while not (producer.done() and written == len(tasks)):
+                getter = asyncio.ensure_future(lines.get())
+                if not producer.done():
+                    # Wakes up when the body is exhausted, to check whether anything is left
+                    await asyncio.wait({getter, producer}, return_when=asyncio.FIRST_COMPLETED)
+                    if not getter.done():
+                        getter.cancel()
+                        producer.result()
+                        continue
+                line = await getter
+                written += 1
+                if line is not None:
+                    errors += line["status"] == "error"
+                    yield json.dumps(line) + "\n"
+                slots.release()
+
+            yield json.dumps({
+                "done": True,
+                "items": written,
+                "errors": errors,
+                "seconds": round(time.perf_counter() - started, 3),
+            }) + "\n"
+        finally:
+            producer.cancel()
+            groups.cancel()
+            for task in tasks:
+                task.cancel()
+            body.close()
+
+    return StreamingResponse(results(), media_type="application/x-ndjson")
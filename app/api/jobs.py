@@ -0,0 +1,137 @@
+import asyncio
+import io
+import threading
+from typing import Optional
+
+from fastapi import APIRouter, UploadFile, File, Form
+from fastapi.responses import JSONResponse
+
+from app.api.analyze import build_analyze_response, run_graph
+from app.api.schemas import ErrorResponse
+from app.config.config import config
+from app.graph.types import State
+from app.utils.image_ingest import load_image, validate_image
+from app.utils.job_store import JobStore, JobRunner, JobError, SUCCEEDED, FAILED, CANCELLED
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+router = APIRouter()
+
+_runner: Optional[JobRunner] = None
+_runner_lock = threading.Lock()
+
+
+def run_job(job: dict) -> dict:
+    """
+    Runs the compiled graph on a stored job's inputs and returns the same body
+    /analyze would. An agent error fails the job without a retry.
+    """
+    state = State(type=None, payload={}, result=None, error=None)
+    if job["note"]:
+        state.payload["note"] = job["note"]
+    if job["image"]:
+        state.payload["image"], metadata = load_image(io.BytesIO(job["image"]))
+        if metadata:
+            state.payload["image_metadata"] = metadata
+    if job["options"].get("no_cache"):
+        state.payload["cache_bypass"] = True
+
+    result = build_analyze_response(run_graph(state))
+    if isinstance(result, ErrorResponse):
+        raise JobError(result.error)
+    return result.model_dump()
+
+
+def get_job_runner() -> JobRunner:
+    """
+    Returns the process-wide job runner, opening the store and starting the
+    workers on first use.
+    """
+    global _runner
+
+    with _runner_lock:
+        if _runner is None:
+            store = JobStore(
+                config.JOB_STORE_PATH,
+                max_attempts=config.JOB_MAX_ATTEMPTS,
+                retry_backoff=config.JOB_RETRY_BACKOFF_SECONDS,
+                ttl_seconds=config.JOB_RESULT_TTL_SECONDS,
+            )
+            _runner = JobRunner(store, run_job, num_workers=config.JOB_WORKERS)
+            _runner.start()
+    return _runner
+
+
+def _not_found(job_id: str) -> JSONResponse:
+    return JSONResponse(status_code=404, content={"error": f"Job {job_id} not found or expired."})
+
+
+@router.get("/jobs")
+def job_stats():
+    return get_job_runner().stats()
+
+
+@router.post("/jobs", status_code=202)
+async def submit_job(note: str = Form(None), image: UploadFile = File(None), no_cache: bool = Form(False)):
+    """
+    Queues an analysis and returns its id immediately. Poll ``/jobs/{id}``
+    and fetch the body /analyze would return from ``/jobs/{id}/result``.
+    """
+    if not note and not image:
+        return JSONResponse(status_code=400, content={"error": "No input provided."})
+
+    contents = None
+    if image and image.filename:
+        try:
+            # Header checks only; rejected now rather than on every attempt
+            await asyncio.to_thread(validate_image, image.file)
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"error": str(e)})
+        await image.seek(0)
+        contents = await image.read()
+
+    runner = get_job_runner()
+    job = await asyncio.to_thread(runner.store.create, note, contents, {"no_cache": no_cache})
+    runner.notify()
+    logger.info("Queued job %s", job["id"])
+    return JSONResponse(
+        status_code=202,
+        content={"job_id": job["id"], "status": job["status"]},
+        headers={"Location": f"/api/jobs/{job['id']}"},
+    )
+
+
+@router.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    job = await asyncio.to_thread(get_job_runner().store.get, job_id)
+    if job is None:
+        return _not_found(job_id)
+    return job
+
+
+@router.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    """
+    200 with the analysis once the job succeeded (or ``{"error"}`` if it
+    failed), 202 with the status while it is queued or running, 409 if it
+    was cancelled.
+    """
+    job = await asyncio.to_thread(get_job_runner().store.get, job_id, True)
+    if job is None:
+        return _not_found(job_id)
+    if job["status"] == SUCCEEDED:
+        return job["result"]
+    if job["status"] == FAILED:
+        return ErrorResponse(error=job["error"] or "Analysis failed.")
+    if job["status"] == CANCELLED:
+        return JSONResponse(status_code=409, content={"error": f"Job {job_id} was cancelled."})
+    return JSONResponse(status_code=202, content={"job_id": job_id, "status": job["status"]})
+
+
+@router.delete("/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = await asyncio.to_thread(get_job_runner().store.cancel, job_id)
+    if job is None:
+        return _not_found(job_id)
+    return job
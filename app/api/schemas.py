@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List, Optional, Literal, Union, TypeAlias
+from typing import Dict, List, Optional, Literal, Union, TypeAlias
 
 class ICD10Code(BaseModel):
     code: str
@@ -16,6 +16,12 @@ class SOAPNote(BaseModel):
     Assessment: str
     Plan: str
 
+class SOAPFacts(BaseModel):
+    Subjective: List[str]
+    Objective: List[str]
+    Assessment: List[str]
+    Plan: List[str]
+
 class SOAPResponse(BaseModel):
     agent: Literal["soap"]
     result: SOAPNote
@@ -34,10 +40,17 @@ class ImageAnalysisResponse(BaseModel):
 class ErrorResponse(BaseModel):
     error: str
 
+class MultiAgentResponse(BaseModel):
+    agent: Literal["multi"] = "multi"
+    # One entry per agent that succeeded, and the error of each one that failed
+    results: Dict[str, Union[ICD10Response, SOAPResponse, ImageAnalysisResponse]]
+    errors: Dict[str, str] = {}
+
 # Type alias for FastAPI response_model
 AnalyzeResponse: TypeAlias = Union[
     ICD10Response,
     SOAPResponse,
     ImageAnalysisResponse,
+    MultiAgentResponse,
     ErrorResponse
 ]
@@ -1,10 +1,173 @@
-import mlx.core as mx
-from mlx_lm import load, generate 
+import os
 
 class Config:
-    MODEL_ID = "mlx-community/medgemma-4b-it-4bit"
+    MODEL_ID = os.getenv("MODEL_ID", "mlx-community/medgemma-4b-it-4bit")
+    # "mlx" loads MODEL_ID with mlx_vlm; "stub" (or "package.module:Class") plugs in a ModelBackend
+    MODEL_BACKEND = os.getenv("MODEL_BACKEND", "mlx")
+
+    # Model registry: the model spec an agent runs on when it should not use the default
+    # model (see model_for); agents naming the same spec share it. A repo id loads with
+    # mlx_vlm, "lm:<repo id>" a text-only mlx_lm model, and "stub" or "package.module:Class"
+    # a ModelBackend. E.g. ROUTER_MODEL=lm:mlx-community/Qwen2.5-0.5B-Instruct-4bit
+    AGENT_MODELS = {
+        agent: spec
+        for agent, spec in {
+            "router": os.getenv("ROUTER_MODEL"),
+            "icd10": os.getenv("ICD10_MODEL"),
+            "soap": os.getenv("SOAP_MODEL"),
+            "image_analysis": os.getenv("IMAGE_ANALYSIS_MODEL"),
+        }.items()
+        if spec
+    }
+    MODEL_AGENTS = ("router", "icd10", "soap", "image_analysis")
+    # Least recently used models are unloaded to keep their weights under this (0: no limit)
+    MODEL_MEMORY_BUDGET_GB = float(os.getenv("MODEL_MEMORY_BUDGET_GB", "0"))
+    # Simulated decode time of the stub backend
+    STUB_SECONDS_PER_TOKEN = float(os.getenv("STUB_SECONDS_PER_TOKEN", "0"))
     # MAX_NEW_TOKENS = 1024
     # TORCH_DTYPE = torch.float32 if torch.backends.mps.is_available() else torch.bfloat16
     # DEVICE_MAP = "auto"
 
-config = Config()
\ No newline at end of file
+    # Inference worker pool in front of the compiled graph
+    # Workers share each model: the batcher below serializes model access, or without it
+    # a per-model lock does, so extra workers only overlap the work around generation
+    INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", "8"))
+    INFERENCE_QUEUE_SIZE = int(os.getenv("INFERENCE_QUEUE_SIZE", "16"))
+    INFERENCE_TIMEOUT_SECONDS = float(os.getenv("INFERENCE_TIMEOUT_SECONDS", "300"))
+
+    # Per-request deadlines: clients may ask for less than INFERENCE_TIMEOUT_SECONDS
+    # with the X-Request-Timeout header (seconds). A node is shed before it starts
+    # when the time left is under its typical latency times DEADLINE_SHED_FACTOR
+    # (0 disables shedding), and max_tokens shrinks to what the time left can decode
+    DEADLINE_SHED_FACTOR = float(os.getenv("DEADLINE_SHED_FACTOR", "1.0"))
+    DEADLINE_FIT_MAX_TOKENS = os.getenv("DEADLINE_FIT_MAX_TOKENS", "true").lower() == "true"
+
+    # Identical /api/analyze requests (same normalized note and image) arriving while
+    # one is running attach to it instead of starting their own model work
+    COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "true").lower() == "true"
+
+    # Dynamic batching of generate calls across concurrent requests
+    BATCHING_ENABLED = os.getenv("BATCHING_ENABLED", "true").lower() == "true"
+    BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+    BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "15"))
+
+    # /api/analyze/batch: items read ahead of the results, how long a routed
+    # group waits for more items of the same agent, and where image_path is resolved
+    BULK_MAX_IN_FLIGHT = int(os.getenv("BULK_MAX_IN_FLIGHT", "16"))
+    BULK_GROUP_LINGER_MS = float(os.getenv("BULK_GROUP_LINGER_MS", "50"))
+    BULK_IMAGE_ROOT = os.getenv("BULK_IMAGE_ROOT", "")
+
+    # Asynchronous /api/jobs: SQLite job store and the workers running the graph for it
+    JOB_STORE_PATH = os.getenv("JOB_STORE_PATH", "data/jobs.sqlite3")
+    JOB_WORKERS = int(os.getenv("JOB_WORKERS", "1"))
+    JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+    # Doubled after every failed attempt
+    JOB_RETRY_BACKOFF_SECONDS = float(os.getenv("JOB_RETRY_BACKOFF_SECONDS", "5"))
+    # Finished jobs (and their results) are deleted after this long
+    JOB_RESULT_TTL_SECONDS = float(os.getenv("JOB_RESULT_TTL_SECONDS", "86400"))
+
+    # Image ingestion: uploads past UPLOAD_SPOOL_MAX_BYTES are spooled to disk; files
+    # over the byte or pixel limits are rejected from the header, before decoding
+    UPLOAD_SPOOL_MAX_BYTES = int(os.getenv("UPLOAD_SPOOL_MAX_BYTES", str(1024 * 1024)))
+    IMAGE_MAX_UPLOAD_BYTES = int(os.getenv("IMAGE_MAX_UPLOAD_BYTES", str(64 * 1024 * 1024)))
+    IMAGE_MAX_PIXELS = int(os.getenv("IMAGE_MAX_PIXELS", str(64_000_000)))
+    # Images are decoded/downscaled to keep both sides >= this; the MedGemma processor resizes to 896x896
+    IMAGE_TARGET_SIZE = int(os.getenv("IMAGE_TARGET_SIZE", "896"))
+    # DICOM files are memory-mapped, so they may be larger than other images
+    DICOM_MAX_UPLOAD_BYTES = int(os.getenv("DICOM_MAX_UPLOAD_BYTES", str(1024 * 1024 * 1024)))
+    # Frames tiled into one montage for a multi-frame DICOM (1: the middle frame only)
+    DICOM_MONTAGE_FRAMES = int(os.getenv("DICOM_MONTAGE_FRAMES", "9"))
+
+    # Startup: the model is loaded in the background, then each listed agent's prompt shape
+    # is run for a few tokens before /readyz reports ready
+    WARMUP_ENABLED = os.getenv("WARMUP_ENABLED", "true").lower() == "true"
+    WARMUP_AGENTS = [a for a in os.getenv("WARMUP_AGENTS", "router,icd10,soap,image_analysis").split(",") if a]
+    WARMUP_MAX_TOKENS = int(os.getenv("WARMUP_MAX_TOKENS", "4"))
+
+    # Multi-process serving: this many inference worker processes each load their own copy
+    # of the models (nothing is shared, so N workers need N times the model memory) and run
+    # the graph; 0 runs it in this process. Workers without a heartbeat for SERVING_UNHEALTHY_AFTER_SECONDS get
+    # no requests, and crashed workers are restarted after a backoff that doubles up to 30s
+    SERVING_PROCESSES = int(os.getenv("SERVING_PROCESSES", "0"))
+    SERVING_WORKER_THREADS = int(os.getenv("SERVING_WORKER_THREADS", "4"))
+    SERVING_HEARTBEAT_SECONDS = float(os.getenv("SERVING_HEARTBEAT_SECONDS", "2"))
+    SERVING_UNHEALTHY_AFTER_SECONDS = float(os.getenv("SERVING_UNHEALTHY_AFTER_SECONDS", "10"))
+    SERVING_RESTART_BACKOFF_SECONDS = float(os.getenv("SERVING_RESTART_BACKOFF_SECONDS", "1"))
+
+    # Structured logging: "json" lines (or "text"), written from a background thread;
+    # DEBUG records (payload summaries, prompts) are kept for this fraction of requests
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+    LOG_VERBOSE_SAMPLE_RATE = float(os.getenv("LOG_VERBOSE_SAMPLE_RATE", "0.1"))
+    # Records are dropped rather than blocking the caller when this many are pending
+    LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+
+    # A long note sent with an image runs image_analysis and the note's agent concurrently
+    FANOUT_ENABLED = os.getenv("FANOUT_ENABLED", "true").lower() == "true"
+
+    # Router tiers: rules and the local classifier must reach this confidence to skip the LLM
+    ROUTER_CONFIDENCE_THRESHOLD = float(os.getenv("ROUTER_CONFIDENCE_THRESHOLD", "0.8"))
+
+    # Generate text-only requests with mlx_lm on the language model (False: mlx_vlm without images)
+    TEXT_ONLY_ENABLED = os.getenv("TEXT_ONLY_ENABLED", "true").lower() == "true"
+
+    # Speculative decoding: DRAFT_MODEL (an mlx_lm repo sharing the target's tokenizer, e.g. a
+    # small Gemma 3) proposes SPECULATIVE_DRAFT_TOKENS tokens that the agent's model verifies in one
+    # pass. Off while DRAFT_MODEL is empty. An agent whose acceptance rate over the last
+    # SPECULATIVE_WINDOW_TOKENS drafted tokens falls under SPECULATIVE_MIN_ACCEPTANCE decodes
+    # normally, retrying the draft every SPECULATIVE_PROBE_EVERY generations
+    DRAFT_MODEL = os.getenv("DRAFT_MODEL", "")
+    SPECULATIVE_AGENTS = [a for a in os.getenv("SPECULATIVE_AGENTS", "icd10,soap,soap_map,soap_reduce").split(",") if a]
+    SPECULATIVE_DRAFT_TOKENS = int(os.getenv("SPECULATIVE_DRAFT_TOKENS", "3"))
+    SPECULATIVE_MIN_ACCEPTANCE = float(os.getenv("SPECULATIVE_MIN_ACCEPTANCE", "0.4"))
+    SPECULATIVE_WINDOW_TOKENS = int(os.getenv("SPECULATIVE_WINDOW_TOKENS", "512"))
+    SPECULATIVE_PROBE_EVERY = int(os.getenv("SPECULATIVE_PROBE_EVERY", "20"))
+
+    # Reuse a prefilled KV cache for each agent's static instruction block
+    PREFIX_CACHE_ENABLED = os.getenv("PREFIX_CACHE_ENABLED", "true").lower() == "true"
+
+    # Content-addressed result cache (memory LRU + optional SQLite file)
+    RESULT_CACHE_ENABLED = os.getenv("RESULT_CACHE_ENABLED", "true").lower() == "true"
+    RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RESULT_CACHE_MAX_ENTRIES", "1024"))
+    RESULT_CACHE_TTL_SECONDS = float(os.getenv("RESULT_CACHE_TTL_SECONDS", "86400"))
+    RESULT_CACHE_SQLITE_PATH = os.getenv("RESULT_CACHE_SQLITE_PATH", "")
+
+    # Restrict ICD-10 / SOAP / radiology decoding to JSON matching their response schemas
+    CONSTRAINED_DECODING_ENABLED = os.getenv("CONSTRAINED_DECODING_ENABLED", "true").lower() == "true"
+
+    # ICD-10-CM code index used to validate and canonicalize ICD-10 agent output
+    ICD10_ORDER_FILE = os.getenv("ICD10_ORDER_FILE", "data/icd10cm_order.txt")
+    ICD10_INDEX_DIR = os.getenv("ICD10_INDEX_DIR", "data/icd10_index")
+    ICD10_VALIDATION_ENABLED = os.getenv("ICD10_VALIDATION_ENABLED", "true").lower() == "true"
+
+    # TF-IDF shortlist of candidate codes put in the ICD-10 prompt
+    ICD10_RETRIEVAL_ENABLED = os.getenv("ICD10_RETRIEVAL_ENABLED", "true").lower() == "true"
+    ICD10_RETRIEVAL_TOP_K = int(os.getenv("ICD10_RETRIEVAL_TOP_K", "20"))
+
+    # Long transcripts (at least SOAP_MAP_REDUCE_MIN_TOKENS) are split into overlapping
+    # chunks of speaker turns; S/O/A/P facts are extracted from up to SOAP_MAP_CONCURRENCY
+    # chunks at a time, deduplicated, and merged into the note by a final pass
+    SOAP_MAP_REDUCE_ENABLED = os.getenv("SOAP_MAP_REDUCE_ENABLED", "true").lower() == "true"
+    SOAP_MAP_REDUCE_MIN_TOKENS = int(os.getenv("SOAP_MAP_REDUCE_MIN_TOKENS", "3000"))
+    SOAP_CHUNK_TOKENS = int(os.getenv("SOAP_CHUNK_TOKENS", "1500"))
+    SOAP_CHUNK_OVERLAP_TOKENS = int(os.getenv("SOAP_CHUNK_OVERLAP_TOKENS", "150"))
+    SOAP_MAP_CONCURRENCY = int(os.getenv("SOAP_MAP_CONCURRENCY", "8"))
+    SOAP_MAP_MAX_TOKENS = int(os.getenv("SOAP_MAP_MAX_TOKENS", "384"))
+
+    # Per-agent generation budgets
+    ROUTER_MAX_TOKENS = int(os.getenv("ROUTER_MAX_TOKENS", "16"))
+    ICD10_MAX_TOKENS = int(os.getenv("ICD10_MAX_TOKENS", "384"))
+    SOAP_MAX_TOKENS = int(os.getenv("SOAP_MAX_TOKENS", "768"))
+    IMAGE_ANALYSIS_MAX_TOKENS = int(os.getenv("IMAGE_ANALYSIS_MAX_TOKENS", "512"))
+
+    # Resolved on every call so that overriding MODEL_BACKEND or MODEL_ID after import
+    # (e.g. run_evaluation.py --backend) changes the models the agents load
+    def default_model(self) -> str:
+        """The model spec of agents without an entry in AGENT_MODELS."""
+        return self.MODEL_ID if self.MODEL_BACKEND == "mlx" else self.MODEL_BACKEND
+
+    def model_for(self, agent: str) -> str:
+        """The model spec ``agent`` runs on."""
+        return self.AGENT_MODELS.get(agent) or self.default_model()
+
+config = Config()
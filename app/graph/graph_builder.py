@@ -1,30 +1,172 @@
 # app/graph/graph_builder.py
 
+import threading
+from typing import Any, Callable, List, Optional
+
+from app.config.config import config
 from app.graph.types import State
 from app.agents.icd10_agent import ICD10Agent
 from app.agents.soap_generator_agent import SoapGeneratorAgent
 from app.agents.image_analyzer_agent import ImageAnalyzerAgent
 from app.agents.router_agent import RouterAgent
+from app.utils.deadline import RequestCancelled, deadline_node, request_scope
+from app.utils.logger import get_logger
+from app.utils.metrics import instrumented_node
+from app.utils.result_cache import cached_node
 from langgraph.graph import START, END, StateGraph
 
+logger = get_logger(__name__)
+
+# Node name -> agent class; every node is wrapped with the result cache, deadline checks and metrics
+AGENTS = {
+    "router": RouterAgent,
+    "icd10": ICD10Agent,
+    "soap": SoapGeneratorAgent,
+    "image_analysis": ImageAnalyzerAgent,
+}
+
+_nodes = None
+_graph = None
+_lock = threading.RLock()
+
+
+def get_nodes() -> dict:
+    """
+    The graph's node functions (agents wrapped with the result cache,
+    deadline checks and metrics), created once and shared by the compiled
+    graph and the batch pipeline. Cache hits skip the deadline check.
+    """
+    global _nodes
+
+    with _lock:
+        if _nodes is None:
+            _nodes = {
+                name: instrumented_node(name, cached_node(name, deadline_node(name, agent().run)))
+                for name, agent in AGENTS.items()
+            }
+    return _nodes
+
+
+def run_node(name: str, state: State):
+    """
+    Runs one node on ``state`` and returns its update, on a worker process
+    when ``SERVING_PROCESSES`` is set, within ``state.deadline``.
+    """
+    with request_scope(state):
+        if config.SERVING_PROCESSES:
+            from app.utils.dispatcher import get_dispatcher
+
+            return get_dispatcher().call("app.graph.graph_builder:run_node", name, state)
+        return get_nodes()[name](state)
+
+
+def get_graph():
+    """
+    The compiled graph, built on first use. Building it constructs the agents,
+    which loads the model, so this is called from the warmup thread rather
+    than at import time.
+    """
+    global _graph
+
+    with _lock:
+        if _graph is None:
+            _graph = build_graph()
+    return _graph
+
+
+def fanout_agents(state: State) -> Optional[List[str]]:
+    """The agents a fanned-out request runs in parallel, or None for a single agent."""
+    agents = state.routing.agents if state.routing is not None else None
+    return list(agents) if agents and len(agents) > 1 else None
+
+
+def branch_state(state: State, name: str) -> State:
+    """
+    The input of ``name``'s branch of a fan-out: its own copy of the payload
+    (branches run concurrently), without the image for the text agents, and
+    with streamed events tagged with the agent.
+    """
+    payload = dict(state.payload)
+    if name != "image_analysis":
+        payload.pop("image", None)
+    emit = payload.get("on_event")
+    if emit is not None:
+        payload["on_event"] = lambda event: emit({**event, "agent": name})
+    return state.model_copy(update={"type": name, "payload": payload})
+
+
+def branch_result(name: str, output) -> dict:
+    output = output if isinstance(output, dict) else output.model_dump(include={"result", "error"})
+    return {name: {"result": output.get("result"), "error": output.get("error")}}
+
+
+def join_branches(state: State, results: dict) -> State:
+    """
+    Combines the branches of a fan-out into one ``"multi"`` state whose
+    result maps each agent to its ``{"result", "error"}``. The request only
+    fails if every branch failed.
+    """
+    errors = [f"{name}: {entry['error']}" for name, entry in results.items() if entry["error"]]
+    return State(
+        type="multi",
+        payload=state.payload,
+        result=results,
+        error="; ".join(errors) if len(errors) == len(results) else None,
+        routing=state.routing,
+        results=results,
+        deadline=state.deadline,
+    )
+
+
+def _branch_node(name: str, node: Callable[[State], Any]) -> Callable[[State], Any]:
+    def run(state: State):
+        if fanout_agents(state) is None:
+            return node(state)
+        # Parallel branches may only write the "results" channel, which merges them
+        try:
+            output = node(branch_state(state, name))
+        except RequestCancelled:
+            raise
+        except Exception as e:
+            # A failing branch is reported in its entry; the other branches still complete
+            logger.warning("%s branch failed: %s", name, e)
+            output = {"result": None, "error": str(e) or type(e).__name__}
+        return {"results": branch_result(name, output)}
+
+    return run
+
+
+def _join(state: State):
+    return join_branches(state, state.results) if state.results else {}
+
+
+def _route(state: State):
+    return fanout_agents(state) or state.type
+
+
 def build_graph():
+    """
+    router -> one agent, or several agents as parallel branches when the
+    router fans out -> join -> END. Total latency of a fan-out is that of its
+    slowest branch.
+    """
     graph = StateGraph(State)
 
-    graph.add_node("router", RouterAgent().run)
-    graph.add_node("icd10", ICD10Agent().run)
-    graph.add_node("soap", SoapGeneratorAgent().run)
-    graph.add_node("image_analysis", ImageAnalyzerAgent().run)
+    for name, node in get_nodes().items():
+        graph.add_node(name, node if name == "router" else _branch_node(name, node))
+    graph.add_node("join", _join)
 
     graph.add_edge(START, "router")
 
-    graph.add_conditional_edges("router", lambda s: s.type, {
+    graph.add_conditional_edges("router", _route, {
         "icd10": "icd10",
         "soap": "soap",
         "image_analysis": "image_analysis"
     })
 
-    graph.add_edge("icd10", END)
-    graph.add_edge("soap", END)
-    graph.add_edge("image_analysis", END)
+    graph.add_edge("icd10", "join")
+    graph.add_edge("soap", "join")
+    graph.add_edge("image_analysis", "join")
+    graph.add_edge("join", END)
 
     return graph.compile()
@@ -1,6 +1,6 @@
 # app/graph/types.py
 
-from typing import TypedDict, Literal, Union, Optional, List
+from typing import Annotated, TypedDict, Literal, Union, Optional, List
 from PIL import Image as PILImage
 from pydantic import BaseModel
 from app.api.schemas import ICD10Code
@@ -16,8 +16,28 @@ class ImageAnalysisPayload(TypedDict):
     image: PILImage.Image
     clinical_note: Optional[str]
 
+AgentName = Literal["icd10", "soap", "image_analysis"]
+
+class RoutingDecision(BaseModel):
+    agent: AgentName
+    confidence: float
+    tier: Literal["rules", "classifier", "llm"]
+    # Every agent to run, as parallel branches, when the request fans out (e.g. a note with an image)
+    agents: Optional[List[AgentName]] = None
+
+def merge_results(left: Optional[dict], right: Optional[dict]) -> Optional[dict]:
+    """Reducer for ``State.results``: parallel branches each add their own entry."""
+    if left is None or right is None:
+        return left if right is None else right
+    return {**left, **right}
+
 class State(BaseModel):
-    type: Optional[Literal["icd10", "soap", "image_analysis"]]
+    type: Optional[Literal["icd10", "soap", "image_analysis", "multi"]]
     payload: dict  
     result: Optional[Union[str, List[ICD10Code], dict]]  # accept str or list or dict
-    error: Optional[str]
\ No newline at end of file
+    error: Optional[str]
+    routing: Optional[RoutingDecision] = None
+    # Agent name -> {"result", "error"} of each branch of a fan-out
+    results: Annotated[Optional[dict], merge_results] = None
+    # Epoch seconds the request must finish by (X-Request-Timeout or INFERENCE_TIMEOUT_SECONDS)
+    deadline: Optional[float] = None
\ No newline at end of file
@@ -1,7 +1,18 @@
+import uuid
 from fastapi import FastAPI
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.formparsers import MultiPartParser
 from app.api.analyze import router as analyze_router
+from app.api.batch import router as batch_router
+from app.api.jobs import router as jobs_router, get_job_runner
+from app.utils.dispatcher import get_dispatcher
+from app.utils.inference_worker import get_inference_pool
+from app.config.config import config
+from app.utils.logger import set_correlation_id, reset_correlation_id
+from app.utils.startup import startup, FAILED
 import os
 from langsmith import Client
 from langsmith.run_helpers import traceable
@@ -15,9 +26,44 @@ LANGCHAIN_ENDPOINT = os.getenv("LANGCHAIN_ENDPOINT")
 LANGCHAIN_API_KEY = os.getenv("LANGCHAIN_API_KEY")
 LANGCHAIN_PROJECT = os.getenv("LANGCHAIN_PROJECT")
 
+# Multipart files above this size are written to a temporary file, not kept in memory
+MultiPartParser.spool_max_size = config.UPLOAD_SPOOL_MAX_BYTES
+
+class CorrelationIdMiddleware:
+    """
+    Every log record of the request carries an id, echoed in ``X-Request-ID``;
+    clients may supply their own. A plain ASGI middleware rather than
+    ``@app.middleware("http")``, which hides client disconnects from the
+    endpoints (see ``wait_for_disconnect``).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        request_id = Headers(scope=scope).get("X-Request-ID") or uuid.uuid4().hex
+
+        async def send_with_id(message):
+            if message["type"] == "http.response.start":
+                MutableHeaders(scope=message)["X-Request-ID"] = request_id
+            await send(message)
+
+        token = set_correlation_id(request_id)
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            reset_correlation_id(token)
+
+
 app = FastAPI()
 langsmith_client = Client()
+app.add_middleware(CorrelationIdMiddleware)
 app.include_router(analyze_router, prefix="/api")
+app.include_router(batch_router, prefix="/api")
+app.include_router(jobs_router, prefix="/api")
 
 # Serve static HTML
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
@@ -25,3 +71,33 @@ app.mount("/static", StaticFiles(directory="app/static"), name="static")
 @app.get("/")
 def serve_ui():
     return FileResponse(os.path.join("app/static", "index.html"))
+
+@app.get("/metrics")
+def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/healthz")
+def healthz():
+    # Liveness: answers while the model is still loading; only a failed startup is fatal
+    if startup.state == FAILED:
+        return JSONResponse(status_code=503, content=startup.status())
+    return {"status": "ok"}
+
+@app.get("/readyz")
+def readyz():
+    return JSONResponse(status_code=200 if startup.ready else 503, content=startup.status())
+
+@app.on_event("startup")
+def start_background_services():
+    # The model loads and warms up in the background; the port opens right away
+    startup.start()
+    # Resumes jobs left in the store by a previous run
+    get_job_runner()
+    startup.listening()
+
+@app.on_event("shutdown")
+def shutdown_inference_pool():
+    get_job_runner().shutdown()
+    get_inference_pool().shutdown()
+    if config.SERVING_PROCESSES:
+        get_dispatcher().shutdown()
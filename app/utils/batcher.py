@@ -0,0 +1,147 @@
+import threading
+import time
+from typing import Any, Callable, List, Optional
+
+from app.utils.deadline import current_cancellation
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+
+class GenerationRequest:
+    """
+    A single prompt waiting in the batcher, resolved by the scheduler thread.
+    It keeps the submitter's cancellation, which the scheduler thread checks.
+    """
+
+    __slots__ = ("prompt", "image", "kwargs", "cancellation", "enqueued_at", "result", "error", "_done")
+
+    def __init__(self, prompt: Any, image: Any = None, **kwargs):
+        self.prompt = prompt
+        self.image = image
+        self.kwargs = kwargs
+        self.cancellation = current_cancellation()
+        self.enqueued_at = time.monotonic()
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self._done = threading.Event()
+
+    def resolve(self, result: Any = None, error: Optional[BaseException] = None):
+        self.result = result
+        self.error = error
+        self._done.set()
+
+    def wait(self) -> Any:
+        self._done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class GenerationBatcher:
+    """
+    Collects generation requests from concurrent callers into micro-batches.
+
+    The first request of a batch opens a collection window of ``window_ms``;
+    everything that arrives before the window closes (up to ``max_batch_size``)
+    is handed to ``run_batch`` in one call. A single scheduler thread owns the
+    model, so callers on other threads never run generation concurrently.
+
+    Args:
+        run_batch (Callable): Takes a list of ``GenerationRequest`` and returns
+            one result per request, in the same order.
+        max_batch_size (int): Maximum number of requests per batch.
+        window_ms (float): How long to wait for more requests after the first one.
+        name (str): Name of the scheduler thread.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[List[GenerationRequest]], List[Any]],
+        max_batch_size: int = 8,
+        window_ms: float = 10.0,
+        name: str = "generation-batcher",
+    ):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.window = max(0.0, window_ms) / 1000.0
+        self._pending: List[GenerationRequest] = []
+        self._cond = threading.Condition()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._requests = 0
+        self._largest_batch = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, prompt: Any, image: Any = None, **kwargs) -> Any:
+        """
+        Enqueue a prompt and block until its batch has been generated.
+        """
+        request = GenerationRequest(prompt, image, **kwargs)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Generation batcher is closed.")
+            self._pending.append(request)
+            self._cond.notify()
+        return request.wait()
+
+    def close(self):
+        """
+        Stops the scheduler thread once the pending requests are done, so
+        the batcher (and the model it holds) can be released.
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def _next_batch(self) -> List[GenerationRequest]:
+        with self._cond:
+            while not self._pending:
+                if self._closed:
+                    return []
+                self._cond.wait()
+            deadline = self._pending[0].enqueued_at + self.window
+            while len(self._pending) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._pending[: self.max_batch_size]
+            del self._pending[: self.max_batch_size]
+            return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                break
+            with self._stats_lock:
+                self._batches += 1
+                self._requests += len(batch)
+                self._largest_batch = max(self._largest_batch, len(batch))
+            try:
+                results = self.run_batch(batch)
+            except BaseException as e:
+                logger.error("Batch of %d failed: %s", len(batch), e)
+                for request in batch:
+                    request.resolve(error=e)
+                continue
+            for request, result in zip(batch, results):
+                if isinstance(result, BaseException):
+                    request.resolve(error=result)
+                else:
+                    request.resolve(result)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "batches": self._batches,
+                "requests": self._requests,
+                "pending": len(self._pending),
+                "avg_batch_size": round(self._requests / self._batches, 2) if self._batches else 0.0,
+                "largest_batch": self._largest_batch,
+                "max_batch_size": self.max_batch_size,
+                "window_ms": self.window * 1000.0,
+            }
@@ -0,0 +1,320 @@
+import json
+import string
+import typing
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple
+
+from pydantic import BaseModel
+from app.api.schemas import ICD10Code, SOAPFacts, SOAPNote, RadiologyReport
+from app.utils.logger import get_logger
+
+if TYPE_CHECKING:
+    import mlx.core as mx
+
+logger = get_logger(__name__)
+
+_LIT, _STR, _CHOICE, _END = range(4)
+
+_HEX = set(string.hexdigits)
+_ESCAPES = set('"\\/bfnrt')
+_WHITESPACE = set(" \t\n\r")
+# Structural characters that may be followed by whitespace
+_OPENERS = set("{[,:")
+
+# Candidates checked per step before falling back to single-character tokens
+DEFAULT_TOP_K = 32
+
+_surfaces = {}
+
+
+class _Node:
+    __slots__ = ("kind", "text", "next", "options")
+
+    def __init__(self, kind, text="", next=None, options=None):
+        self.kind = kind
+        self.text = text
+        self.next = next
+        self.options = options
+
+
+class JSONSchema:
+    """
+    Character-level grammar for JSON matching a pydantic model, or a list of
+    them with ``many=True``.
+
+    Keys are emitted in field order, with optional whitespace between the
+    structural characters (so pretty-printed output, as in the prompt
+    examples, is allowed); string fields accept any JSON string, optional
+    fields may be left out at the end of the object.
+    The grammar has finitely many states (string contents are not tracked), so
+    a state is just ``(node, position)`` and transitions can be memoized.
+
+    Args:
+        model (type[BaseModel]): The schema of the value (or of each list item).
+        many (bool): Whether the top-level value is a list of ``model``.
+    """
+
+    def __init__(self, model: typing.Type[BaseModel], many: bool = False):
+        self.name = f"List[{model.__name__}]" if many else model.__name__
+        self._nodes: List[_Node] = []
+        end = self._add(_Node(_END))
+        self.initial = (self._compile(typing.List[model] if many else model, end), 0)
+
+    def __repr__(self):
+        return f"JSONSchema({self.name})"
+
+    def _add(self, node: _Node) -> int:
+        self._nodes.append(node)
+        return len(self._nodes) - 1
+
+    def _lit(self, text: str, next: int) -> int:
+        return self._add(_Node(_LIT, text=text, next=next))
+
+    def _choice(self, alternatives: Iterable[int], node: Optional[int] = None) -> int:
+        options = {}
+        for alt in alternatives:
+            if self._nodes[alt].kind != _LIT or self._nodes[alt].text[0] in options:
+                raise TypeError(f"Ambiguous alternatives in {self.name}")
+            options[self._nodes[alt].text[0]] = alt
+        if node is None:
+            return self._add(_Node(_CHOICE, options=options))
+        self._nodes[node].options = options
+        return node
+
+    def _compile(self, annotation, next: int) -> int:
+        origin = typing.get_origin(annotation)
+        args = typing.get_args(annotation)
+        if origin is typing.Union and type(None) in args:
+            rest = [a for a in args if a is not type(None)]
+            if len(rest) == 1:
+                return self._compile(rest[0], next)
+        if annotation is str:
+            return self._lit('"', self._add(_Node(_STR, next=next)))
+        if origin is list:
+            return self._compile_array(args[0], next)
+        if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+            return self._compile_object(annotation, next)
+        raise TypeError(f"Unsupported field type {annotation!r} in {self.name}")
+
+    def _compile_object(self, model: typing.Type[BaseModel], next: int) -> int:
+        fields = list(model.model_fields.items())
+        required = [(name, f) for name, f in fields if f.is_required()]
+        optional = [(name, f) for name, f in fields if not f.is_required()]
+        if not required or fields[: len(required)] != required:
+            raise TypeError(f"{model.__name__} needs required fields first")
+
+        close = self._lit("}", next)
+        node = close
+        for name, field in reversed(optional):
+            value = self._compile(field.annotation, node)
+            node = self._choice([self._lit(f",{json.dumps(name)}:", value), close])
+        for i in reversed(range(len(required))):
+            name, field = required[i]
+            value = self._compile(field.annotation, node)
+            node = self._lit(("{" if i == 0 else ",") + f"{json.dumps(name)}:", value)
+        return node
+
+    def _compile_array(self, item, next: int) -> int:
+        close = self._lit("]", next)
+        after_item = self._add(_Node(_CHOICE))
+        first = self._compile(item, after_item)
+        self._choice([self._lit(",", first), close], node=after_item)
+        return self._lit("[", self._choice([first, close]))
+
+    def _settle(self, node: int, pos: int) -> Tuple[int, int]:
+        n = self._nodes[node]
+        if pos == len(n.text):
+            return (n.next, 0)
+        return (node, pos)
+
+    def advance(self, state: Tuple[int, int], ch: str) -> Optional[Tuple[int, int]]:
+        """
+        Returns the state after ``ch``, or None if ``ch`` is not allowed.
+        """
+        node, pos = state
+        n = self._nodes[node]
+        if n.kind == _LIT:
+            if n.text[pos] == ch:
+                return self._settle(node, pos + 1)
+            # Whitespace before a literal, after "{", "[", "," or ":", or before ":"
+            if ch in _WHITESPACE and (pos == 0 or n.text[pos - 1] in _OPENERS or n.text[pos] == ":"):
+                return state
+            return None
+        if n.kind == _CHOICE:
+            if ch in _WHITESPACE:
+                return state
+            target = n.options.get(ch)
+            return self._settle(target, 1) if target is not None else None
+        if n.kind == _STR:
+            if pos == 0:
+                if ch == '"':
+                    return (n.next, 0)
+                if ch == "\\":
+                    return (node, 1)
+                return state if ch >= " " else None
+            if pos == 1:
+                if ch == "u":
+                    return (node, 2)
+                return (node, 0) if ch in _ESCAPES else None
+            # pos 2-5: the four hex digits of a \u escape
+            if ch not in _HEX:
+                return None
+            return (node, pos + 1) if pos < 5 else (node, 0)
+        return None
+
+    def feed(self, state: Tuple[int, int], text: str) -> Optional[Tuple[int, int]]:
+        for ch in text:
+            state = self.advance(state, ch)
+            if state is None:
+                return None
+        return state
+
+    def is_complete(self, state: Tuple[int, int]) -> bool:
+        return self._nodes[state[0]].kind == _END
+
+    def next_chars(self, state: Tuple[int, int]) -> List[str]:
+        """
+        Characters that always keep the output valid, used when none of the
+        model's top candidates fit. Inside a string that is a space rather
+        than the closing quote, so a string only ends where the model
+        chose to end it.
+        """
+        node, pos = state
+        n = self._nodes[node]
+        if n.kind == _LIT:
+            return [n.text[pos]]
+        if n.kind == _CHOICE:
+            return list(n.options)
+        if n.kind == _STR:
+            if pos == 0:
+                return [" "]
+            return ['"'] if pos == 1 else ["0"]
+        return []
+
+
+def token_surfaces(tokenizer) -> List[Optional[str]]:
+    """
+    The text each token id contributes when decoded, or None for special
+    tokens and partial UTF-8 bytes. Computed once per tokenizer.
+    """
+    key = id(tokenizer)
+    if key in _surfaces:
+        return _surfaces[key]
+
+    vocab = tokenizer.get_vocab()
+    special = set(getattr(tokenizer, "all_special_ids", []))
+    special.update(getattr(tokenizer, "added_tokens_decoder", {}))
+    sentencepiece = any(token.startswith("▁") for token in vocab)
+
+    surfaces: List[Optional[str]] = [None] * (max(vocab.values()) + 1)
+    for token, token_id in vocab.items():
+        if token_id in special:
+            continue
+        if not sentencepiece:
+            surfaces[token_id] = tokenizer.decode([token_id])
+        elif token.startswith("<0x") and len(token) == 6:
+            value = int(token[3:5], 16)
+            surfaces[token_id] = chr(value) if value < 0x80 else None
+        else:
+            surfaces[token_id] = token.replace("▁", " ")
+
+    _surfaces[key] = surfaces
+    return surfaces
+
+
+class JSONLogitsProcessor:
+    """
+    ``mlx_lm`` logits processor that only lets through tokens keeping the
+    output a valid prefix of ``schema``, and forces EOS once the top-level
+    value has closed.
+
+    Only the model's ``top_k`` best tokens are checked each step, best first;
+    if none fit, the single-character tokens the grammar expects next are
+    allowed instead, so decoding always makes progress.
+
+    Args:
+        schema (JSONSchema): The grammar to enforce.
+        tokenizer: The model's tokenizer (used for token surfaces).
+        eos_token_ids (Iterable[int]): Tokens that end generation.
+        top_k (int): Number of candidates checked per step.
+    """
+
+    def __init__(self, schema: JSONSchema, tokenizer, eos_token_ids: Iterable[int], top_k: int = DEFAULT_TOP_K):
+        self.schema = schema
+        self.surfaces = token_surfaces(tokenizer)
+        self.eos_token_ids = sorted(eos_token_ids)
+        self.top_k = top_k
+        self._char_tokens = {}
+        for token_id, surface in enumerate(self.surfaces):
+            if surface is not None and len(surface) == 1:
+                self._char_tokens.setdefault(surface, token_id)
+        self._transitions: Dict[tuple, Optional[tuple]] = {}
+        self._start = None
+        self._ids: List[int] = []
+        self._states = [schema.initial]
+
+    def _step(self, state, token: int):
+        key = (state, token)
+        if key not in self._transitions:
+            surface = self.surfaces[token] if token < len(self.surfaces) else None
+            self._transitions[key] = self.schema.feed(state, surface) if surface else None
+        return self._transitions[key]
+
+    def _sync(self, tokens: "mx.array"):
+        """
+        Advances the grammar over the tokens generated since the first call.
+        Tokens are compared against the ones already seen, so a history that
+        was rewound (speculative decoding rejecting draft tokens) is handled.
+        """
+        if self._start is None:
+            self._start = tokens.size
+            return self._states[-1]
+
+        generated = tokens[self._start:].tolist() if tokens.size > self._start else []
+        common = 0
+        limit = min(len(generated), len(self._ids))
+        while common < limit and generated[common] == self._ids[common]:
+            common += 1
+        del self._ids[common:]
+        del self._states[common + 1:]
+
+        for token in generated[common:]:
+            state = self._states[-1]
+            self._ids.append(token)
+            self._states.append(self._step(state, token) if state is not None else None)
+        return self._states[-1]
+
+    def _allowed(self, state, logits: "mx.array") -> List[int]:
+        import mlx.core as mx
+
+        row = logits.reshape(-1)
+        k = min(self.top_k, row.size)
+        candidates = mx.argpartition(-row, kth=k - 1)[:k]
+        ordered = candidates[mx.argsort(-row[candidates])].tolist()
+        allowed = [token for token in ordered if self._step(state, token) is not None]
+        if not allowed:
+            allowed = [self._char_tokens[ch] for ch in self.schema.next_chars(state) if ch in self._char_tokens]
+        return allowed
+
+    def __call__(self, tokens: "mx.array", logits: "mx.array") -> "mx.array":
+        import mlx.core as mx
+
+        state = self._sync(tokens)
+        if state is None:
+            return logits
+        if self.schema.is_complete(state):
+            allowed = self.eos_token_ids
+        else:
+            allowed = self._allowed(state, logits)
+        if not allowed:
+            logger.warning("No token can continue %s; leaving logits unconstrained", self.schema.name)
+            return logits
+
+        keep = mx.zeros((logits.shape[-1],), dtype=mx.bool_)
+        keep[mx.array(allowed)] = True
+        return mx.where(keep, logits, float("-inf"))
+
+
+ICD10_SCHEMA = JSONSchema(ICD10Code, many=True)
+SOAP_SCHEMA = JSONSchema(SOAPNote)
+SOAP_FACTS_SCHEMA = JSONSchema(SOAPFacts)
+RADIOLOGY_SCHEMA = JSONSchema(RadiologyReport)
@@ -0,0 +1,259 @@
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+from app.config.config import config
+from app.graph.types import State
+from app.utils.logger import get_logger
+from app.utils.metrics import GENERATIONS_SHORTENED, WORK_CANCELLED, current_node
+
+logger = get_logger(__name__)
+
+# Request header carrying the client's timeout in seconds
+DEADLINE_HEADER = "X-Request-Timeout"
+
+DISCONNECTED = "disconnected"
+DEADLINE = "deadline"
+SHED = "shed"
+
+# Weight of the newest sample in the latency and decode-rate estimates
+_SMOOTHING = 0.2
+# Share of the time left that fit_max_tokens budgets for decoding
+_DECODE_SHARE = 0.9
+
+
+class RequestCancelled(Exception):
+    """
+    Raised where work stops for a cancelled request: ``reason`` is
+    ``disconnected``, ``deadline`` or ``shed``.
+    """
+
+    def __init__(self, reason: str, message: Optional[str] = None):
+        super().__init__(message or f"Request cancelled ({reason}).")
+        self.reason = reason
+
+    def __reduce__(self):
+        # Crosses the process boundary from the serving workers
+        return type(self), (self.reason, str(self))
+
+
+class Cancellation:
+    """
+    The deadline and cancel flag of one request, bound to the context it runs
+    in (see ``cancellation_scope``) and checked by the graph nodes and the
+    decode loops.
+
+    Args:
+        deadline (Optional[float]): Epoch seconds the request must finish by,
+            or None for no deadline.
+    """
+
+    def __init__(self, deadline: Optional[float] = None):
+        self.deadline = deadline
+        self.reason: Optional[str] = None
+        self._callbacks: List[Callable[[str], None]] = []
+        self._extend_callbacks: List[Callable[[Optional[float]], None]] = []
+        self._lock = threading.Lock()
+
+    def cancel(self, reason: str = DISCONNECTED):
+        """Cancels the request; only the first reason is kept."""
+        with self._lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback(reason)
+            except Exception as e:
+                logger.warning("Cancellation callback failed: %s", e)
+
+    def on_cancel(self, callback: Callable[[str], None]):
+        """Calls ``callback(reason)`` when the request is cancelled (at once if it already is)."""
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(callback)
+                return
+        callback(self.reason)
+
+    def extend(self, deadline: Optional[float]):
+        """
+        Moves the deadline to ``deadline`` (None for none) if that is later,
+        e.g. when a request with more time left joins the work.
+        """
+        with self._lock:
+            if self.reason is not None or self.deadline is None:
+                return
+            if deadline is not None and deadline <= self.deadline:
+                return
+            self.deadline = deadline
+            callbacks = list(self._extend_callbacks)
+        for callback in callbacks:
+            try:
+                callback(deadline)
+            except Exception as e:
+                logger.warning("Deadline extension callback failed: %s", e)
+
+    def on_extend(self, callback: Callable[[Optional[float]], None]):
+        """Calls ``callback(deadline)`` whenever ``extend`` moves the deadline."""
+        with self._lock:
+            self._extend_callbacks.append(callback)
+
+    def remaining(self) -> Optional[float]:
+        """Seconds until the deadline, or None without one."""
+        return None if self.deadline is None else self.deadline - time.time()
+
+    @property
+    def cancelled(self) -> bool:
+        if self.reason is None and self.deadline is not None and time.time() >= self.deadline:
+            self.cancel(DEADLINE)
+        return self.reason is not None
+
+    def check(self):
+        """
+        Raises:
+            RequestCancelled: If the request was cancelled or its deadline passed.
+        """
+        if self.cancelled:
+            raise RequestCancelled(self.reason)
+
+
+_current: contextvars.ContextVar = contextvars.ContextVar("cancellation", default=None)
+
+
+def current_cancellation() -> Optional[Cancellation]:
+    return _current.get()
+
+
+@contextmanager
+def cancellation_scope(cancellation: Optional[Cancellation]):
+    """Binds ``cancellation`` (None for none) to the current context for the block."""
+    token = _current.set(cancellation)
+    try:
+        yield cancellation
+    finally:
+        _current.reset(token)
+
+
+def check_cancelled():
+    """
+    Raises ``RequestCancelled`` if the request running in this context was
+    cancelled. Cheap enough to call once per decoded token.
+    """
+    cancellation = _current.get()
+    if cancellation is not None:
+        cancellation.check()
+
+
+def state_cancellation(state: State) -> Cancellation:
+    """
+    The cancellation bound to this context, or a new one for ``state.deadline``
+    (e.g. for work started from a batch item or a serving worker).
+    """
+    return _current.get() or Cancellation(getattr(state, "deadline", None))
+
+
+@contextmanager
+def request_scope(state: State):
+    """
+    Binds the cancellation of the request ``state`` belongs to (see
+    ``state_cancellation``) for the block, failing at once if the request was
+    cancelled while it waited in a queue.
+    """
+    cancellation = state_cancellation(state)
+    if cancellation.cancelled:
+        count_cancelled("queue", cancellation.reason)
+        raise RequestCancelled(cancellation.reason)
+    with cancellation_scope(cancellation):
+        yield cancellation
+
+
+def request_deadline(timeout: Optional[str]) -> float:
+    """
+    Deadline (epoch seconds) of a request whose ``X-Request-Timeout`` header
+    is ``timeout``: that many seconds from now, capped at
+    ``INFERENCE_TIMEOUT_SECONDS``. A missing or invalid header gets the cap.
+    """
+    seconds = config.INFERENCE_TIMEOUT_SECONDS
+    try:
+        requested = float(timeout) if timeout else 0.0
+    except ValueError:
+        logger.warning("Ignoring invalid %s header: %r", DEADLINE_HEADER, timeout)
+        requested = 0.0
+    if requested > 0:
+        seconds = min(seconds, requested)
+    return time.time() + seconds
+
+
+def count_cancelled(node: str, reason: str):
+    WORK_CANCELLED.labels(node, reason).inc()
+
+
+class _Estimates:
+    """Exponentially weighted moving averages, one per key."""
+
+    def __init__(self):
+        self._values: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, key: str, value: float):
+        with self._lock:
+            previous = self._values.get(key)
+            self._values[key] = value if previous is None else previous + _SMOOTHING * (value - previous)
+
+    def get(self, key: str) -> Optional[float]:
+        return self._values.get(key)
+
+
+# Node name -> seconds a run takes; agent -> decoded tokens per second
+node_latency = _Estimates()
+decode_rate = _Estimates()
+
+
+def deadline_node(name: str, fn: Callable[[State], Any]) -> Callable[[State], Any]:
+    """
+    Wraps a graph node so it does not start for a cancelled request, and is
+    shed when the time left is under its typical latency (an average of its
+    past runs) times ``DEADLINE_SHED_FACTOR``: a run that cannot finish in
+    time would only take the model from requests that can.
+    """
+
+    def run(state: State):
+        cancellation = _current.get()
+        if cancellation is not None:
+            cancellation.check()
+            remaining = cancellation.remaining()
+            estimate = node_latency.get(name)
+            if remaining is not None and estimate is not None and remaining < estimate * config.DEADLINE_SHED_FACTOR:
+                cancellation.cancel(SHED)
+                raise RequestCancelled(SHED, f"{name} takes about {estimate:.1f}s and only {remaining:.1f}s are left.")
+        tic = time.perf_counter()
+        output = fn(state)
+        node_latency.observe(name, time.perf_counter() - tic)
+        return output
+
+    return run
+
+
+def fit_max_tokens(agent: Optional[str], max_tokens: int) -> int:
+    """
+    ``max_tokens`` cut to what ``agent`` can decode (at its recent rate)
+    before the deadline of the request running in this context. The output
+    may then be truncated, but arrives in time.
+    """
+    cancellation = _current.get()
+    if not config.DEADLINE_FIT_MAX_TOKENS or cancellation is None or agent is None:
+        return max_tokens
+    remaining, rate = cancellation.remaining(), decode_rate.get(agent)
+    if remaining is None or not rate:
+        return max_tokens
+    budget = max(1, int(remaining * _DECODE_SHARE * rate))
+    if budget >= max_tokens:
+        return max_tokens
+    GENERATIONS_SHORTENED.labels(current_node()).inc()
+    logger.info(
+        "Cutting %s max_tokens from %d to %d to meet the deadline (%.1fs left)", agent, max_tokens, budget, remaining
+    )
+    return budget
@@ -0,0 +1,271 @@
+import math
+import struct
+from collections.abc import Sequence
+from typing import BinaryIO, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from app.config.config import config
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+DICOM_MAGIC = b"DICM"
+PIXEL_DATA_TAG = b"\xe0\x7f\x10\x00"
+# Explicit VR types whose element header has two reserved bytes and a 4-byte length
+LONG_VRS = {b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"UC", b"UN", b"UR", b"UT"}
+
+# (window center, window width) used when the file has no VOI window, by
+# (modality, body part); other modalities are windowed from their histogram
+DEFAULT_WINDOWS = {
+    ("CT", "HEAD"): (40.0, 80.0),
+    ("CT", "BRAIN"): (40.0, 80.0),
+    ("CT", "CHEST"): (-600.0, 1500.0),
+    ("CT", "LUNG"): (-600.0, 1500.0),
+    ("CT", None): (40.0, 400.0),
+}
+
+
+def _pydicom():
+    try:
+        import pydicom
+    except ImportError as e:
+        raise ValueError("DICOM uploads need the pydicom package (pip install pydicom).") from e
+    return pydicom
+
+
+def is_dicom(fp: BinaryIO) -> bool:
+    """
+    True if the file has the DICOM Part 10 preamble; the position is kept.
+    """
+    position = fp.tell()
+    try:
+        fp.seek(position + 128)
+        return fp.read(4) == DICOM_MAGIC
+    finally:
+        fp.seek(position)
+
+
+def read_header(fp: BinaryIO):
+    """
+    Reads the dataset up to the pixel data and checks the image dimensions.
+    The file is left positioned at the pixel data element.
+
+    Raises:
+        ValueError: If the file cannot be parsed, has no image, or is too large.
+    """
+    pydicom = _pydicom()
+    try:
+        ds = pydicom.dcmread(fp, stop_before_pixels=True)
+    except Exception as e:
+        raise ValueError("Invalid DICOM file.") from e
+
+    if "Rows" not in ds or "Columns" not in ds:
+        raise ValueError("DICOM file has no image.")
+    if ds.Rows * ds.Columns > config.IMAGE_MAX_PIXELS:
+        raise ValueError(
+            f"DICOM frames are {ds.Columns}x{ds.Rows}; at most {config.IMAGE_MAX_PIXELS} pixels are accepted."
+        )
+    return ds
+
+
+def technique_metadata(ds) -> dict:
+    """
+    Acquisition details for the radiology prompt. Only technique fields are
+    taken; nothing that identifies the patient.
+    """
+    fields = {
+        "modality": ds.get("Modality"),
+        "body_part": ds.get("BodyPartExamined"),
+        "view": ds.get("ViewPosition"),
+        "laterality": ds.get("ImageLaterality") or ds.get("Laterality"),
+        "study_description": ds.get("StudyDescription"),
+        "series_description": ds.get("SeriesDescription"),
+        "contrast": ds.get("ContrastBolusAgent"),
+    }
+    metadata = {key: str(value).strip() for key, value in fields.items() if value not in (None, "")}
+    frames = int(ds.get("NumberOfFrames") or 1)
+    if frames > 1:
+        metadata["frames"] = frames
+    return metadata
+
+
+def _frame_shape(ds) -> Tuple[int, ...]:
+    samples = int(ds.get("SamplesPerPixel", 1))
+    if samples == 1:
+        return int(ds.Rows), int(ds.Columns)
+    if int(ds.get("PlanarConfiguration", 0)) == 1:
+        return samples, int(ds.Rows), int(ds.Columns)
+    return int(ds.Rows), int(ds.Columns), samples
+
+
+def memmap_frames(fp: BinaryIO, ds) -> Optional[np.ndarray]:
+    """
+    Native (uncompressed) pixel data as a read-only memory map over the file,
+    shaped ``(frames, *frame_shape)``. Only the frames that are indexed are
+    paged in. None when the data is compressed, big endian, not byte
+    aligned, or the file has no descriptor to map.
+    """
+    syntax = ds.file_meta.get("TransferSyntaxUID")
+    if syntax is None or syntax.is_compressed or not syntax.is_little_endian or int(ds.BitsAllocated) not in (8, 16, 32):
+        return None
+
+    start = fp.tell()
+    header = fp.read(12)
+    fp.seek(start)
+    if header[:4] != PIXEL_DATA_TAG:
+        return None
+    if syntax.is_implicit_VR:
+        length, offset = struct.unpack("<I", header[4:8])[0], start + 8
+    elif header[4:6] in LONG_VRS:
+        length, offset = struct.unpack("<I", header[8:12])[0], start + 12
+    else:
+        length, offset = struct.unpack("<H", header[6:8])[0], start + 8
+    if length == 0xFFFFFFFF:
+        return None
+
+    signed = int(ds.get("PixelRepresentation", 0)) == 1
+    dtype = np.dtype(f"<{'i' if signed else 'u'}{int(ds.BitsAllocated) // 8}")
+    shape = (int(ds.get("NumberOfFrames") or 1),) + _frame_shape(ds)
+    if length < dtype.itemsize * math.prod(shape):
+        return None
+    try:
+        fp.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+    return np.memmap(fp, dtype=dtype, mode="r", offset=offset, shape=shape)
+
+
+def choose_frames(count: int, max_tiles: int) -> List[int]:
+    """
+    The frames shown to the model: the middle one, or up to ``max_tiles``
+    evenly spaced over the central 80% of the series for a montage.
+    """
+    if count == 1 or max_tiles <= 1:
+        return [count // 2]
+    positions = np.linspace(0.1 * (count - 1), 0.9 * (count - 1), min(max_tiles, count))
+    return sorted(set(np.round(positions).astype(int).tolist()))
+
+
+def _first(value) -> Optional[float]:
+    if value is None or value == "":
+        return None
+    if isinstance(value, Sequence) and not isinstance(value, str):
+        value = value[0]
+    return float(value)
+
+
+def window_frame(frame: np.ndarray, ds) -> np.ndarray:
+    """
+    Applies the modality rescale and a window/level to one frame and returns
+    it as 8-bit. The window comes from the file when present, otherwise from
+    ``DEFAULT_WINDOWS`` or the frame's 1st-99th percentile.
+    """
+    photometric = str(ds.get("PhotometricInterpretation", "MONOCHROME2")).upper()
+    if int(ds.get("SamplesPerPixel", 1)) > 1:
+        if int(ds.get("PlanarConfiguration", 0)) == 1:
+            frame = np.moveaxis(frame, 0, -1)
+        if photometric.startswith("YBR"):
+            from pydicom.pixels import convert_color_space
+
+            frame = convert_color_space(np.asarray(frame), photometric, "RGB")
+        if int(ds.BitsAllocated) > 8:
+            frame = frame >> (int(ds.get("BitsStored", ds.BitsAllocated)) - 8)
+        return np.asarray(frame, dtype=np.uint8)
+
+    bits_stored = int(ds.get("BitsStored", ds.BitsAllocated))
+    if frame.dtype.kind == "u" and bits_stored < frame.dtype.itemsize * 8:
+        # Memory-mapped data may carry overlay bits above BitsStored
+        frame = frame & np.array((1 << bits_stored) - 1, dtype=frame.dtype)
+    values = np.asarray(frame, dtype=np.float32)
+    slope, intercept = _first(ds.get("RescaleSlope")), _first(ds.get("RescaleIntercept"))
+    if slope is not None and slope != 1.0:
+        values *= slope
+    if intercept:
+        values += intercept
+
+    center, width = _first(ds.get("WindowCenter")), _first(ds.get("WindowWidth"))
+    if center is None or not width:
+        modality = str(ds.get("Modality", "")).upper()
+        body_part = str(ds.get("BodyPartExamined", "")).upper() or None
+        center, width = DEFAULT_WINDOWS.get((modality, body_part)) or DEFAULT_WINDOWS.get((modality, None)) or (None, None)
+    if center is None:
+        # Percentiles of a strided sample are enough to place the window
+        step = max(1, int(math.sqrt(values.size / 65536)))
+        low, high = np.percentile(values[::step, ::step], (1, 99))
+        center, width = (low + high) / 2.0, max(high - low, 1.0)
+
+    # DICOM linear VOI function (PS3.3 C.11.2.1.2)
+    low = center - 0.5 - (width - 1.0) / 2.0
+    values -= low
+    values *= 1.0 / max(width - 1.0, 1.0)
+    np.clip(values, 0.0, 1.0, out=values)
+    if photometric == "MONOCHROME1":
+        values = 1.0 - values
+    return (values * 255.0 + 0.5).astype(np.uint8)
+
+
+def montage(tiles: List[np.ndarray], target: int) -> Image.Image:
+    """
+    Tiles frames on a square-ish grid, each scaled to fill a cell so the
+    whole montage is about ``target`` pixels wide.
+    """
+    columns = math.ceil(math.sqrt(len(tiles)))
+    rows = math.ceil(len(tiles) / columns)
+    cell = max(1, (target or max(tiles[0].shape[:2])) // columns)
+    mode = "RGB" if tiles[0].ndim == 3 else "L"
+    sheet = Image.new(mode, (cell * columns, cell * rows))
+    for i, tile in enumerate(tiles):
+        image = Image.fromarray(tile)
+        scale = cell / max(image.size)
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.Resampling.BILINEAR, reducing_gap=3.0 if scale < 1 else None)
+        x = (i % columns) * cell + (cell - image.width) // 2
+        y = (i // columns) * cell + (cell - image.height) // 2
+        sheet.paste(image, (x, y))
+    return sheet
+
+
+def load_dicom(fp: BinaryIO, target: int) -> Tuple[Image.Image, dict]:
+    """
+    Decodes a single or multi-frame DICOM file into one 8-bit image for the
+    model: the only frame, or a montage of ``DICOM_MONTAGE_FRAMES`` frames
+    (the middle frame if that is 1). Native pixel data is memory-mapped so
+    only the chosen frames are read; compressed data is decoded frame by
+    frame.
+
+    Returns:
+        Tuple[Image.Image, dict]: The image ("L" or "RGB") and its ``technique_metadata``.
+    """
+    ds = read_header(fp)
+    frames = int(ds.get("NumberOfFrames") or 1)
+    indices = choose_frames(frames, config.DICOM_MONTAGE_FRAMES)
+
+    volume = memmap_frames(fp, ds)
+    if volume is not None:
+        raw = [volume[i] for i in indices]
+    else:
+        from pydicom.pixels import pixel_array
+
+        raw = []
+        for i in indices:
+            fp.seek(0)
+            try:
+                raw.append(pixel_array(fp, index=i if frames > 1 else None))
+            except Exception as e:
+                raise ValueError(f"Cannot decode DICOM pixel data: {e}") from e
+
+    tiles = [window_frame(frame, ds) for frame in raw]
+    image = Image.fromarray(tiles[0]) if len(tiles) == 1 else montage(tiles, target)
+    metadata = technique_metadata(ds)
+    if len(tiles) > 1:
+        metadata["frames_shown"] = [i + 1 for i in indices]
+    logger.info(
+        "Decoded DICOM %s with %d frame(s), %d shown (%s)",
+        metadata.get("modality", "?"),
+        frames,
+        len(tiles),
+        "memory-mapped" if volume is not None else "decoded",
+    )
+    return image, metadata
@@ -0,0 +1,394 @@
+import concurrent.futures
+import importlib
+import itertools
+import multiprocessing
+import pickle
+import threading
+import time
+from typing import Any, Callable, Dict, Optional
+
+from app.config.config import config
+from app.utils.deadline import Cancellation, cancellation_scope, current_cancellation
+from app.utils.inference_worker import WorkerUnavailableError
+from app.utils.logger import get_logger, get_correlation_id, set_correlation_id
+from app.utils.metrics import WORKER_IN_FLIGHT, WORKER_RESTARTS
+
+logger = get_logger(__name__)
+
+MAX_RESTART_BACKOFF_SECONDS = 30.0
+
+
+class WorkerCrashedError(RuntimeError):
+    """Raised for calls that were running on a worker process when it died."""
+
+
+def _strip_callables(state):
+    # Callbacks (e.g. payload["on_event"]) cannot cross the process boundary
+    payload = state.get("payload") if isinstance(state, dict) else getattr(state, "payload", None)
+    if not isinstance(payload, dict) or not any(callable(value) for value in payload.values()):
+        return state
+    payload = {key: value for key, value in payload.items() if not callable(value)}
+    if isinstance(state, dict):
+        return {**state, "payload": payload}
+    return state.model_copy(update={"payload": payload})
+
+
+def _picklable_error(e: BaseException) -> BaseException:
+    try:
+        pickle.loads(pickle.dumps(e))
+        return e
+    except Exception:
+        return RuntimeError(f"{type(e).__name__}: {e}")
+
+
+def _resolve(target: str) -> Callable:
+    module_name, _, attr = target.partition(":")
+    return getattr(importlib.import_module(module_name), attr)
+
+
+def _worker_main(index: int, conn, overrides: dict):
+    """
+    Entry point of an inference worker process: loads and warms the models,
+    reports ready, then runs calls from the dispatcher on a thread pool,
+    sending a heartbeat every ``SERVING_HEARTBEAT_SECONDS``. Each call runs
+    under a ``Cancellation`` for its deadline, which a ``("cancel", call_id,
+    reason)`` message from the dispatcher cancels and an ``("extend",
+    call_id, deadline)`` message extends.
+    """
+    # This process serves in-process; it must not start workers of its own
+    config.SERVING_PROCESSES = 0
+    for name, value in overrides.items():
+        setattr(config, name, value)
+
+    from app.utils.startup import startup, READY
+
+    send_lock = threading.Lock()
+
+    def send(message):
+        with send_lock:
+            conn.send(message)
+
+    def heartbeat():
+        while True:
+            try:
+                send(("heartbeat",))
+            except (OSError, EOFError, BrokenPipeError):
+                return
+            time.sleep(config.SERVING_HEARTBEAT_SECONDS)
+
+    threading.Thread(target=heartbeat, name="heartbeat", daemon=True).start()
+
+    startup.run()
+    if startup.state != READY:
+        send(("failed", startup.error))
+        return
+    send(("ready", startup.status()))
+
+    cancellations: Dict[int, Cancellation] = {}
+
+    def handle(call_id: int, target: str, args: tuple, correlation_id: Optional[str], stream: bool, cancellation: Cancellation):
+        set_correlation_id(correlation_id)
+        try:
+            kwargs = {}
+            if stream:
+                def emit(event):
+                    send(("event", call_id, event))
+
+                args[0].payload["on_event"] = emit
+                kwargs["emit"] = emit
+            with cancellation_scope(cancellation):
+                result = _strip_callables(_resolve(target)(*args, **kwargs))
+            send(("result", call_id, result))
+        except BaseException as e:
+            send(("error", call_id, _picklable_error(e)))
+        finally:
+            cancellations.pop(call_id, None)
+
+    with concurrent.futures.ThreadPoolExecutor(config.SERVING_WORKER_THREADS, thread_name_prefix=f"worker{index}") as pool:
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            if message is None:
+                break
+            if message[0] in ("cancel", "extend"):
+                cancellation = cancellations.get(message[1])
+                if cancellation is not None:
+                    getattr(cancellation, message[0])(message[2])
+                continue
+            # Registered here, so a cancel sent right after the call finds it
+            call_id, target, args, correlation_id, stream, deadline = message
+            cancellations[call_id] = Cancellation(deadline)
+            pool.submit(handle, call_id, target, args, correlation_id, stream, cancellations[call_id])
+
+
+class _Call:
+    __slots__ = ("future", "emit")
+
+    def __init__(self, emit: Optional[Callable[[dict], None]]):
+        self.future: concurrent.futures.Future = concurrent.futures.Future()
+        self.emit = emit
+
+
+class _Worker:
+    def __init__(self, index: int):
+        self.index = index
+        self.process: Optional[multiprocessing.Process] = None
+        self.conn = None
+        self.send_lock = threading.Lock()
+        self.calls: Dict[int, _Call] = {}
+        self.ready = False
+        self.last_heartbeat = 0.0
+        self.restarts = 0
+        self.backoff = 0.0
+        self.restart_at = 0.0
+        self.error: Optional[str] = None
+
+    @property
+    def healthy(self) -> bool:
+        return (
+            self.ready
+            and self.process is not None
+            and self.process.is_alive()
+            and time.monotonic() - self.last_heartbeat < config.SERVING_UNHEALTHY_AFTER_SECONDS
+        )
+
+
+class ProcessDispatcher:
+    """
+    Fronts ``num_workers`` inference worker processes. Each one loads its own
+    copy of the models, so model memory grows with every worker, and runs
+    calls (``"module:function"`` targets, e.g. ``run_graph``) on its own
+    thread pool, so its batcher still sees concurrent requests.
+
+    Calls go to the healthy worker with the fewest calls in flight; a worker
+    is healthy once it has warmed up and while its heartbeat is fresh. A
+    worker that exits fails its in-flight calls with ``WorkerCrashedError``
+    and is restarted with exponential backoff.
+
+    Args:
+        num_workers (int): Number of worker processes.
+    """
+
+    def __init__(self, num_workers: int):
+        self.num_workers = max(1, num_workers)
+        self._context = multiprocessing.get_context("spawn")
+        self._workers = [_Worker(i) for i in range(self.num_workers)]
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._running = False
+        self._overrides: dict = {}
+
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+        # Workers load the same models as this process, whatever its environment
+        self._overrides = {
+            "MODEL_BACKEND": config.MODEL_BACKEND,
+            "MODEL_ID": config.MODEL_ID,
+            "AGENT_MODELS": {agent: config.model_for(agent) for agent in config.MODEL_AGENTS},
+        }
+        for worker in self._workers:
+            self._spawn(worker)
+        threading.Thread(target=self._monitor, name="dispatcher-monitor", daemon=True).start()
+        logger.info("Started %d inference worker process(es)", self.num_workers)
+
+    def _spawn(self, worker: _Worker):
+        parent, child = self._context.Pipe()
+        process = self._context.Process(
+            target=_worker_main, args=(worker.index, child, self._overrides), name=f"inference-worker-{worker.index}", daemon=True
+        )
+        process.start()
+        child.close()
+        worker.process, worker.conn = process, parent
+        worker.ready = False
+        worker.last_heartbeat = time.monotonic()
+        threading.Thread(target=self._reader, args=(worker, parent), name=f"dispatcher-reader-{worker.index}", daemon=True).start()
+
+    def _reader(self, worker: _Worker, conn):
+        while True:
+            try:
+                message = conn.recv()
+            except (EOFError, OSError):
+                break
+            kind = message[0]
+            worker.last_heartbeat = time.monotonic()
+            if kind == "ready":
+                with self._lock:
+                    worker.ready, worker.error = True, None
+                    worker.backoff = 0.0
+                    self._ready.notify_all()
+                logger.info("Inference worker %d (pid %s) is ready", worker.index, worker.process.pid)
+            elif kind == "failed":
+                worker.error = message[1]
+                logger.error("Inference worker %d failed to start: %s", worker.index, message[1])
+            elif kind == "event":
+                call = worker.calls.get(message[1])
+                if call is not None and call.emit is not None:
+                    call.emit(message[2])
+            elif kind in ("result", "error"):
+                with self._lock:
+                    call = worker.calls.pop(message[1], None)
+                    WORKER_IN_FLIGHT.labels(str(worker.index)).set(len(worker.calls))
+                if call is None:
+                    continue
+                if kind == "result":
+                    call.future.set_result(message[2])
+                else:
+                    call.future.set_exception(message[2])
+        self._on_exit(worker, conn)
+
+    def _on_exit(self, worker: _Worker, conn):
+        with self._lock:
+            if worker.conn is not conn:
+                return
+            worker.ready = False
+            calls, worker.calls = worker.calls, {}
+            WORKER_IN_FLIGHT.labels(str(worker.index)).set(0)
+            if self._running:
+                worker.backoff = min(MAX_RESTART_BACKOFF_SECONDS, max(config.SERVING_RESTART_BACKOFF_SECONDS, 2 * worker.backoff))
+                worker.restart_at = time.monotonic() + worker.backoff
+        for call in calls.values():
+            call.future.set_exception(WorkerCrashedError(f"Inference worker {worker.index} exited."))
+        if self._running:
+            worker.process.join(1.0)
+            exitcode = worker.process.exitcode
+            logger.error(
+                "Inference worker %d exited (code %s) with %d call(s) in flight; restarting in %.1fs",
+                worker.index,
+                exitcode,
+                len(calls),
+                worker.backoff,
+            )
+
+    def _monitor(self):
+        while self._running:
+            time.sleep(0.5)
+            for worker in self._workers:
+                if not self._running:
+                    return
+                if worker.process is None or worker.process.is_alive():
+                    continue
+                with self._lock:
+                    due = not worker.ready and not worker.calls and time.monotonic() >= worker.restart_at
+                if due and worker.restart_at:
+                    worker.restarts += 1
+                    worker.restart_at = 0.0
+                    WORKER_RESTARTS.labels(str(worker.index)).inc()
+                    self._spawn(worker)
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until at least one worker is ready."""
+        with self._ready:
+            return self._ready.wait_for(lambda: any(w.ready for w in self._workers), timeout)
+
+    def ready_workers(self) -> int:
+        return sum(1 for worker in self._workers if worker.healthy)
+
+    def _pick(self) -> _Worker:
+        healthy = [worker for worker in self._workers if worker.healthy]
+        if not healthy:
+            raise WorkerUnavailableError("No healthy inference worker process.")
+        return min(healthy, key=lambda worker: len(worker.calls))
+
+    def call(self, target: str, *args, emit: Optional[Callable[[dict], None]] = None) -> Any:
+        """
+        Runs ``target(*args)`` on a worker process and returns its result.
+        With ``emit``, the worker calls ``target(*args, emit=...)`` and sets
+        ``payload["on_event"]`` on the state, and each event is passed to
+        ``emit`` here. The call runs within the deadline of the cancellation
+        bound here, and cancelling (or extending) it cancels (or extends) the
+        call on the worker.
+
+        Raises:
+            WorkerUnavailableError: If no worker is healthy.
+            WorkerCrashedError: If the worker died during the call.
+        """
+        call = _Call(emit)
+        args = tuple(_strip_callables(arg) for arg in args)
+        cancellation = current_cancellation()
+        call_id = next(self._ids)
+        with self._lock:
+            worker = self._pick()
+            worker.calls[call_id] = call
+            WORKER_IN_FLIGHT.labels(str(worker.index)).set(len(worker.calls))
+        try:
+            with worker.send_lock:
+                worker.conn.send((
+                    call_id, target, args, get_correlation_id(), emit is not None,
+                    cancellation.deadline if cancellation is not None else None,
+                ))
+        except (OSError, EOFError) as e:
+            with self._lock:
+                worker.calls.pop(call_id, None)
+            raise WorkerCrashedError(f"Inference worker {worker.index} is gone: {e}") from e
+        if cancellation is not None:
+            cancellation.on_cancel(lambda reason: self._notify(worker, call_id, "cancel", reason))
+            cancellation.on_extend(lambda deadline: self._notify(worker, call_id, "extend", deadline))
+        return call.future.result()
+
+    def _notify(self, worker: _Worker, call_id: int, kind: str, value):
+        if call_id not in worker.calls:
+            return
+        try:
+            with worker.send_lock:
+                worker.conn.send((kind, call_id, value))
+        except (OSError, EOFError):
+            pass
+
+    def shutdown(self, timeout: float = 10.0):
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+        for worker in self._workers:
+            try:
+                with worker.send_lock:
+                    worker.conn.send(None)
+            except (OSError, EOFError, AttributeError):
+                pass
+        for worker in self._workers:
+            if worker.process is not None:
+                worker.process.join(timeout)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "processes": self.num_workers,
+                "workers": [
+                    {
+                        "index": worker.index,
+                        "pid": worker.process.pid if worker.process is not None else None,
+                        "ready": worker.ready,
+                        "healthy": worker.healthy,
+                        "in_flight": len(worker.calls),
+                        "restarts": worker.restarts,
+                        "error": worker.error,
+                    }
+                    for worker in self._workers
+                ],
+            }
+
+
+_dispatcher: Optional[ProcessDispatcher] = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher() -> ProcessDispatcher:
+    """
+    Returns the process-wide dispatcher (``SERVING_PROCESSES`` workers),
+    starting it on first use.
+    """
+    global _dispatcher
+
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = ProcessDispatcher(config.SERVING_PROCESSES)
+            _dispatcher.start()
+    return _dispatcher
@@ -3,16 +3,16 @@ import base64
 from io import BytesIO
 import io
 import re
-from app.utils.logger import get_logger
+from app.utils.logger import get_logger, payload_summary
+from app.utils.metrics import observe_stage, record_json_parse
 import json
 
 logger = get_logger(__name__)
 
 def convert_uploadfile_to_image(file_bytes: bytes) -> Image.Image:
-    try:
-        return Image.open(io.BytesIO(file_bytes)).convert("RGB")
-    except Exception as e:
-        raise ValueError("Invalid image uploaded.") from e
+    from app.utils.image_ingest import open_image
+
+    return open_image(io.BytesIO(file_bytes))
     
     
 def clean_json_response(response: str) -> str:
@@ -22,7 +22,7 @@ def clean_json_response(response: str) -> str:
     cleaned = re.sub(r"^```json\s*|```$", "", response.strip(), flags=re.MULTILINE)
     try:
         data = json.loads(cleaned)
-        logger.info(f"Parsed JSON response: {data}")
+        logger.debug("Parsed JSON response: %s", payload_summary(data))
         # If data is a list, remove entries with empty 'description'
         if isinstance(data, list):
             data = [entry for entry in data if entry.get("description")]
@@ -31,10 +31,11 @@ def clean_json_response(response: str) -> str:
             for key, value in data.items():
                 if isinstance(value, list):
                     data[key] = [entry for entry in value if entry.get("description")]
-        logger.info(f"Cleaned JSON response: {data}")
+        logger.debug("Cleaned JSON response: %s", payload_summary(data))
+        record_json_parse("cleaned")
         return json.dumps(data)
     except Exception as e:
-        logger.error(f"JSON parsing failed: {e}\nRaw response: {cleaned}")
+        logger.warning("JSON parsing failed: %s; raw response: %s", e, payload_summary(cleaned))
         # Try to recover valid objects from incomplete JSON
         # This regex matches objects like {"code": "...", "description": "..."}
         matches = re.findall(r'\{[^{}]*"code"\s*:\s*"[^"]*",\s*"description"\s*:\s*"[^"]*"\s*\}', cleaned)
@@ -46,5 +47,20 @@ def clean_json_response(response: str) -> str:
                     recovered.append(obj)
             except Exception:
                 continue
-        logger.info(f"Recovered partial JSON objects: {recovered}")
+        logger.info("Recovered %d partial JSON object(s)", len(recovered))
+        record_json_parse("recovered" if recovered else "failed")
         return json.dumps(recovered)
+
+
+def parse_json_response(response: str):
+    """
+    Parses an agent's JSON output. Schema-constrained decoding already yields
+    valid JSON; free-form output goes through ``clean_json_response``.
+    """
+    with observe_stage("json_parse"):
+        try:
+            result = json.loads(response)
+        except json.JSONDecodeError:
+            return json.loads(clean_json_response(response))
+        record_json_parse("valid")
+        return result
@@ -0,0 +1,301 @@
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+from app.config.config import config
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+CODE_WIDTH = 7
+
+_CODE_PATTERN = re.compile(r"^[A-Z][0-9][0-9A-Z]{1,5}$")
+
+# ICD-10-CM chapters as (first category, last category, title)
+CHAPTERS = [
+    ("A00", "B99", "Certain infectious and parasitic diseases"),
+    ("C00", "D49", "Neoplasms"),
+    ("D50", "D89", "Diseases of the blood and blood-forming organs and certain disorders involving the immune mechanism"),
+    ("E00", "E89", "Endocrine, nutritional and metabolic diseases"),
+    ("F01", "F99", "Mental, Behavioral and Neurodevelopmental disorders"),
+    ("G00", "G99", "Diseases of the nervous system"),
+    ("H00", "H59", "Diseases of the eye and adnexa"),
+    ("H60", "H95", "Diseases of the ear and mastoid process"),
+    ("I00", "I99", "Diseases of the circulatory system"),
+    ("J00", "J99", "Diseases of the respiratory system"),
+    ("K00", "K95", "Diseases of the digestive system"),
+    ("L00", "L99", "Diseases of the skin and subcutaneous tissue"),
+    ("M00", "M99", "Diseases of the musculoskeletal system and connective tissue"),
+    ("N00", "N99", "Diseases of the genitourinary system"),
+    ("O00", "O9A", "Pregnancy, childbirth and the puerperium"),
+    ("P00", "P96", "Certain conditions originating in the perinatal period"),
+    ("Q00", "Q99", "Congenital malformations, deformations and chromosomal abnormalities"),
+    ("R00", "R99", "Symptoms, signs and abnormal clinical and laboratory findings, not elsewhere classified"),
+    ("S00", "T88", "Injury, poisoning and certain other consequences of external causes"),
+    ("U00", "U85", "Codes for special purposes"),
+    ("V00", "Y99", "External causes of morbidity"),
+    ("Z00", "Z99", "Factors influencing health status and contact with health services"),
+]
+
+
+def normalize_code(code: str) -> str:
+    """
+    ``" k35.80"`` -> ``"K3580"``: the dotless upper-case form used in the order file.
+    """
+    return re.sub(r"[\s.]", "", code or "").upper()
+
+
+def format_code(code: str) -> str:
+    """
+    ``"K3580"`` -> ``"K35.80"``.
+    """
+    return code if len(code) <= 3 else f"{code[:3]}.{code[3:]}"
+
+
+def parse_order_file(path: str) -> Iterator[Tuple[str, bool, str]]:
+    """
+    Reads the CMS ICD-10-CM order file (``icd10cm_order_<year>.txt``): fixed
+    width columns for order number, code, billable flag, short and long
+    description.
+
+    Yields:
+        Tuple[str, bool, str]: ``(code, billable, long_description)``.
+    """
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if len(line) < 16:
+                continue
+            code = line[6:13].strip()
+            if not code:
+                continue
+            description = line[77:].strip() or line[16:76].strip()
+            yield code, line[14] == "1", description
+
+
+class ICD10Index:
+    """
+    Array-backed ICD-10-CM index. Codes are kept sorted in a fixed-width byte
+    array, so exact lookups and prefix (trie) ranges are binary searches;
+    descriptions live in one UTF-8 blob addressed by offsets. Saved indexes
+    are loaded memory-mapped, so startup reads nothing until a code is looked up.
+
+    Args:
+        codes (np.ndarray): Sorted dotless codes, dtype ``S7``.
+        billable (np.ndarray): Billable flag per code.
+        offsets (np.ndarray): ``len(codes) + 1`` offsets into ``descriptions``.
+        descriptions (np.ndarray): UTF-8 bytes of all long descriptions, dtype ``uint8``.
+    """
+
+    FILES = ("codes.npy", "billable.npy", "offsets.npy", "descriptions.npy")
+
+    def __init__(self, codes: np.ndarray, billable: np.ndarray, offsets: np.ndarray, descriptions: np.ndarray):
+        self.codes = codes
+        self.billable = billable
+        self.offsets = offsets
+        self.descriptions = descriptions
+
+    @classmethod
+    def from_order_file(cls, path: str) -> "ICD10Index":
+        records = sorted(parse_order_file(path))
+        encoded = [description.encode("utf-8") for _, _, description in records]
+        offsets = np.zeros(len(records) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(e) for e in encoded])
+        return cls(
+            codes=np.array([code.encode("ascii") for code, _, _ in records], dtype=f"S{CODE_WIDTH}"),
+            billable=np.array([b for _, b, _ in records], dtype=np.bool_),
+            offsets=offsets,
+            descriptions=np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        )
+
+    def save(self, directory: str, source: Optional[str] = None):
+        os.makedirs(directory, exist_ok=True)
+        for name, array in zip(self.FILES, (self.codes, self.billable, self.offsets, self.descriptions)):
+            np.save(os.path.join(directory, name), array)
+        meta = {"codes": len(self), "source": source, "source_mtime": os.path.getmtime(source) if source else None}
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, directory: str) -> "ICD10Index":
+        arrays = [np.load(os.path.join(directory, name), mmap_mode="r") for name in cls.FILES]
+        return cls(*arrays)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def _position(self, code: str) -> Optional[int]:
+        key = normalize_code(code).encode("ascii", "ignore")
+        if not key or len(key) > CODE_WIDTH:
+            return None
+        i = int(np.searchsorted(self.codes, key))
+        if i < len(self.codes) and self.codes[i] == key:
+            return i
+        return None
+
+    def _description_at(self, i: int) -> str:
+        return bytes(self.descriptions[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+    def __contains__(self, code: str) -> bool:
+        return self._position(code) is not None
+
+    def description(self, code: str) -> Optional[str]:
+        i = self._position(code)
+        return self._description_at(i) if i is not None else None
+
+    def is_billable(self, code: str) -> bool:
+        i = self._position(code)
+        return bool(self.billable[i]) if i is not None else False
+
+    def descendants(self, code: str, billable_only: bool = False) -> List[str]:
+        """
+        Codes under ``code`` in the hierarchy (``code`` itself included).
+        """
+        prefix = normalize_code(code).encode("ascii", "ignore")
+        if not prefix or len(prefix) > CODE_WIDTH:
+            return []
+        lo = int(np.searchsorted(self.codes, prefix, side="left"))
+        hi = int(np.searchsorted(self.codes, prefix + b"\xff" * (CODE_WIDTH - len(prefix)), side="right"))
+        return [
+            self.codes[i].decode("ascii")
+            for i in range(lo, hi)
+            if self.codes[i].startswith(prefix) and (not billable_only or self.billable[i])
+        ]
+
+    def parents(self, code: str) -> List[str]:
+        """
+        Ancestors of ``code`` present in the index, from the category down.
+        """
+        code = normalize_code(code)
+        return [code[:k] for k in range(3, len(code)) if code[:k] in self]
+
+    @staticmethod
+    def chapter(code: str) -> Optional[str]:
+        category = normalize_code(code)[:3]
+        for first, last, title in CHAPTERS:
+            if first <= category <= last:
+                return title
+        return None
+
+    def lookup(self, code: str) -> Optional[dict]:
+        i = self._position(code)
+        if i is None:
+            return None
+        code = self.codes[i].decode("ascii")
+        return {
+            "code": format_code(code),
+            "description": self._description_at(i),
+            "billable": bool(self.billable[i]),
+            "parents": [format_code(p) for p in self.parents(code)],
+            "chapter": self.chapter(code),
+        }
+
+    def resolve(self, code: str) -> Optional[str]:
+        """
+        Maps a model-emitted code to a billable code in the index.
+
+        Over-specified codes that do not exist are collapsed to their nearest
+        existing ancestor; non-billable headers are expanded to their
+        "unspecified" billable child (or the first billable child).
+
+        Returns:
+            Optional[str]: The dotless billable code, or None if nothing matches.
+        """
+        code = normalize_code(code)
+        if not _CODE_PATTERN.match(code):
+            return None
+        while len(code) >= 3 and code not in self:
+            code = code[:-1]
+        if len(code) < 3:
+            return None
+        if self.is_billable(code):
+            return code
+
+        children = self.descendants(code, billable_only=True)
+        if not children:
+            return None
+        unspecified = [c for c in children if "unspecified" in self.description(c).lower()]
+        return min(unspecified or children, key=lambda c: (len(c), c))
+
+    def normalize(self, entries: List[dict]) -> List[dict]:
+        """
+        Validates ``{"code", "description"}`` entries from the ICD-10 agent:
+        unknown codes are dropped, the rest are resolved to billable codes with
+        their canonical description, and duplicates are removed.
+        """
+        normalized, seen = [], set()
+        for entry in entries:
+            resolved = self.resolve(str(entry.get("code", "")))
+            if resolved is None:
+                logger.info("Dropping unknown ICD-10 code: %s", entry.get("code"))
+                continue
+            if resolved in seen:
+                continue
+            seen.add(resolved)
+            normalized.append({"code": format_code(resolved), "description": self.description(resolved)})
+        return normalized
+
+
+_index: Optional[ICD10Index] = None
+_index_lock = threading.Lock()
+_index_missing = False
+
+
+def _index_is_fresh(directory: str, source: str) -> bool:
+    try:
+        with open(os.path.join(directory, "meta.json")) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    if not all(os.path.exists(os.path.join(directory, name)) for name in ICD10Index.FILES):
+        return False
+    return not os.path.exists(source) or meta.get("source_mtime") == os.path.getmtime(source)
+
+
+def get_icd10_index() -> Optional[ICD10Index]:
+    """
+    Returns the process-wide index: the saved arrays in ``ICD10_INDEX_DIR``,
+    rebuilt from ``ICD10_ORDER_FILE`` when missing or stale. Returns None when
+    neither exists, in which case agent output is passed through unvalidated.
+    """
+    global _index, _index_missing
+
+    if _index is not None or _index_missing:
+        return _index
+    with _index_lock:
+        if _index is not None or _index_missing:
+            return _index
+
+        tic = time.perf_counter()
+        directory, source = config.ICD10_INDEX_DIR, config.ICD10_ORDER_FILE
+        if _index_is_fresh(directory, source):
+            _index = ICD10Index.load(directory)
+        elif os.path.exists(source):
+            _index = ICD10Index.from_order_file(source)
+            _index.save(directory, source=source)
+        else:
+            logger.warning("No ICD-10-CM order file at %s; ICD-10 codes are not validated", source)
+            _index_missing = True
+            return None
+        logger.info("Loaded ICD-10-CM index with %d codes in %.3fs", len(_index), time.perf_counter() - tic)
+        return _index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the ICD-10-CM index from a CMS order file.")
+    parser.add_argument("order_file", nargs="?", default=config.ICD10_ORDER_FILE)
+    parser.add_argument("--out", default=config.ICD10_INDEX_DIR)
+    args = parser.parse_args()
+
+    tic = time.perf_counter()
+    index = ICD10Index.from_order_file(args.order_file)
+    index.save(args.out, source=args.order_file)
+    print(f"Indexed {len(index)} codes into {args.out} in {time.perf_counter() - tic:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
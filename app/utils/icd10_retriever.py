@@ -0,0 +1,244 @@
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from scipy import sparse
+from app.config.config import config
+from app.utils.icd10_index import ICD10Index, format_code, get_icd10_index
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+STOPWORDS = frozenset({
+    "a", "an", "and", "as", "at", "by", "for", "from", "in", "into", "is", "of", "on", "or",
+    "the", "to", "with", "without", "other", "unspecified", "patient", "presents", "reports",
+    "no", "not", "mild", "past", "hours", "days", "weeks",
+})
+
+# Note sections that name the conditions to code; the diagnosis counts double
+QUERY_SECTIONS = {"diagnosis": 2, "diagnoses": 2, "assessment": 2, "history & symptoms": 1, "history": 1}
+
+SECTION_HEADER = re.compile(r"^\s*([A-Za-z][A-Za-z &/]*):\s*$", re.MULTILINE)
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in TOKEN_PATTERN.findall(text.lower()) if t not in STOPWORDS and len(t) > 1]
+
+
+def query_text(note: str) -> str:
+    """
+    The parts of a clinical note used as the retrieval query: the Diagnosis
+    and History sections (weighted as in ``QUERY_SECTIONS``), or the whole
+    note when it has none of them.
+    """
+    headers = list(SECTION_HEADER.finditer(note or ""))
+    parts = []
+    for i, header in enumerate(headers):
+        weight = QUERY_SECTIONS.get(header.group(1).strip().lower())
+        if weight:
+            end = headers[i + 1].start() if i + 1 < len(headers) else len(note)
+            parts.extend([note[header.end():end]] * weight)
+    return "\n".join(parts) if parts else (note or "")
+
+
+class ICD10Retriever:
+    """
+    TF-IDF retrieval over the billable ICD-10-CM descriptions.
+
+    Descriptions are a sparse ``codes x terms`` matrix of L2-normalized,
+    sublinear TF-IDF weights; a batch of notes is scored against every code
+    with one sparse matrix product.
+
+    Args:
+        index (ICD10Index): Index providing the descriptions.
+        codes (np.ndarray): Dotless code of each matrix row.
+        matrix (sparse.csr_matrix): Normalized TF-IDF rows.
+        idf (np.ndarray): Inverse document frequency per term.
+        vocabulary (Dict[str, int]): Term to column.
+    """
+
+    FILES = ("retrieval_codes.npy", "retrieval_matrix.npz", "retrieval_idf.npy", "retrieval_vocabulary.json")
+
+    def __init__(self, index: ICD10Index, codes: np.ndarray, matrix: sparse.csr_matrix, idf: np.ndarray, vocabulary: Dict[str, int]):
+        self.index = index
+        self.codes = codes
+        self.matrix = matrix
+        self.idf = idf
+        self.vocabulary = vocabulary
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.total_ms = 0.0
+        self.last_ms = 0.0
+
+    @classmethod
+    def build(cls, index: ICD10Index) -> "ICD10Retriever":
+        codes = [code.decode("ascii") for code, billable in zip(index.codes, index.billable) if billable]
+        vocabulary: Dict[str, int] = {}
+        rows, cols, counts = [], [], []
+        for row, code in enumerate(codes):
+            for term, count in Counter(tokenize(index.description(code))).items():
+                rows.append(row)
+                cols.append(vocabulary.setdefault(term, len(vocabulary)))
+                counts.append(count)
+
+        tf = sparse.csr_matrix(
+            (1.0 + np.log(np.array(counts, dtype=np.float32)), (rows, cols)),
+            shape=(len(codes), len(vocabulary)),
+        )
+        df = np.bincount(np.array(cols, dtype=np.int64), minlength=len(vocabulary))
+        idf = (np.log((1.0 + len(codes)) / (1.0 + df)) + 1.0).astype(np.float32)
+        matrix = _normalize_rows(tf @ sparse.diags(idf))
+        return cls(index, np.array(codes, dtype="U7"), matrix, idf, vocabulary)
+
+    def save(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        codes, matrix, idf, vocabulary = (os.path.join(directory, name) for name in self.FILES)
+        np.save(codes, self.codes)
+        sparse.save_npz(matrix, self.matrix)
+        np.save(idf, self.idf)
+        with open(vocabulary, "w") as f:
+            json.dump(self.vocabulary, f)
+
+    @classmethod
+    def load(cls, index: ICD10Index, directory: str) -> "ICD10Retriever":
+        codes, matrix, idf, vocabulary = (os.path.join(directory, name) for name in cls.FILES)
+        with open(vocabulary) as f:
+            vocabulary = json.load(f)
+        return cls(index, np.load(codes), sparse.load_npz(matrix).tocsr(), np.load(idf), vocabulary)
+
+    def vectorize(self, texts: List[str]) -> sparse.csr_matrix:
+        rows, cols, counts = [], [], []
+        for row, text in enumerate(texts):
+            terms = Counter(self.vocabulary[t] for t in tokenize(text) if t in self.vocabulary)
+            for col, count in terms.items():
+                rows.append(row)
+                cols.append(col)
+                counts.append(count)
+        tf = sparse.csr_matrix(
+            (1.0 + np.log(np.array(counts, dtype=np.float32)), (rows, cols)),
+            shape=(len(texts), len(self.vocabulary)),
+        )
+        return _normalize_rows(tf @ sparse.diags(self.idf))
+
+    def search(self, notes: List[str], k: int = 20) -> List[List[Tuple[str, float]]]:
+        """
+        Top-``k`` codes for each note, scored by cosine similarity between the
+        note's Diagnosis/History text and the code descriptions.
+
+        Returns:
+            List[List[Tuple[str, float]]]: ``(dotless code, score)`` per note, best first.
+        """
+        if not notes:
+            return []
+        tic = time.perf_counter()
+        queries = self.vectorize([query_text(note) for note in notes])
+        scores = (queries @ self.matrix.T).toarray()
+        k = min(k, scores.shape[1])
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+
+        results = []
+        for row, candidates in enumerate(top):
+            ordered = candidates[np.argsort(-scores[row, candidates])]
+            results.append([(str(self.codes[i]), float(scores[row, i])) for i in ordered if scores[row, i] > 0])
+
+        elapsed = 1000 * (time.perf_counter() - tic)
+        with self._lock:
+            self.queries += len(notes)
+            self.total_ms += elapsed
+            self.last_ms = elapsed
+        logger.info("Retrieved ICD-10 candidates for %d note(s) in %.2fms", len(notes), elapsed)
+        return results
+
+    def shortlist(self, note: str, k: int = 20) -> List[dict]:
+        """
+        ``{"code", "description"}`` candidates for one note, for the ICD-10 prompt.
+        """
+        return [
+            {"code": format_code(code), "description": self.index.description(code)}
+            for code, _ in self.search([note], k)[0]
+        ]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "codes": len(self.codes),
+                "terms": len(self.vocabulary),
+                "queries": self.queries,
+                "last_ms": round(self.last_ms, 3),
+                "avg_ms_per_note": round(self.total_ms / self.queries, 3) if self.queries else 0.0,
+            }
+
+
+def _normalize_rows(matrix: sparse.csr_matrix) -> sparse.csr_matrix:
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    return sparse.csr_matrix(sparse.diags(1.0 / norms) @ matrix, dtype=np.float32)
+
+
+_retriever: Optional[ICD10Retriever] = None
+_retriever_lock = threading.Lock()
+
+
+def get_icd10_retriever() -> Optional[ICD10Retriever]:
+    """
+    Returns the process-wide retriever, loaded from ``ICD10_INDEX_DIR`` or
+    built from the ICD-10-CM index on first use. None when there is no index.
+    """
+    global _retriever
+
+    if _retriever is not None:
+        return _retriever
+    with _retriever_lock:
+        if _retriever is not None:
+            return _retriever
+        index = get_icd10_index()
+        if index is None:
+            return None
+
+        directory = config.ICD10_INDEX_DIR
+        tic = time.perf_counter()
+        if _is_fresh(directory):
+            _retriever = ICD10Retriever.load(index, directory)
+        else:
+            _retriever = ICD10Retriever.build(index)
+            _retriever.save(directory)
+        logger.info("Loaded ICD-10 retriever (%d codes) in %.3fs", len(_retriever.codes), time.perf_counter() - tic)
+        return _retriever
+
+
+def _is_fresh(directory: str) -> bool:
+    # Saved after the index it was built from, so a rebuilt index invalidates it
+    paths = [os.path.join(directory, name) for name in ICD10Retriever.FILES]
+    meta = os.path.join(directory, "meta.json")
+    if not all(os.path.exists(p) for p in paths) or not os.path.exists(meta):
+        return False
+    return min(os.path.getmtime(p) for p in paths) >= os.path.getmtime(meta)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build the ICD-10-CM index and its TF-IDF retrieval index.")
+    parser.add_argument("order_file", nargs="?", default=config.ICD10_ORDER_FILE)
+    parser.add_argument("--out", default=config.ICD10_INDEX_DIR)
+    args = parser.parse_args()
+
+    tic = time.perf_counter()
+    index = ICD10Index.from_order_file(args.order_file)
+    index.save(args.out, source=args.order_file)
+    retriever = ICD10Retriever.build(index)
+    retriever.save(args.out)
+    print(
+        f"Indexed {len(index)} codes ({len(retriever.codes)} billable, {len(retriever.vocabulary)} terms) "
+        f"into {args.out} in {time.perf_counter() - tic:.2f}s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+import asyncio
+import math
+from typing import BinaryIO, Optional, Tuple
+
+from fastapi import UploadFile
+from PIL import Image, UnidentifiedImageError
+
+from app.config.config import config
+from app.utils.dicom_ingest import is_dicom, load_dicom, read_header
+from app.utils.logger import get_logger
+from app.utils.metrics import observe_stage
+
+logger = get_logger(__name__)
+
+ALLOWED_FORMATS = frozenset({"JPEG", "PNG", "TIFF", "BMP", "WEBP"})
+
+
+def target_size(size: Tuple[int, int], target: int) -> Tuple[int, int]:
+    """
+    The smallest size with the same aspect ratio whose sides are both at least
+    ``target``, or ``size`` itself if it is already smaller. The processor
+    resizes to ``target x target``, so nothing below this reaches the model.
+    """
+    width, height = size
+    scale = max(target / width, target / height)
+    if not target or scale >= 1:
+        return size
+    return max(1, math.ceil(width * scale)), max(1, math.ceil(height * scale))
+
+
+def _check_size(fp: BinaryIO, limit: int):
+    position = fp.tell()
+    size = fp.seek(0, 2) - position
+    fp.seek(position)
+    if size > limit:
+        raise ValueError(f"Image upload is larger than {limit} bytes.")
+
+
+def inspect_image(fp: BinaryIO) -> Image.Image:
+    """
+    Opens an image and validates its format and dimensions from the header
+    only; pixels are not decoded.
+
+    Raises:
+        ValueError: If the file is not an image, not an allowed format, or too large.
+    """
+    _check_size(fp, config.IMAGE_MAX_UPLOAD_BYTES)
+    try:
+        image = Image.open(fp)
+    except Image.DecompressionBombError as e:
+        raise ValueError("Image dimensions are too large.") from e
+    except (UnidentifiedImageError, OSError) as e:
+        raise ValueError("Invalid image uploaded.") from e
+
+    if image.format not in ALLOWED_FORMATS:
+        raise ValueError(f"Unsupported image format: {image.format}.")
+    if image.width * image.height > config.IMAGE_MAX_PIXELS:
+        raise ValueError(
+            f"Image is {image.width}x{image.height}; at most {config.IMAGE_MAX_PIXELS} pixels are accepted."
+        )
+    return image
+
+
+def validate_image(fp: BinaryIO):
+    """
+    Header-only check of an image or DICOM file, without decoding pixels.
+
+    Raises:
+        ValueError: If the file would be rejected by ``load_image``.
+    """
+    position = fp.tell()
+    if is_dicom(fp):
+        _check_size(fp, config.DICOM_MAX_UPLOAD_BYTES)
+        read_header(fp)
+    else:
+        inspect_image(fp)
+    fp.seek(position)
+
+
+def load_image(fp: BinaryIO, target: Optional[int] = None) -> Tuple[Image.Image, dict]:
+    """
+    Decodes an image or DICOM file close to the model's input resolution.
+
+    The header is checked first (``inspect_image``). JPEGs are decoded in
+    draft mode at the smallest DCT scale that stays above the target size;
+    other formats are decoded and then reduced. Grayscale images are resized
+    before the RGB conversion, so the full-resolution RGB copy never exists.
+    DICOM files go through ``load_dicom`` (windowing, frame selection).
+
+    Args:
+        fp (BinaryIO): Seekable file object positioned at the image.
+        target (Optional[int]): Minimum side length kept; defaults to
+            ``IMAGE_TARGET_SIZE``, 0 keeps the native resolution.
+
+    Returns:
+        Tuple[Image.Image, dict]: The RGB image and, for DICOM, its technique
+        metadata (empty for other formats).
+    """
+    with observe_stage("image_decode"):
+        return _load_image(fp, config.IMAGE_TARGET_SIZE if target is None else target)
+
+
+def _load_image(fp: BinaryIO, target: int) -> Tuple[Image.Image, dict]:
+    if is_dicom(fp):
+        _check_size(fp, config.DICOM_MAX_UPLOAD_BYTES)
+        image, metadata = load_dicom(fp, target)
+    else:
+        image, metadata = inspect_image(fp), {}
+
+    size = target_size(image.size, target)
+    try:
+        if size != image.size:
+            image.draft(None, size)
+            if image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            image = image.resize(size, Image.Resampling.BILINEAR, reducing_gap=3.0)
+        return image.convert("RGB"), metadata
+    except (OSError, SyntaxError) as e:
+        raise ValueError("Invalid image uploaded.") from e
+
+
+def open_image(fp: BinaryIO, target: Optional[int] = None) -> Image.Image:
+    """
+    ``load_image`` without the metadata.
+    """
+    return load_image(fp, target)[0]
+
+
+async def ingest_upload(upload: UploadFile, target: Optional[int] = None) -> Tuple[Image.Image, dict]:
+    """
+    Decodes an uploaded image or DICOM file on a worker thread, straight from
+    the spooled upload file instead of a bytes copy of it.
+
+    Raises:
+        ValueError: If the upload is too large or not an acceptable image.
+    """
+    await upload.seek(0)
+    image, metadata = await asyncio.to_thread(load_image, upload.file, target)
+    logger.info("Ingested upload as %dx%d", image.size[0], image.size[1])
+    return image, metadata
@@ -0,0 +1,223 @@
+import asyncio
+import contextvars
+import queue
+import threading
+import time
+from typing import Any, Callable, Optional
+
+from app.config.config import config
+from app.utils.logger import get_logger
+from app.utils.metrics import QUEUE_WAIT, WORK_CANCELLED
+
+logger = get_logger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when the submission queue is at capacity."""
+
+
+class WorkerUnavailableError(Exception):
+    """Raised when the pool is not accepting work (not started or shutting down)."""
+
+
+class _Job:
+    __slots__ = ("fn", "args", "kwargs", "future", "loop", "context", "enqueued_at", "expired")
+
+    def __init__(self, fn, args, kwargs, future, loop):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.loop = loop
+        # Runs in the submitter's context, so correlation ids follow the job
+        self.context = contextvars.copy_context()
+        self.enqueued_at = time.monotonic()
+        self.expired = False
+
+
+def _set_result(future: asyncio.Future, result: Any):
+    if not future.done():
+        future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future, exc: BaseException):
+    if not future.done():
+        future.set_exception(exc)
+
+
+class InferenceWorkerPool:
+    """
+    Runs blocking inference calls (e.g. ``graph.invoke``) on dedicated worker
+    threads behind a bounded queue, so the event loop never waits on the model.
+
+    Args:
+        num_workers (int): Number of worker threads pulling from the queue.
+        max_queue_size (int): Maximum number of jobs waiting for a worker.
+        name (str): Prefix used for the worker thread names.
+    """
+
+    def __init__(self, num_workers: int, max_queue_size: int, name: str = "inference"):
+        self.num_workers = max(1, num_workers)
+        self.max_queue_size = max(1, max_queue_size)
+        self.name = name
+        self._queue: "queue.Queue[Optional[_Job]]" = queue.Queue(maxsize=self.max_queue_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._running = False
+
+        self._active = 0
+        self._submitted = 0
+        self._completed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._last_wait = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            for i in range(self.num_workers):
+                thread = threading.Thread(target=self._worker, name=f"{self.name}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        logger.info("Started %d %s worker(s), queue size %d", self.num_workers, self.name, self.max_queue_size)
+
+    def shutdown(self, wait: bool = True):
+        with self._lock:
+            if not self._running:
+                return
+            self._running = False
+        for _ in self._threads:
+            # Sentinels are queued behind pending work so in-flight jobs still finish
+            self._queue.put(None)
+        if wait:
+            for thread in self._threads:
+                thread.join()
+        self._threads = []
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def enqueue(self, fn: Callable, *args, **kwargs) -> asyncio.Future:
+        """
+        Queue ``fn(*args, **kwargs)`` for a worker thread without waiting for it.
+
+        Raises:
+            WorkerUnavailableError: If the pool is not running.
+            QueueFullError: If the queue is full; the job is rejected immediately.
+        """
+        job = self._enqueue(fn, args, kwargs)
+        return job.future
+
+    def _enqueue(self, fn, args, kwargs) -> _Job:
+        if not self._running:
+            raise WorkerUnavailableError(f"{self.name} pool is not running.")
+
+        loop = asyncio.get_running_loop()
+        job = _Job(fn, args, kwargs, loop.create_future(), loop)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._rejected += 1
+            raise QueueFullError(f"{self.name} queue is full ({self.max_queue_size} pending).")
+
+        with self._lock:
+            self._submitted += 1
+        return job
+
+    async def submit(self, fn: Callable, *args, timeout: Optional[float] = None, **kwargs) -> Any:
+        """
+        Queue ``fn(*args, **kwargs)`` for a worker thread and await its result.
+
+        Raises:
+            WorkerUnavailableError: If the pool is not running.
+            QueueFullError: If the queue is full; the job is rejected immediately.
+            asyncio.TimeoutError: If the job does not finish within ``timeout`` seconds.
+        """
+        job = self._enqueue(fn, args, kwargs)
+        try:
+            # shield so a timeout does not cancel the future the worker resolves
+            return await asyncio.wait_for(asyncio.shield(job.future), timeout)
+        except asyncio.TimeoutError:
+            # A job that has not started yet is skipped; a running one finishes in the background
+            job.expired = True
+            # Nobody awaits the job any more; retrieve its outcome so asyncio does not log it
+            job.future.add_done_callback(lambda future: future.cancelled() or future.exception())
+            with self._lock:
+                self._timed_out += 1
+            raise
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            if job.expired:
+                WORK_CANCELLED.labels("queue", "deadline").inc()
+                continue
+
+            wait = time.monotonic() - job.enqueued_at
+            QUEUE_WAIT.labels(self.name).observe(wait)
+            with self._lock:
+                self._active += 1
+                self._total_wait += wait
+                self._last_wait = wait
+                self._max_wait = max(self._max_wait, wait)
+
+            try:
+                result = job.context.run(job.fn, *job.args, **job.kwargs)
+                job.loop.call_soon_threadsafe(_set_result, job.future, result)
+                with self._lock:
+                    self._completed += 1
+            except BaseException as e:
+                logger.error("%s job failed: %s", self.name, e)
+                job.loop.call_soon_threadsafe(_set_exception, job.future, e)
+                with self._lock:
+                    self._failed += 1
+            finally:
+                with self._lock:
+                    self._active -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            started = self._completed + self._failed
+            return {
+                "running": self._running,
+                "workers": self.num_workers,
+                "active": self._active,
+                "queue_depth": self._queue.qsize(),
+                "max_queue_size": self.max_queue_size,
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "timed_out": self._timed_out,
+                "avg_wait_ms": round(1000 * self._total_wait / started, 2) if started else 0.0,
+                "last_wait_ms": round(1000 * self._last_wait, 2),
+                "max_wait_ms": round(1000 * self._max_wait, 2),
+            }
+
+
+_pool: Optional[InferenceWorkerPool] = None
+
+
+def get_inference_pool() -> InferenceWorkerPool:
+    """
+    Returns the process-wide inference pool, starting it on first use.
+    """
+    global _pool
+
+    if _pool is None:
+        _pool = InferenceWorkerPool(config.INFERENCE_WORKERS, config.INFERENCE_QUEUE_SIZE)
+        _pool.start()
+
+    return _pool
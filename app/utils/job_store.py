@@ -0,0 +1,304 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Callable, Optional
+
+from app.utils.logger import get_logger, set_correlation_id, reset_correlation_id
+from app.utils.metrics import QUEUE_WAIT
+
+logger = get_logger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (SUCCEEDED, FAILED, CANCELLED)
+
+_COLUMNS = "id, status, attempts, max_attempts, error, created_at, started_at, finished_at, expires_at, cancel_requested"
+
+
+class JobError(Exception):
+    """Raised by a job handler for a failure that retrying will not fix."""
+
+
+class JobStore:
+    """
+    SQLite-backed store of analysis jobs and their inputs and results, so
+    queued work and finished results survive restarts and dropped connections.
+
+    A job moves ``queued -> running -> succeeded | failed | cancelled``; a
+    failed attempt goes back to ``queued`` with exponential backoff until
+    ``max_attempts``. Finished jobs expire ``ttl_seconds`` after finishing.
+
+    Args:
+        path (str): SQLite file, created with its directory if missing.
+        max_attempts (int): Attempts per job before it is marked failed.
+        retry_backoff (float): Delay before the first retry, doubled per attempt.
+        ttl_seconds (float): Lifetime of a finished job.
+    """
+
+    def __init__(self, path: str, max_attempts: int, retry_backoff: float, ttl_seconds: float):
+        self.max_attempts = max(1, max_attempts)
+        self.retry_backoff = retry_backoff
+        self.ttl = ttl_seconds
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            " id TEXT PRIMARY KEY, status TEXT NOT NULL, note TEXT, image BLOB, options TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0, max_attempts INTEGER NOT NULL, result TEXT, error TEXT,"
+            " created_at REAL NOT NULL, started_at REAL, finished_at REAL, run_after REAL NOT NULL,"
+            " expires_at REAL, cancel_requested INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_queue ON jobs (status, run_after)")
+        # Jobs that were running when the process stopped are picked up again, unless
+        # that was their last attempt (e.g. a job that crashes the process every time)
+        now = time.time()
+        failed = self._db.execute(
+            "UPDATE jobs SET status = ?, error = ?, finished_at = ?, expires_at = ?, note = NULL, image = NULL"
+            " WHERE status = ? AND attempts >= max_attempts",
+            (FAILED, "Interrupted by a restart.", now, now + self.ttl, RUNNING),
+        ).rowcount
+        recovered = self._db.execute(
+            "UPDATE jobs SET status = ?, started_at = NULL WHERE status = ?", (QUEUED, RUNNING)
+        ).rowcount
+        self._db.commit()
+        if recovered or failed:
+            logger.info("Re-queued %d and failed %d job(s) interrupted by a restart", recovered, failed)
+
+    def create(self, note: Optional[str], image: Optional[bytes], options: Optional[dict] = None) -> dict:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO jobs (id, status, note, image, options, max_attempts, created_at, run_after)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, QUEUED, note, image, json.dumps(options or {}), self.max_attempts, now, now),
+            )
+            self._db.commit()
+        return self.get(job_id)
+
+    def get(self, job_id: str, with_result: bool = False) -> Optional[dict]:
+        """
+        The job's status fields (and ``result`` if asked), or None if it does
+        not exist or has expired.
+        """
+        columns = f"{_COLUMNS}, result" if with_result else _COLUMNS
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT {columns} FROM jobs WHERE id = ? AND (expires_at IS NULL OR expires_at >= ?)",
+                (job_id, time.time()),
+            ).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["cancel_requested"] = bool(job["cancel_requested"])
+        if job.get("result") is not None:
+            job["result"] = json.loads(job["result"])
+        return job
+
+    def claim(self) -> Optional[dict]:
+        """
+        Marks the oldest runnable queued job as running and returns it with its
+        inputs, or None when there is nothing to run.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, note, image, options, attempts, run_after FROM jobs"
+                " WHERE status = ? AND run_after <= ? ORDER BY created_at LIMIT 1",
+                (QUEUED, now),
+            ).fetchone()
+            if row is None:
+                return None
+            # Guarded on the status in case another process shares the file
+            claimed = self._db.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, started_at = ? WHERE id = ? AND status = ?",
+                (RUNNING, now, row["id"], QUEUED),
+            ).rowcount
+            self._db.commit()
+            if not claimed:
+                return None
+        job = dict(row)
+        job["options"] = json.loads(job["options"])
+        job["attempts"] += 1
+        return job
+
+    def next_run_in(self) -> Optional[float]:
+        """
+        Seconds until the next queued job becomes runnable, None if none is queued.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT MIN(run_after) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()
+        return None if row[0] is None else max(0.0, row[0] - time.time())
+
+    def complete(self, job_id: str, result: dict):
+        self._finish(job_id, SUCCEEDED, result=json.dumps(result))
+
+    def fail(self, job_id: str, error: str, retry: bool = True) -> str:
+        """
+        Records a failed attempt. The job is queued again after a backoff if
+        ``retry`` is set and it has attempts left; otherwise it is marked failed.
+
+        Returns:
+            str: The job's new status.
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT attempts, max_attempts, cancel_requested FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if row is not None and retry and not row["cancel_requested"] and row["attempts"] < row["max_attempts"]:
+                delay = self.retry_backoff * 2 ** (row["attempts"] - 1)
+                self._db.execute(
+                    "UPDATE jobs SET status = ?, error = ?, started_at = NULL, run_after = ? WHERE id = ?",
+                    (QUEUED, error, time.time() + delay, job_id),
+                )
+                self._db.commit()
+                logger.info("Job %s attempt %d failed, retrying in %.1fs: %s", job_id, row["attempts"], delay, error)
+                return QUEUED
+        self._finish(job_id, FAILED, error=error)
+        return FAILED
+
+    def cancel(self, job_id: str) -> Optional[dict]:
+        """
+        Cancels a queued job. A running job is flagged and its result is
+        discarded when the attempt ends; a finished job is left as it is.
+        """
+        with self._lock:
+            self._db.execute(
+                "UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status IN (?, ?)", (job_id, QUEUED, RUNNING)
+            )
+            self._db.commit()
+        self._finish(job_id, CANCELLED, only_from=QUEUED)
+        return self.get(job_id)
+
+    def _finish(self, job_id: str, status: str, result: Optional[str] = None, error: Optional[str] = None, only_from: Optional[str] = None):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT status, cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None or row["status"] in FINISHED or (only_from and row["status"] != only_from):
+                return
+            if row["cancel_requested"]:
+                status, result = CANCELLED, None
+            # The inputs are not needed any more; the image can be large
+            self._db.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, expires_at = ?, note = NULL, image = NULL"
+                " WHERE id = ?",
+                (status, result, error, now, now + self.ttl, job_id),
+            )
+            self._db.commit()
+
+    def purge_expired(self) -> int:
+        with self._lock:
+            deleted = self._db.execute("DELETE FROM jobs WHERE expires_at < ?", (time.time(),)).rowcount
+            self._db.commit()
+        return deleted
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+
+class JobRunner:
+    """
+    Worker threads that take jobs from a ``JobStore`` and run ``handler`` on
+    them, independently of the request-serving inference pool.
+
+    ``handler(job)`` gets the claimed job (``note``, ``image`` bytes,
+    ``options``) and returns the JSON-serializable result. Raising
+    ``JobError`` fails the job immediately; any other exception is retried.
+
+    Args:
+        store (JobStore): Where jobs are claimed and results recorded.
+        handler (Callable[[dict], dict]): Runs one job.
+        num_workers (int): Number of worker threads.
+        poll_seconds (float): Longest idle wait before checking the store again.
+    """
+
+    def __init__(self, store: JobStore, handler: Callable[[dict], dict], num_workers: int = 1, poll_seconds: float = 5.0):
+        self.store = store
+        self.handler = handler
+        self.num_workers = max(1, num_workers)
+        self.poll_seconds = poll_seconds
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._active = 0
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self._stopping.clear()
+            for i in range(self.num_workers):
+                thread = threading.Thread(target=self._worker, name=f"jobs-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+        logger.info("Started %d job worker(s)", self.num_workers)
+
+    def shutdown(self, wait: bool = True):
+        """
+        Stops the workers after their current job; jobs still queued stay in
+        the store for the next start.
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+        self._stopping.set()
+        self._wakeup.set()
+        if wait:
+            for thread in threads:
+                thread.join()
+
+    def notify(self):
+        """Wakes an idle worker, e.g. right after a job is created."""
+        self._wakeup.set()
+
+    def _worker(self):
+        while True:
+            # Cleared before polling, so a notify() or shutdown() after the poll still ends the wait
+            self._wakeup.clear()
+            if self._stopping.is_set():
+                break
+            job = self.store.claim()
+            if job is None:
+                self.store.purge_expired()
+                next_run = self.store.next_run_in()
+                self._wakeup.wait(self.poll_seconds if next_run is None else min(next_run, self.poll_seconds))
+                continue
+
+            with self._lock:
+                self._active += 1
+            # Measured from when the job became runnable (creation or retry time)
+            QUEUE_WAIT.labels("jobs").observe(max(0.0, time.time() - job["run_after"]))
+            token = set_correlation_id(job["id"])
+            tic = time.perf_counter()
+            try:
+                result = self.handler(job)
+                self.store.complete(job["id"], result)
+                logger.info("Job %s finished in %.2fs", job["id"], time.perf_counter() - tic)
+            except JobError as e:
+                self.store.fail(job["id"], str(e), retry=False)
+            except Exception as e:
+                logger.error("Job %s failed: %s", job["id"], e)
+                self.store.fail(job["id"], str(e) or type(e).__name__)
+            finally:
+                reset_correlation_id(token)
+                with self._lock:
+                    self._active -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            active = self._active
+            running = bool(self._threads)
+        return {"running": running, "workers": self.num_workers, "active": active, "jobs": self.store.stats()}
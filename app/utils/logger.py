@@ -1,11 +1,204 @@
+import atexit
+import contextvars
+import hashlib
+import json
 import logging
+import logging.handlers
+import queue
+import random
+import threading
+import time
+import zlib
+from typing import Any, Mapping, Optional
+
+from app.config.config import config
+
+# Per-request correlation id, set by the HTTP middleware and the job/batch workers
+_correlation_id: contextvars.ContextVar = contextvars.ContextVar("correlation_id", default=None)
+
+# LogRecord attributes that are not user-supplied ``extra`` fields
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "correlation_id"}
+
+_listener: Optional[logging.handlers.QueueListener] = None
+_setup_lock = threading.Lock()
+_dropped = 0
+
+
+def get_correlation_id() -> Optional[str]:
+    return _correlation_id.get()
+
+
+def set_correlation_id(correlation_id: Optional[str]) -> contextvars.Token:
+    """
+    Tags every record logged from this context (and tasks or threads started
+    from it with a copied context) with ``correlation_id``.
+    """
+    return _correlation_id.set(correlation_id)
+
+
+def reset_correlation_id(token: contextvars.Token):
+    _correlation_id.reset(token)
+
+
+def summarize(value: Any) -> Any:
+    """
+    A PHI-safe description of a payload for logs: strings become their length
+    and a short hash, images their size and mode; dicts, lists and pydantic
+    models are summarized field by field. Numbers, booleans and None pass
+    through.
+    """
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, str):
+        return {"len": len(value), "sha256": hashlib.sha256(value.encode("utf-8", "replace")).hexdigest()[:12]}
+    if hasattr(value, "size") and hasattr(value, "mode"):
+        return {"image": f"{value.size[0]}x{value.size[1]}", "mode": value.mode}
+    if hasattr(value, "text") and hasattr(value, "generation_tokens"):
+        return {"text": summarize(value.text), "prompt_tokens": value.prompt_tokens, "generation_tokens": value.generation_tokens}
+    if hasattr(value, "model_dump"):
+        value = {key: getattr(value, key) for key in type(value).model_fields}
+    if isinstance(value, dict):
+        return {str(key): summarize(item) for key, item in value.items() if not callable(item)}
+    if isinstance(value, (list, tuple)):
+        return {"items": len(value)} if len(value) > 8 else [summarize(item) for item in value]
+    return type(value).__name__
+
+
+class _Summary:
+    """Defers ``summarize`` until the record is known to be emitted."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value: Any):
+        self.value = value
+
+    def __str__(self) -> str:
+        return json.dumps(summarize(self.value), default=str)
+
+
+def payload_summary(value: Any) -> _Summary:
+    """
+    Log argument that renders as ``summarize(value)``, e.g.
+    ``logger.debug("Running with %s", payload_summary(state))``. The summary is
+    only computed for records that pass the level and sampling checks.
+    """
+    return _Summary(value)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line: time, level, logger, message, correlation id,
+    any ``extra`` fields and the formatted exception.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": f"{time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created))}.{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "correlation_id", None):
+            entry["correlation_id"] = record.correlation_id
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_FIELDS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("[%(asctime)s] %(levelname)s - %(name)s - %(cid)s%(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        record.cid = f"[{record.correlation_id}] " if getattr(record, "correlation_id", None) else ""
+        return super().format(record)
+
+
+class _ContextFilter(logging.Filter):
+    """
+    Runs in the caller's thread: stamps the correlation id and samples verbose
+    (DEBUG) records. Sampling is keyed on the correlation id, so a sampled
+    request keeps all of its verbose records.
+    """
+
+    def __init__(self, sample_rate: float):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.correlation_id = _correlation_id.get()
+        if record.levelno > logging.DEBUG or self.sample_rate >= 1.0:
+            return True
+        if record.correlation_id is None:
+            return random.random() < self.sample_rate
+        return zlib.crc32(record.correlation_id.encode()) % 10000 < self.sample_rate * 10000
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Non-blocking handler: the caller only snapshots payload summaries and
+    enqueues the record; message formatting and I/O happen on the listener
+    thread. Records are dropped (and counted) when the queue is full.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.args:
+            # Payloads may change after this call returns; summarize them now
+            if isinstance(record.args, Mapping):
+                # A single mapping argument, for "%(name)s"-style messages
+                record.args = {key: str(arg) if isinstance(arg, _Summary) else arg for key, arg in record.args.items()}
+            else:
+                args = record.args if isinstance(record.args, tuple) else (record.args,)
+                record.args = tuple(str(arg) if isinstance(arg, _Summary) else arg for arg in args)
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        global _dropped
+
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _dropped += 1
+
+
+def dropped_records() -> int:
+    return _dropped
+
+
+def configure_logging():
+    """
+    Installs the queue handler on the ``app`` logger tree (once).
+    """
+    global _listener
+
+    with _setup_lock:
+        if _listener is not None:
+            return
+        output = logging.StreamHandler()
+        output.setFormatter(TextFormatter() if config.LOG_FORMAT == "text" else JsonFormatter())
+        records: queue.Queue = queue.Queue(maxsize=config.LOG_QUEUE_SIZE)
+        handler = _QueueHandler(records)
+        handler.addFilter(_ContextFilter(config.LOG_VERBOSE_SAMPLE_RATE))
+
+        root = logging.getLogger("app")
+        root.setLevel(config.LOG_LEVEL)
+        root.addHandler(handler)
+        root.propagate = False
+
+        _listener = logging.handlers.QueueListener(records, output, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
 
 def get_logger(name: str = "app"):
-    logger = logging.getLogger(name)
-    if not logger.handlers:
-        logger.setLevel(logging.INFO)
-        handler = logging.StreamHandler()
-        formatter = logging.Formatter("[%(asctime)s] %(levelname)s - %(name)s - %(message)s")
-        handler.setFormatter(formatter)
-        logger.addHandler(handler)
-    return logger
\ No newline at end of file
+    """
+    Returns a logger under the ``app`` tree, which logs through the
+    structured, queue-backed handler.
+    """
+    configure_logging()
+    if name != "app" and not name.startswith("app."):
+        name = f"app.{name}"
+    return logging.getLogger(name)
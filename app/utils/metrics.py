@@ -0,0 +1,143 @@
+import contextvars
+import time
+from contextlib import contextmanager
+from typing import Any, Callable
+
+from prometheus_client import Counter, Gauge, Histogram
+
+from app.graph.types import State
+
+# Node currently executing on this thread; "api" outside the graph (e.g. image decoding)
+_current_node: contextvars.ContextVar = contextvars.ContextVar("current_node", default="api")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0, 160.0)
+
+NODE_REQUESTS = Counter("graph_node_requests_total", "Graph node executions.", ["node"])
+NODE_ERRORS = Counter("graph_node_errors_total", "Graph node executions that raised or returned an error.", ["node"])
+NODE_LATENCY = Histogram("graph_node_latency_seconds", "Wall time of a graph node.", ["node"], buckets=LATENCY_BUCKETS)
+ROUTING_DECISIONS = Counter("router_decisions_total", "Routing outcomes of the router node.", ["agent", "tier"])
+
+STAGE_LATENCY = Histogram(
+    "graph_stage_latency_seconds",
+    "Time spent per stage (image_decode, template, prefill, decode, json_parse) inside a node.",
+    ["node", "stage"],
+    buckets=LATENCY_BUCKETS,
+)
+PROMPT_TOKENS = Counter("model_prompt_tokens_total", "Prompt tokens processed.", ["node"])
+GENERATED_TOKENS = Counter("model_generated_tokens_total", "Tokens generated.", ["node"])
+JSON_PARSE = Counter(
+    "json_parse_total",
+    "Agent output parsing outcomes: valid, cleaned (clean_json_response fixed it), "
+    "recovered (partial objects salvaged) or failed.",
+    ["node", "outcome"],
+)
+
+# Seconds from process start until the app could accept connections ("listen") and until warm ("ready")
+STARTUP_SECONDS = Gauge("startup_seconds", "Time from process start to each startup phase.", ["phase"])
+MODEL_LOAD_SECONDS = Gauge("model_load_seconds", "Time taken to load each model spec.", ["model"])
+QUEUE_WAIT = Histogram(
+    "queue_wait_seconds", "Time a job waited in a queue before a worker started it.", ["pool"], buckets=LATENCY_BUCKETS
+)
+SPECULATIVE_DRAFTED = Counter("speculative_drafted_tokens_total", "Tokens proposed by the draft model.", ["agent"])
+SPECULATIVE_ACCEPTED = Counter("speculative_accepted_tokens_total", "Draft tokens the target model accepted.", ["agent"])
+SPECULATIVE_ACCEPTANCE = Gauge("speculative_acceptance_rate", "Draft acceptance rate over the recent window.", ["agent"])
+SPECULATIVE_FALLBACKS = Counter(
+    "speculative_fallbacks_total", "Times an agent switched to normal decoding for low draft acceptance.", ["agent"]
+)
+WORK_CANCELLED = Counter(
+    "work_cancelled_total",
+    "Work stopped before finishing: reason is disconnected (client went away), deadline "
+    "(deadline passed while running) or shed (skipped because the deadline could not be met).",
+    ["node", "reason"],
+)
+GENERATIONS_SHORTENED = Counter(
+    "generations_shortened_total", "Generations whose max_tokens was cut to fit the request deadline.", ["node"]
+)
+COALESCED_REQUESTS = Counter(
+    "coalesced_requests_total", "Requests that attached to an identical request in flight instead of starting their own.", ["endpoint"]
+)
+WORKER_IN_FLIGHT = Gauge("serving_worker_in_flight", "Calls running on each inference worker process.", ["worker"])
+WORKER_RESTARTS = Counter("serving_worker_restarts_total", "Inference worker processes restarted after exiting.", ["worker"])
+
+
+def current_node() -> str:
+    return _current_node.get()
+
+
+@contextmanager
+def observe_stage(stage: str):
+    """
+    Times the block as ``stage`` of the node running on this thread.
+    """
+    tic = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.labels(current_node(), stage).observe(time.perf_counter() - tic)
+
+
+def record_stage(stage: str, seconds: float):
+    STAGE_LATENCY.labels(current_node(), stage).observe(seconds)
+
+
+def record_generation(response, seconds: float):
+    """
+    Token counters and prefill/decode latency from a ``GenerationResult``.
+    Prefill and decode are split with the result's throughput figures when it
+    has them; otherwise the whole call counts as decode.
+    """
+    node = current_node()
+    prompt_tokens = getattr(response, "prompt_tokens", 0) or 0
+    generation_tokens = getattr(response, "generation_tokens", 0) or 0
+    PROMPT_TOKENS.labels(node).inc(prompt_tokens)
+    GENERATED_TOKENS.labels(node).inc(generation_tokens)
+
+    prompt_tps = getattr(response, "prompt_tps", 0) or 0
+    generation_tps = getattr(response, "generation_tps", 0) or 0
+    if prompt_tps and generation_tps:
+        STAGE_LATENCY.labels(node, "prefill").observe(prompt_tokens / prompt_tps)
+        STAGE_LATENCY.labels(node, "decode").observe(generation_tokens / generation_tps)
+    else:
+        STAGE_LATENCY.labels(node, "decode").observe(seconds)
+
+
+def record_json_parse(outcome: str):
+    JSON_PARSE.labels(current_node(), outcome).inc()
+
+
+def instrumented_node(name: str, fn: Callable[[State], Any]) -> Callable[[State], Any]:
+    """
+    Wraps a graph node with request, error, cancellation and latency metrics,
+    and labels the stage and token metrics recorded while it runs with ``name``.
+    """
+
+    def run(state: State):
+        NODE_REQUESTS.labels(name).inc()
+        token = _current_node.set(name)
+        tic = time.perf_counter()
+        try:
+            output = fn(state)
+        except Exception as e:
+            # Imported here: the deadline module builds on these metrics
+            from app.utils.deadline import RequestCancelled
+
+            if isinstance(e, RequestCancelled):
+                WORK_CANCELLED.labels(name, e.reason).inc()
+            else:
+                NODE_ERRORS.labels(name).inc()
+            raise
+        finally:
+            NODE_LATENCY.labels(name).observe(time.perf_counter() - tic)
+            _current_node.reset(token)
+
+        error = output.get("error") if isinstance(output, dict) else getattr(output, "error", None)
+        if error:
+            NODE_ERRORS.labels(name).inc()
+        routing = output.get("routing") if isinstance(output, dict) else getattr(output, "routing", None)
+        if name == "router" and routing is not None:
+            routing = routing if isinstance(routing, dict) else routing.model_dump()
+            agent = "+".join(routing["agents"]) if routing.get("agents") else routing["agent"]
+            ROUTING_DECISIONS.labels(agent, routing["tier"]).inc()
+        return output
+
+    return run
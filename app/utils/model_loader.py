@@ -1,20 +1,273 @@
-from mlx_vlm import load
-from mlx_vlm.utils import load_config
+import gc
+import importlib
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional
 from app.config.config import config
 from app.utils.logger import get_logger
+from app.utils.metrics import MODEL_LOAD_SECONDS, observe_stage
 
 logger = get_logger(__name__)
 
-_model = None
-_processor = None
-_config = None
+# Short names accepted by MODEL_BACKEND and model specs besides repo ids and "package.module:Class"
+BACKENDS = {
+    "stub": "app.utils.stub_model:StubModel",
+}
+
+# Model spec prefix for a text-only mlx_lm model
+TEXT_MODEL_PREFIX = "lm:"
+
+
+class ModelBackend:
+    """
+    Interface for a model that is not loaded through ``mlx_vlm``.
+
+    A backend is returned by ``load_medgemma_model`` in place of the model and
+    the processor, and the agents' calls to ``apply_chat_template`` and
+    ``generate_response`` are routed to it. Set ``MODEL_BACKEND`` to
+    ``"package.module:Class"`` to plug one in.
+    """
+
+    config: Any = None
+    # Bytes held by the backend's weights, counted against MODEL_MEMORY_BUDGET_GB
+    memory_bytes: int = 0
+
+    def format_prompt(self, prompt: str, num_images: int = 0) -> str:
+        raise NotImplementedError
+
+    def generate(self, formatted_prompt: str, image: Optional[Any] = None, **kwargs):
+        """
+        Returns an object with the fields of ``mlx_vlm``'s ``GenerationResult``
+        (``text``, ``prompt_tokens``, ``generation_tokens``, ...).
+        """
+        raise NotImplementedError
+
+
+def _load_backend(name: str) -> ModelBackend:
+    module_name, _, attr = BACKENDS.get(name, name).partition(":")
+    backend = getattr(importlib.import_module(module_name), attr)()
+    if not isinstance(backend, ModelBackend):
+        raise TypeError(f"{name} is not a ModelBackend")
+    return backend
+
+
+def parameter_bytes(model) -> int:
+    """
+    Memory held by an mlx model's parameters.
+    """
+    from mlx.utils import tree_flatten
+
+    return sum(value.nbytes for _, value in tree_flatten(model.parameters()))
+
+
+def load_model_spec(spec: str) -> tuple:
+    """
+    Loads the model a spec names:
+
+    - ``"<repo id>"``: a multimodal model with ``mlx_vlm`` (e.g. MedGemma)
+    - ``"lm:<repo id>"``: a text-only model with ``mlx_lm``
+    - ``"stub"`` or ``"package.module:Class"``: a ``ModelBackend``
+
+    Returns:
+        tuple: ``(model, processor, config)``; a backend fills all three.
+    """
+    if spec.startswith(TEXT_MODEL_PREFIX):
+        from app.utils.text_backend import MlxLMModel
+
+        backend = MlxLMModel(spec[len(TEXT_MODEL_PREFIX):])
+        return backend, backend, backend.config
+    if spec in BACKENDS or ":" in spec:
+        backend = _load_backend(spec)
+        return backend, backend, backend.config
+
+    from mlx_vlm import load
+    from mlx_vlm.utils import load_config
+
+    model, processor = load(spec)
+    return model, processor, load_config(spec)
+
+
+class _LoadedModel:
+    __slots__ = ("spec", "model", "processor", "config", "bytes", "loaded_at")
+
+    def __init__(self, spec, model, processor, model_config, size):
+        self.spec = spec
+        self.model = model
+        self.processor = processor
+        self.config = model_config
+        self.bytes = size
+        self.loaded_at = time.time()
+
+
+class ModelRegistry:
+    """
+    Loaded models keyed by spec (see ``load_model_spec``). Agents that name the
+    same spec share one copy of the weights. When ``budget_bytes`` is set, the
+    least recently used models are unloaded to keep the total under it; a
+    model's size from an earlier load is used to make room before reloading
+    it. Eviction listeners drop per-model state (batchers, prefix caches) so
+    the weights can actually be freed.
+
+    Args:
+        budget_bytes (int): Total parameter memory allowed, 0 for no limit.
+    """
+
+    def __init__(self, budget_bytes: int = 0):
+        self.budget_bytes = budget_bytes
+        self._models: "OrderedDict[str, _LoadedModel]" = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        # Loads are serialized; lookups of loaded models do not wait for them
+        self._load_lock = threading.Lock()
+        self._listeners: List[Callable[[Any], None]] = []
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+
+    def on_evict(self, listener: Callable[[Any], None]):
+        """Registers ``listener(model)``, called after a model is unloaded."""
+        self._listeners.append(listener)
+
+    def _lookup(self, spec: str) -> Optional[tuple]:
+        with self._lock:
+            entry = self._models.get(spec)
+            if entry is None:
+                return None
+            self._models.move_to_end(spec)
+            self.hits += 1
+            return entry.model, entry.processor, entry.config
+
+    def get(self, spec: str) -> tuple:
+        """
+        Returns ``(model, processor, config)`` for ``spec``, loading it (and
+        evicting others to fit the budget) on first use.
+        """
+        found = self._lookup(spec)
+        if found is not None:
+            return found
+
+        with self._load_lock:
+            found = self._lookup(spec)
+            if found is not None:
+                return found
+            self._make_room(self._sizes.get(spec, 0))
+
+            logger.info("Loading model %s...", spec)
+            tic = time.perf_counter()
+            model, processor, model_config = load_model_spec(spec)
+            seconds = time.perf_counter() - tic
+            size = model.memory_bytes if isinstance(model, ModelBackend) else parameter_bytes(model)
+            MODEL_LOAD_SECONDS.labels(spec).set(seconds)
+            logger.info("Loaded model %s (%.2f GiB) in %.1fs", spec, size / 2**30, seconds)
+
+            with self._lock:
+                self._models[spec] = _LoadedModel(spec, model, processor, model_config, size)
+                self._sizes[spec] = size
+                self.loads += 1
+            self._make_room(0, keep=spec)
+            return model, processor, model_config
+
+    def _make_room(self, needed: int, keep: Optional[str] = None):
+        if not self.budget_bytes:
+            return
+        evicted = []
+        with self._lock:
+            total = sum(entry.bytes for entry in self._models.values())
+            for spec in list(self._models):
+                if total + needed <= self.budget_bytes:
+                    break
+                # Unloading a model that holds no memory would not make room
+                if spec == keep or not self._models[spec].bytes:
+                    continue
+                entry = self._models.pop(spec)
+                total -= entry.bytes
+                evicted.append(entry)
+                self.evictions += 1
+            if total + needed > self.budget_bytes:
+                logger.warning(
+                    "Models need %.2f GiB, over the %.2f GiB budget",
+                    (total + needed) / 2**30,
+                    self.budget_bytes / 2**30,
+                )
+        for entry in evicted:
+            self._release(entry)
+
+    def _release(self, entry: _LoadedModel):
+        logger.info("Unloading model %s (least recently used)", entry.spec)
+        for listener in self._listeners:
+            listener(entry.model)
+        # Requests already holding the model keep it alive until they finish
+        entry.model = entry.processor = entry.config = None
+        gc.collect()
+        if "mlx.core" in sys.modules:
+            sys.modules["mlx.core"].clear_cache()
+
+    def evict(self, spec: str) -> bool:
+        with self._lock:
+            entry = self._models.pop(spec, None)
+        if entry is None:
+            return False
+        self._release(entry)
+        return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "budget_gib": round(self.budget_bytes / 2**30, 2) if self.budget_bytes else None,
+                "loaded": {
+                    spec: {"gib": round(entry.bytes / 2**30, 3), "agents": agents_using(spec)}
+                    for spec, entry in self._models.items()
+                },
+                "total_gib": round(sum(entry.bytes for entry in self._models.values()) / 2**30, 3),
+                "hits": self.hits,
+                "loads": self.loads,
+                "evictions": self.evictions,
+            }
+
+
+def agents_using(spec: str) -> List[str]:
+    return [agent for agent in config.MODEL_AGENTS if config.model_for(agent) == spec]
+
+
+model_registry = ModelRegistry(int(config.MODEL_MEMORY_BUDGET_GB * 2**30))
+
+
+def load_agent_model(agent: str) -> tuple:
+    """
+    ``(model, processor, config)`` of the model ``agent`` runs on (see
+    ``config.model_for``).
+    """
+    return model_registry.get(config.model_for(agent))
+
 
 def load_medgemma_model():
-    global _model, _processor, _config
+    """
+    The default model (``config.default_model()``), for callers not tied to an agent.
+    """
+    return model_registry.get(config.default_model())
+
+
+def apply_chat_template(processor, model_config, prompt: str, num_images: int = 0) -> str:
+    """
+    Applies the loaded model's chat template (``mlx_vlm``'s, unless a
+    ``ModelBackend`` is plugged in).
+    """
+    with observe_stage("template"):
+        if isinstance(processor, ModelBackend):
+            return processor.format_prompt(prompt, num_images=num_images)
+        from mlx_vlm.prompt_utils import apply_chat_template as mlx_apply_chat_template
+
+        return mlx_apply_chat_template(processor, model_config, prompt, num_images=num_images)
 
-    if _model is None or _processor is None:
-        logger.info("[INFO] Loading {config.MODEL_ID}...")
-        _model, _processor = load(config.MODEL_ID)
-        _config = load_config(config.MODEL_ID)
 
-    return _model, _processor, _config
+def count_tokens(processor, text: str) -> int:
+    """
+    Number of tokens ``text`` encodes to with the loaded model's tokenizer;
+    whitespace-separated words for a backend without one.
+    """
+    tokenizer = getattr(processor, "tokenizer", processor)
+    if hasattr(tokenizer, "encode"):
+        return len(tokenizer.encode(text, add_special_tokens=False))
+    return len(text.split())
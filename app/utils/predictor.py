@@ -1,24 +1,362 @@
-from mlx_lm import generate
-from app.utils.logger import get_logger
+import threading
+import time
+from contextlib import contextmanager
+from typing import TYPE_CHECKING, Callable, List, Optional
+
+from app.config.config import config
+from app.utils.batcher import GenerationBatcher, GenerationRequest
+from app.utils.constrained_decoding import JSONLogitsProcessor, JSONSchema
+from app.utils.deadline import (
+    RequestCancelled, cancellation_scope, check_cancelled, current_cancellation, decode_rate, fit_max_tokens
+)
+from app.utils.metrics import record_generation
+from app.utils.model_loader import ModelBackend, model_registry
+from app.utils.logger import get_logger, payload_summary
+
+if TYPE_CHECKING:
+    from mlx_vlm.generate import GenerationResult
 
 logger = get_logger(__name__)
 
-def generate_response(model, processor, formatted_prompt, image):
+DEFAULT_MAX_TOKENS = 256
+
+_batchers = {}
+_batchers_lock = threading.Lock()
+# Serializes generation on a model when batching is off (keyed like _batchers)
+_model_locks = {}
+
+_recorder = threading.local()
+
+
+class _NotBatchable(Exception):
+    """Raised when a group of requests cannot share one batched decode."""
+
+
+def generate_response(model, processor, formatted_prompt, image, **kwargs):
     """
     Generate response using the MedGemma model.
-    
+
     Args:
         model: The loaded MedGemma model.
         processor: The processor for the model.
-        messages: The input messages for the model.
-    
+        formatted_prompt: The prompt with the chat template applied.
+        image: The image (or list of images) passed with the prompt, or None for
+            a text-only prompt (formatted with ``num_images=0``).
+        **kwargs: Extra generation options, e.g. ``max_tokens``, ``agent`` to
+            resume from that agent's cached prompt prefix, ``on_chunk`` to
+            receive each decoded text segment as it is produced, or
+            ``json_schema`` (a ``JSONSchema``) to only decode JSON matching it.
+            ``max_tokens`` is cut to what fits before the request's deadline.
+
     Returns:
-        str: The generated response.
+        GenerationResult: The generated response.
+
+    Raises:
+        RequestCancelled: If the request is cancelled while it decodes.
     """
-    logger.info("Generating response with prompt: %s", formatted_prompt)
-    response = generate(model, processor, formatted_prompt, image)
-    logger.info("Model outputs: %s", response)
+    logger.debug("Generating response with prompt: %s", payload_summary(formatted_prompt))
+    agent = kwargs.get("agent")
+    max_tokens = kwargs.get("max_tokens", DEFAULT_MAX_TOKENS)
+    fitted = fit_max_tokens(agent, max_tokens)
+    if fitted < max_tokens:
+        kwargs["max_tokens"] = fitted
+    tic = time.perf_counter()
+    if isinstance(model, ModelBackend):
+        response = model.generate(formatted_prompt, image, **kwargs)
+    elif config.BATCHING_ENABLED:
+        response = get_batcher(model, processor).submit(formatted_prompt, image, **kwargs)
+    else:
+        with _model_lock(model):
+            response = _generate_single(model, processor, formatted_prompt, image, **kwargs)
+    logger.debug("Model outputs: %s", payload_summary(response))
+    elapsed = time.perf_counter() - tic
+    record_generation(response, elapsed)
+    generation_tokens = getattr(response, "generation_tokens", 0) or 0
+    if agent and generation_tokens:
+        decode_rate.observe(agent, getattr(response, "generation_tps", 0) or generation_tokens / elapsed)
+
+    records = getattr(_recorder, "records", None)
+    if records is not None:
+        records.append({
+            "agent": kwargs.get("agent"),
+            "prompt_tokens": response.prompt_tokens,
+            "generation_tokens": response.generation_tokens,
+            "seconds": elapsed,
+        })
     return response
 
 
+@contextmanager
+def record_generations():
+    """
+    Collects token counts and latency of every ``generate_response`` call made
+    by the current thread inside the block.
+
+    Yields:
+        list: One dict per generation (``agent``, ``prompt_tokens``,
+            ``generation_tokens``, ``seconds``).
+    """
+    records = []
+    _recorder.records = records
+    try:
+        yield records
+    finally:
+        _recorder.records = None
+
+
+def get_batcher(model, processor) -> GenerationBatcher:
+    """
+    Returns the batcher that owns ``model``, creating it on first use.
+    """
+    key = id(model)
+    with _batchers_lock:
+        if key not in _batchers:
+            _batchers[key] = GenerationBatcher(
+                run_batch=lambda requests: _run_batch(model, processor, requests),
+                max_batch_size=config.BATCH_MAX_SIZE,
+                window_ms=config.BATCH_WINDOW_MS,
+            )
+        return _batchers[key]
+
+
+def _model_lock(model) -> threading.Lock:
+    with _batchers_lock:
+        return _model_locks.setdefault(id(model), threading.Lock())
+
+
+def _drop_batcher(model):
+    with _batchers_lock:
+        batcher = _batchers.pop(id(model), None)
+        _model_locks.pop(id(model), None)
+    if batcher is not None:
+        batcher.close()
+
+
+model_registry.on_evict(_drop_batcher)
+
+
+def _generate_single(model, processor, formatted_prompt, image, agent=None, on_chunk=None, json_schema=None, **kwargs):
+    from mlx_vlm import generate
+    from app.utils.text_model import generate_text
+
+    if json_schema is not None and _can_constrain(model, image):
+        kwargs["logits_processors"] = [json_processor(processor, json_schema)]
+        return generate_text(model, processor, formatted_prompt, image=image, agent=agent, on_chunk=on_chunk, **kwargs)
+    if not image and config.TEXT_ONLY_ENABLED:
+        return generate_text(model, processor, formatted_prompt, agent=agent, on_chunk=on_chunk, **kwargs)
+    # Only the streaming loop can stop between tokens
+    if on_chunk is None and current_cancellation() is None:
+        return generate(model, processor, formatted_prompt, image, **kwargs)
+    return _stream_vlm(model, processor, formatted_prompt, image, on_chunk, **kwargs)
+
+
+def _can_constrain(model, image) -> bool:
+    # Constrained decoding runs through mlx_lm; image prompts need the VLM to embed them
+    return config.CONSTRAINED_DECODING_ENABLED and (not image or hasattr(model, "get_input_embeddings"))
+
+
+def json_processor(processor, schema: JSONSchema) -> JSONLogitsProcessor:
+    """
+    A fresh logits processor enforcing ``schema`` for one generation.
+    """
+    tokenizer = processor.tokenizer if hasattr(processor, "tokenizer") else processor
+    return JSONLogitsProcessor(schema, tokenizer, _eos_token_ids(processor))
+
+
+def _stream_vlm(model, processor, formatted_prompt, image, on_chunk: Optional[Callable[[str], None]], **kwargs):
+    """
+    Same as ``mlx_vlm.generate`` but hands every decoded segment to ``on_chunk``
+    and stops once the request is cancelled.
+    """
+    from mlx_vlm import stream_generate
+    from mlx_vlm.generate import GenerationResult
+
+    tokenizer = processor.tokenizer if hasattr(processor, "tokenizer") else processor
+    tokenizer.stopping_criteria.reset(model.config.eos_token_id)
+
+    text = ""
+    response = None
+    for response in stream_generate(model, processor, formatted_prompt, image, **kwargs):
+        check_cancelled()
+        text += response.text
+        if on_chunk is not None and response.text:
+            on_chunk(response.text)
+
+    if response is None:
+        return GenerationResult(text="")
+    return GenerationResult(
+        text=text,
+        prompt_tokens=response.prompt_tokens,
+        generation_tokens=response.generation_tokens,
+        total_tokens=response.total_tokens,
+        prompt_tps=response.prompt_tps,
+        generation_tps=response.generation_tps,
+        peak_memory=response.peak_memory,
+    )
+
+
+def batcher_stats() -> list:
+    with _batchers_lock:
+        return [batcher.stats() for batcher in _batchers.values()]
+
+
+def _run_batch(model, processor, requests: List[GenerationRequest]) -> list:
+    """
+    Runs a micro-batch collected by the batcher. Requests with the same
+    generation options are decoded together; anything that cannot be batched
+    (single request, prompt too long for the sliding window, unsupported
+    model) is generated one at a time. Requests cancelled while they waited
+    are not generated.
+    """
+    results = [None] * len(requests)
+    groups = {}
+    for i, request in enumerate(requests):
+        if request.cancellation is not None and request.cancellation.cancelled:
+            results[i] = RequestCancelled(request.cancellation.reason)
+            continue
+        key = (not request.image, tuple(sorted(request.kwargs.items())))
+        groups.setdefault(key, []).append(i)
+
+    for indices in groups.values():
+        group = [requests[i] for i in indices]
+        # Streaming requests need per-token callbacks, which the batched decode does not drive
+        if len(group) > 1 and "on_chunk" not in group[0].kwargs:
+            try:
+                for i, result in zip(indices, _batched_generate(model, processor, group)):
+                    results[i] = result
+                continue
+            except _NotBatchable as e:
+                logger.info("Falling back to sequential generation: %s", e)
+            except Exception as e:
+                logger.error("Batched generation failed, falling back to sequential: %s", e)
+
+        for i, request in zip(indices, group):
+            try:
+                # Runs in the submitter's cancellation, so its decode loop can stop
+                with cancellation_scope(request.cancellation):
+                    results[i] = _generate_single(model, processor, request.prompt, request.image, **request.kwargs)
+            except Exception as e:
+                results[i] = e
+    return results
+
+
+def _eos_token_ids(processor) -> set:
+    tokenizer = processor.tokenizer if hasattr(processor, "tokenizer") else processor
+    criteria = getattr(tokenizer, "stopping_criteria", None)
+    if criteria is not None:
+        return set(criteria.eos_token_ids)
+    return {tokenizer.eos_token_id}
+
+
+def _batched_generate(model, processor, requests: List[GenerationRequest]) -> List["GenerationResult"]:
+    """
+    Greedy batched prefill/decode over the language model.
+
+    Prompts are left-padded to a common length and an explicit attention mask
+    hides the padding, so every row decodes exactly as it would alone. The
+    padded batch must fit the model's sliding window, otherwise rotating KV
+    caches would reorder keys under the mask. A row whose request is cancelled
+    stops decoding and gets ``RequestCancelled`` as its result.
+    """
+    import mlx.core as mx
+    from mlx_vlm.generate import GenerationResult
+    from mlx_vlm.utils import prepare_inputs
+
+    if not hasattr(model, "get_input_embeddings"):
+        raise _NotBatchable(f"{type(model).__name__} does not expose get_input_embeddings")
+
+    max_tokens = requests[0].kwargs.get("max_tokens", DEFAULT_MAX_TOKENS)
+    # "agent" only selects a prefix cache; a batched prefill does not use one
+    if set(requests[0].kwargs) - {"max_tokens", "agent", "json_schema"}:
+        raise _NotBatchable(f"unsupported options {sorted(requests[0].kwargs)}")
+    schema = requests[0].kwargs.get("json_schema") if config.CONSTRAINED_DECODING_ENABLED else None
+
+    tokenizer = processor.tokenizer if hasattr(processor, "tokenizer") else processor
+    image_token_index = getattr(model.config, "image_token_index", None)
+
+    token_ids, pixel_values = [], []
+    for request in requests:
+        inputs = prepare_inputs(
+            processor,
+            images=request.image,
+            prompts=request.prompt,
+            image_token_index=image_token_index,
+        )
+        token_ids.append(inputs["input_ids"].reshape(-1))
+        # Text-only requests carry no pixel values and skip the vision tower
+        if inputs.get("pixel_values") is not None:
+            pixel_values.append(inputs["pixel_values"])
+
+    lengths = [ids.size for ids in token_ids]
+    length = max(lengths)
+    lm = model.language_model
+    window = getattr(lm.config, "sliding_window", None)
+    if window and length + max_tokens > window:
+        raise _NotBatchable(f"{length} prompt + {max_tokens} new tokens exceeds sliding window {window}")
+
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+    input_ids = mx.stack([
+        mx.concatenate([mx.full((length - n,), pad_id, dtype=ids.dtype), ids])
+        for ids, n in zip(token_ids, lengths)
+    ])
+    valid = mx.arange(length)[None, :] >= mx.array([length - n for n in lengths])[:, None]
+    embeddings, _ = model.get_input_embeddings(
+        input_ids,
+        mx.concatenate(pixel_values, axis=0) if pixel_values else None,
+        valid.astype(mx.int32),
+    )
+
+    # Causal mask restricted to real tokens; the diagonal keeps padded query rows finite
+    keep = mx.tril(mx.ones((length, length), dtype=mx.bool_))[None] & valid[:, None, :]
+    keep = keep | mx.eye(length, dtype=mx.bool_)[None]
+    mask = mx.where(keep[:, None], 0.0, float("-inf")).astype(embeddings.dtype)
+
+    tic = time.perf_counter()
+    cache = lm.make_cache()
+    logits = lm(input_ids, inputs_embeds=embeddings, mask=mask, cache=cache).logits[:, -1, :]
+    mx.eval(logits)
+    prefill_seconds = time.perf_counter() - tic
+
+    eos_ids = _eos_token_ids(processor)
+    batch_size = len(requests)
+    outputs = [[] for _ in range(batch_size)]
+    finished = [False] * batch_size
+    cancellations = [request.cancellation for request in requests]
+    stopped = [False] * batch_size
+    processors = [json_processor(processor, schema) for _ in requests] if schema is not None else None
+    for step in range(max_tokens):
+        if processors is not None:
+            # Each row follows its own grammar state; finished rows are forced to EOS
+            logits = mx.concatenate([
+                p(mx.array(outputs[i], dtype=mx.int32), logits[i:i + 1]) for i, p in enumerate(processors)
+            ], axis=0)
+        next_tokens = mx.argmax(logits, axis=-1)
+        for i, token in enumerate(next_tokens.tolist()):
+            if finished[i]:
+                continue
+            if cancellations[i] is not None and cancellations[i].cancelled:
+                finished[i] = stopped[i] = True
+            elif token in eos_ids:
+                finished[i] = True
+            else:
+                outputs[i].append(token)
+        if all(finished) or step == max_tokens - 1:
+            break
+        valid = mx.concatenate([valid, mx.ones((batch_size, 1), dtype=mx.bool_)], axis=1)
+        mask = mx.where(valid[:, None, None, :], 0.0, float("-inf")).astype(embeddings.dtype)
+        logits = lm(next_tokens[:, None], mask=mask, cache=cache).logits[:, -1, :]
 
+    mx.clear_cache()
+    decode_seconds = time.perf_counter() - tic - prefill_seconds
+    # The batch shares one prefill and one decode loop; rates are per row over that time
+    return [
+        RequestCancelled(cancellation.reason) if cancelled else GenerationResult(
+            text=tokenizer.decode(tokens),
+            prompt_tokens=n,
+            generation_tokens=len(tokens),
+            total_tokens=n + len(tokens),
+            prompt_tps=n / prefill_seconds if prefill_seconds else 0.0,
+            generation_tps=len(tokens) / decode_seconds if decode_seconds and tokens else 0.0,
+        )
+        for tokens, n, cancellation, cancelled in zip(outputs, lengths, cancellations, stopped)
+    ]
@@ -1,25 +1,13 @@
 from PIL import Image
-import numpy as np
+import hashlib
 from typing import Optional, List, Any
-from mlx_vlm.prompt_utils import apply_chat_template
 from app.utils.logger import get_logger
 
 logger = get_logger(__name__)
 
-def build_router_prompt(note: Optional[str], image: Optional[Image]) -> List:
-    """
-    Builds the prompt for the RouterAgent based on the provided note and image.
-    
-    Args:
-        note (Optional[str]): The clinical note to analyze.
-        image (Optional[Image]): The image to analyze.
-    
-    Returns:
-        List: A list of messages formatted for the model input.
-    """
-    logger.info(f"Building router prompt with note: {note} and image: {image}")
-    image = Image.fromarray(np.zeros((224, 224, 3), dtype=np.uint8)) if image is None else image
-    prompt = f"""
+# Static instruction blocks. Each prompt is its agent's block followed by the
+# per-request input, so the block can be prefilled once and reused.
+ROUTER_INSTRUCTIONS = """
         You are a medical routing agent. Your task is to analyze the provided imputs
         and determine the appropriate next step for processing the input. 
         If there is a textual input, it can be a clinical note or a transcript.
@@ -34,26 +22,9 @@ def build_router_prompt(note: Optional[str], image: Optional[Image]) -> List:
         If the input is a medical image, route it to the ImageAnalyzerAgent.
         ONLY respond with one of: "icd10", "soap", "image_analysis.
         
-        Here is the input you need to analyze:
-        text: {note}
-        image: {image if image else "No image provided"}"""
-
-    return prompt
-
-
+"""
 
-def build_icd10_prompt(clinical_note: str, image: Optional[Image]) -> list:
-    """
-    Builds the prompt for the ICD-10 coding agent based on the clinical note.
-    
-    Args:
-        clinical_note (str): The clinical note to analyze.
-    
-    Returns:
-        list: A list of messages formatted for the model input.
-    """
-    image = Image.fromarray(np.zeros((224, 224, 3), dtype=np.uint8)) if image is None else image
-    prompt = f"""
+ICD10_INSTRUCTIONS = """
     You are an expert clinical coder. Extract ICD-10 codes from the note below.
 
     Instructions:
@@ -64,35 +35,24 @@ def build_icd10_prompt(clinical_note: str, image: Optional[Image]) -> list:
     - Return ONLY valid JSON: an array of objects with double quotes for all keys and values
     - Do not include markdown, code fences, extra text, or repeated codes
     - If unsure, omit rather than guessing
+    - When candidate codes are listed after the note, choose only from them
 
     Example:
     [
-    {{"code": "K35.80", "description": "Acute appendicitis, unspecified"}},
-    {{"code": "R10.9", "description": "Abdominal pain, unspecified"}},
-    {{"code": "R11.0", "description": "Nausea"}}
+    {"code": "K35.80", "description": "Acute appendicitis, unspecified"},
+    {"code": "R10.9", "description": "Abdominal pain, unspecified"},
+    {"code": "R11.0", "description": "Nausea"}
     ]
 
-    Clinical note:
-    {clinical_note}
-    Image: {image if image else "No image provided"}
-    """
-    return prompt
+"""
 
-def build_image_analyzer_prompt(image: Image, question: str = None) -> list:
-    """
-    Builds the prompt for the image analyzer agent based on the provided image.
-    
-    Args:
-        image (Image): The image to analyze.
-    
-    Returns:
-        list: A list of messages formatted for the model input.
-    """
-    prompt = f"""
+IMAGE_ANALYZER_INSTRUCTIONS = """
         You are an expert radiologist and you are provided with an image of a medical condition.
         Analyze the image and provide a detailed description of the findings,
         including any abnormalities or notable features. If the user provides any question about the image,
-        answer it based on the image content.
+        answer it based on the image content. When technique details from the DICOM header are listed,
+        use them for the technique field instead of inferring them from the image. A grid of several
+        panels is a montage of slices from one series.
 
         Given the findings from a medical image, generate a structured radiology report in JSON format with the following fields:
 
@@ -113,25 +73,9 @@ def build_image_analyzer_prompt(image: Image, question: str = None) -> list:
         "recommendations": "Clinical correlation recommended.",
         "answer_to_user_question": "The image shows no signs of acute stroke."
     
-    Here is the image you need to analyze:
-        {image if image else "No image provided."}
-        Question: {question if question else "No specific question provided."}
-
-    """
-    return prompt
+"""
 
-def build_soap_generator_prompt(transcript: str, image: Optional[Image]) -> list:
-    """
-    Builds the prompt for the SOAP note generator agent based on the clinical note.
-    
-    Args:
-        transcript (str): The transcript to analyze.
-    
-    Returns:
-        list: A list of messages formatted for the model input.
-    """
-    image = Image.fromarray(np.zeros((224, 224, 3), dtype=np.uint8)) if image is None else image
-    prompt = f"""
+SOAP_INSTRUCTIONS = """
     You are a clinical documentation assistant. Your task is to read medical 
     transcripts (dialogues between clinicians and patients) and convert them 
     into structured clinical notes using the SOAP format.
@@ -167,12 +111,12 @@ def build_soap_generator_prompt(transcript: str, image: Optional[Image]) -> list
 
     You shoud return a JSON object with exactly the following fields:
 
-    {{
+    {
     "Subjective": "...",
     "Objective": "...",
     "Assessment": "...",
     "Plan": "..."
-    }}
+    }
 
     Each field should contain a concise summary relevant to that section.
 
@@ -181,8 +125,230 @@ def build_soap_generator_prompt(transcript: str, image: Optional[Image]) -> list
     Here is the transcript from a medical record file from which you will be
     asked to extract relevant SOAP information:
 
-    {transcript}
-    Image: {image if image else "No image provided."}
+"""
+
+SOAP_MAP_INSTRUCTIONS = """
+    You are a clinical documentation assistant. You will be given one excerpt
+    of a long medical transcript (a dialogue between clinicians and patients).
+    Neighbouring excerpts overlap by a few lines.
+
+    List the clinical facts stated in this excerpt under the SOAP section they
+    belong to:
+
+    *Subjective*: symptoms, duration, history and complaints reported by the patient.
+    *Objective*: vital signs, exam findings, lab and imaging results.
+    *Assessment*: diagnoses or impressions stated by the clinician.
+    *Plan*: prescriptions, tests, referrals and follow-up instructions.
+
+    Each fact is one short sentence. Only include facts stated in the excerpt;
+    do not invent information and leave a section empty if nothing belongs in it.
+
+    Return only a JSON object with exactly the following fields:
+
+    {
+    "Subjective": ["..."],
+    "Objective": ["..."],
+    "Assessment": ["..."],
+    "Plan": ["..."]
+    }
+
+    Here is the excerpt:
+
+"""
+
+SOAP_REDUCE_INSTRUCTIONS = """
+    You are a clinical documentation assistant. The clinical facts below were
+    extracted, section by section, from consecutive parts of one long medical
+    transcript, in the order they were said. Write the SOAP note for the whole
+    encounter from them.
+
+    Merge facts that repeat or update each other (keep the latest value), drop
+    anything non-clinical, and do not invent information that is not listed.
+    Always use a bullet point format for each section of the SOAP note.
 
+    You shoud return a JSON object with exactly the following fields:
+
+    {
+    "Subjective": "...",
+    "Objective": "...",
+    "Assessment": "...",
+    "Plan": "..."
+    }
+
+    Return only valid JSON with double quotes and no extra text or markdown.
+
+    Here are the extracted facts:
+
+"""
+
+PROMPT_PREFIXES = {
+    "router": ROUTER_INSTRUCTIONS,
+    "icd10": ICD10_INSTRUCTIONS,
+    "image_analysis": IMAGE_ANALYZER_INSTRUCTIONS,
+    "soap": SOAP_INSTRUCTIONS,
+    "soap_map": SOAP_MAP_INSTRUCTIONS,
+    "soap_reduce": SOAP_REDUCE_INSTRUCTIONS,
+}
+
+def build_router_prompt(note: Optional[str], image: Optional[Image]) -> List:
     """
-    return prompt
\ No newline at end of file
+    Builds the prompt for the RouterAgent based on the provided note and image.
+    
+    Args:
+        note (Optional[str]): The clinical note to analyze.
+        image (Optional[Image]): The image to analyze.
+    
+    Returns:
+        List: A list of messages formatted for the model input.
+    """
+    prompt = ROUTER_INSTRUCTIONS + f"""        Here is the input you need to analyze:
+        text: {note if note else "No text provided"}
+        image: {"Attached" if image else "No image provided"}"""
+
+    return prompt
+
+
+
+def build_icd10_prompt(clinical_note: str, image: Optional[Image] = None, candidates: Optional[List[dict]] = None) -> list:
+    """
+    Builds the prompt for the ICD-10 coding agent based on the clinical note.
+    
+    Args:
+        clinical_note (str): The clinical note to analyze.
+        image (Optional[Image]): An image sent along with the note, if any.
+        candidates (Optional[List[dict]]): Retrieved ``{"code", "description"}``
+            shortlist the model should choose from.
+    
+    Returns:
+        list: A list of messages formatted for the model input.
+    """
+    prompt = ICD10_INSTRUCTIONS + f"""    Clinical note:
+    {clinical_note}
+    """
+    if candidates:
+        shortlist = "\n".join(f"    - {c['code']}: {c['description']}" for c in candidates)
+        prompt += f"""
+    Candidate codes:
+{shortlist}
+    """
+    return prompt
+
+def build_image_analyzer_prompt(image: Image, question: str = None, metadata: Optional[dict] = None) -> list:
+    """
+    Builds the prompt for the image analyzer agent based on the provided image.
+    
+    Args:
+        image (Image): The image to analyze.
+        question (str): The user's question about the image, if any.
+        metadata (Optional[dict]): Technique details read from a DICOM header.
+    
+    Returns:
+        list: A list of messages formatted for the model input.
+    """
+    technique = ""
+    if metadata:
+        lines = [
+            f"        - {label}: {_metadata_value(metadata[key])}\n"
+            for key, label in TECHNIQUE_LABELS.items() if key in metadata
+        ]
+        technique = "        Technique (from the DICOM header):\n" + "".join(lines)
+
+    prompt = IMAGE_ANALYZER_INSTRUCTIONS + f"""    Here is the image you need to analyze:
+        {"Attached" if image else "No image provided."}
+{technique}        Question: {question if question else "No specific question provided."}
+
+    """
+    return prompt
+
+
+# DICOM technique metadata keys (see ``technique_metadata``) and their prompt labels
+TECHNIQUE_LABELS = {
+    "modality": "Modality",
+    "body_part": "Body part",
+    "view": "View",
+    "laterality": "Laterality",
+    "study_description": "Study",
+    "series_description": "Series",
+    "contrast": "Contrast agent",
+    "frames": "Frames in series",
+    "frames_shown": "Frames shown in the montage",
+}
+
+
+def _metadata_value(value) -> str:
+    return ", ".join(str(v) for v in value) if isinstance(value, list) else str(value)
+
+def build_soap_generator_prompt(transcript: str, image: Optional[Image] = None) -> list:
+    """
+    Builds the prompt for the SOAP note generator agent based on the clinical note.
+    
+    Args:
+        transcript (str): The transcript to analyze.
+        image (Optional[Image]): An image sent along with the transcript, if any.
+    
+    Returns:
+        list: A list of messages formatted for the model input.
+    """
+    prompt = SOAP_INSTRUCTIONS + f"""    {transcript}
+
+    """
+    return prompt
+
+
+def build_soap_chunk_prompt(chunk: str) -> str:
+    """
+    Builds the prompt extracting S/O/A/P facts from one chunk of a long
+    transcript (the map step of long-transcript SOAP generation).
+
+    Args:
+        chunk (str): Consecutive speaker turns of the transcript.
+
+    Returns:
+        str: The prompt text.
+    """
+    return SOAP_MAP_INSTRUCTIONS + f"""    {chunk}
+
+    """
+
+
+def build_soap_reduce_prompt(facts: dict) -> str:
+    """
+    Builds the prompt writing the SOAP note from the facts extracted from
+    every chunk (the reduce step).
+
+    Args:
+        facts (dict): Section name -> list of deduplicated facts.
+
+    Returns:
+        str: The prompt text.
+    """
+    sections = []
+    for section in ("Subjective", "Objective", "Assessment", "Plan"):
+        lines = "\n".join(f"    - {fact}" for fact in facts.get(section, [])) or "    - Not documented."
+        sections.append(f"    {section}:\n{lines}")
+    return SOAP_REDUCE_INSTRUCTIONS + "\n\n".join(sections) + "\n\n    "
+
+
+def _template_version() -> str:
+    """
+    Hash of every prompt rendered for fixed placeholder inputs, so it changes
+    with any template text: the instruction blocks and the per-request parts
+    (note and candidate framing, DICOM technique lines, ...) alike.
+    """
+    metadata = {key: f"{{{key}}}" for key in TECHNIQUE_LABELS}
+    samples = [
+        build_router_prompt("{note}", True),
+        build_router_prompt(None, None),
+        build_icd10_prompt("{note}", candidates=[{"code": "{code}", "description": "{description}"}]),
+        build_icd10_prompt("{note}"),
+        build_image_analyzer_prompt(True, "{question}", metadata),
+        build_image_analyzer_prompt(None),
+        build_soap_generator_prompt("{transcript}"),
+        build_soap_chunk_prompt("{chunk}"),
+        build_soap_reduce_prompt({"Subjective": ["{fact}"]}),
+    ]
+    return hashlib.sha256("\x00".join(samples).encode("utf-8")).hexdigest()[:12]
+
+
+# Changes whenever any template text changes; used to invalidate cached prefixes and results
+PROMPT_TEMPLATE_VERSION = _template_version()
@@ -0,0 +1,131 @@
+import copy
+import threading
+from typing import List, Optional, Tuple
+
+from app.config.config import config
+from app.utils.logger import get_logger
+from app.utils.model_loader import model_registry
+from app.utils.prompt_builder import PROMPT_PREFIXES, PROMPT_TEMPLATE_VERSION
+
+logger = get_logger(__name__)
+
+# Marks where the per-request input starts once the chat template is applied
+_SENTINEL = "<<<PREFIX_CACHE_SENTINEL>>>"
+
+# Tokens dropped from the end of the prefix so a merge with the first input
+# token (e.g. trailing whitespace) never makes the cached prefix diverge
+_BOUNDARY_SLACK = 2
+
+
+class _PrefixEntry:
+    __slots__ = ("key", "tokens", "cache")
+
+    def __init__(self, key, tokens, cache):
+        self.key = key
+        self.tokens = tokens
+        self.cache = cache
+
+
+class PrefixCacheStore:
+    """
+    Holds one prefilled KV cache per agent for that agent's static instruction
+    block (see ``PROMPT_PREFIXES``). A request whose tokens start with the
+    cached prefix resumes from a copy of the cache and only prefills the rest.
+
+    Entries are keyed on the model id, the model instance and
+    ``PROMPT_TEMPLATE_VERSION``; a mismatch rebuilds the entry.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.builds = 0
+        self.prefill_tokens_saved = 0
+
+    def _key(self, model) -> tuple:
+        return (config.MODEL_ID, id(model), PROMPT_TEMPLATE_VERSION)
+
+    def _build(self, agent: str, model, processor) -> Optional[_PrefixEntry]:
+        # mlx is only imported once a prefix is built, so importing this module stays cheap
+        import mlx.core as mx
+        from mlx_lm.models.cache import make_prompt_cache
+        from mlx_vlm.prompt_utils import apply_chat_template
+        from app.utils.text_model import get_text_model, encode_prompt
+
+        formatted = apply_chat_template(processor, model.config, PROMPT_PREFIXES[agent] + _SENTINEL, num_images=0)
+        if _SENTINEL not in formatted:
+            return None
+        tokens = encode_prompt(processor, formatted[: formatted.index(_SENTINEL)])[:-_BOUNDARY_SLACK]
+        if not tokens:
+            return None
+
+        text_model = get_text_model(model)
+        cache = make_prompt_cache(text_model)
+        text_model(mx.array(tokens)[None], cache=cache)
+        mx.eval([c.state for c in cache])
+        self.builds += 1
+        logger.info("Prefilled %d prefix tokens for %s", len(tokens), agent)
+        return _PrefixEntry(self._key(model), tokens, cache)
+
+    def get(self, agent: str, model, processor) -> Optional[_PrefixEntry]:
+        """
+        Returns the prefilled entry for ``agent``, building it on first use or
+        after the model/template changed.
+        """
+        if agent not in PROMPT_PREFIXES:
+            return None
+        with self._lock:
+            entry = self._entries.get(agent)
+            if entry is None or entry.key != self._key(model):
+                entry = self._build(agent, model, processor)
+                self._entries[agent] = entry
+            return entry
+
+    def resume(self, agent: str, model, processor, tokens: List[int]) -> Tuple[Optional[list], List[int]]:
+        """
+        Splits ``tokens`` into a copy of the cached prefix state and the suffix
+        still to prefill. Returns ``(None, tokens)`` when the prompt does not
+        start with the cached prefix.
+        """
+        entry = self.get(agent, model, processor)
+        if entry is None or len(tokens) <= len(entry.tokens) or tokens[: len(entry.tokens)] != entry.tokens:
+            self.misses += 1
+            return None, tokens
+        self.hits += 1
+        self.prefill_tokens_saved += len(entry.tokens)
+        return copy.deepcopy(entry.cache), tokens[len(entry.tokens):]
+
+    def warm(self, model, processor, agents=("router", "icd10", "soap")):
+        """
+        Prefills the given agents' prefixes up front instead of on first use.
+        The image analyzer is left out: its prompt starts with image tokens.
+        """
+        for agent in agents:
+            self.get(agent, model, processor)
+
+    def clear(self):
+        with self._lock:
+            self._entries = {}
+
+    def drop_model(self, model):
+        """Drops the entries prefilled with ``model`` (e.g. after it was unloaded)."""
+        with self._lock:
+            self._entries = {
+                agent: e for agent, e in self._entries.items() if e is not None and e.key[1] != id(model)
+            }
+
+    def stats(self) -> dict:
+        return {
+            "template_version": PROMPT_TEMPLATE_VERSION,
+            "entries": {agent: len(e.tokens) for agent, e in self._entries.items() if e is not None},
+            "hits": self.hits,
+            "misses": self.misses,
+            "builds": self.builds,
+            "prefill_tokens_saved": self.prefill_tokens_saved,
+        }
+
+
+prefix_cache = PrefixCacheStore()
+model_registry.on_evict(prefix_cache.drop_model)
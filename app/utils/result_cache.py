@@ -0,0 +1,217 @@
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Callable, Optional
+
+from PIL import Image
+
+from app.config.config import config
+from app.graph.types import State, RoutingDecision
+from app.utils.logger import get_logger
+from app.utils.prompt_builder import PROMPT_TEMPLATE_VERSION
+
+logger = get_logger(__name__)
+
+
+def normalize_note(note: Optional[str]) -> str:
+    """
+    Canonical form of a note for hashing: NFC unicode, unified line endings,
+    collapsed runs of spaces/tabs, no trailing whitespace.
+    """
+    if not note:
+        return ""
+    note = unicodedata.normalize("NFC", note).replace("\r\n", "\n").replace("\r", "\n")
+    lines = [re.sub(r"[ \t]+", " ", line).strip() for line in note.split("\n")]
+    return "\n".join(lines).strip()
+
+
+def image_digest(image: Optional[Image.Image]) -> str:
+    """
+    Hash of the decoded pixels, so re-encoded copies of the same image match.
+    """
+    if image is None:
+        return ""
+    h = hashlib.sha256()
+    h.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode("ascii"))
+    h.update(image.tobytes())
+    return h.hexdigest()
+
+
+def input_fingerprint(payload: dict) -> str:
+    """
+    Fingerprint of the request input (normalized note + image pixels + DICOM
+    technique metadata), memoized in the payload so later nodes do not hash
+    the image again.
+    """
+    if "input_fingerprint" not in payload:
+        h = hashlib.sha256()
+        h.update(normalize_note(payload.get("note")).encode("utf-8"))
+        h.update(b"\x00")
+        h.update(image_digest(payload.get("image")).encode("ascii"))
+        if payload.get("image_metadata"):
+            h.update(json.dumps(payload["image_metadata"], sort_keys=True).encode("utf-8"))
+        payload["input_fingerprint"] = h.hexdigest()
+    return payload["input_fingerprint"]
+
+
+def result_cache_key(payload: dict, agent: str) -> str:
+    parts = [input_fingerprint(payload), agent, PROMPT_TEMPLATE_VERSION, config.model_for(agent)]
+    return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+def text_cache_key(text: str, step: str, agent: str) -> str:
+    """
+    Key of an intermediate result that depends only on ``text`` (e.g. the facts
+    extracted from one transcript chunk), produced by ``step`` with ``agent``'s model.
+    """
+    digest = hashlib.sha256(normalize_note(text).encode("utf-8")).hexdigest()
+    parts = [digest, step, PROMPT_TEMPLATE_VERSION, config.model_for(agent)]
+    return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Two-tier cache of node results: an in-memory LRU with entry and TTL limits,
+    backed by an optional SQLite file that survives restarts.
+
+    Args:
+        max_entries (int): Maximum entries kept in memory.
+        ttl_seconds (float): Lifetime of an entry in both tiers.
+        sqlite_path (Optional[str]): Path of the persistent tier; None disables it.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: float, sqlite_path: Optional[str] = None):
+        self.max_entries = max(1, max_entries)
+        self.ttl = ttl_seconds
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        if sqlite_path:
+            self._db = sqlite3.connect(sqlite_path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._db.execute("DELETE FROM results WHERE expires_at < ?", (time.time(),))
+            self._db.commit()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at >= now:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return json.loads(value)
+                del self._memory[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT value, expires_at FROM results WHERE key = ?", (key,)
+                ).fetchone()
+                if row is not None and row[1] >= now:
+                    self._remember(key, row[1], row[0])
+                    self.disk_hits += 1
+                    return json.loads(row[0])
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: dict):
+        expires_at = time.time() + self.ttl
+        serialized = json.dumps(value)
+        with self._lock:
+            self._remember(key, expires_at, serialized)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO results (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, serialized, expires_at),
+                )
+                self._db.commit()
+            self.writes += 1
+
+    def _remember(self, key: str, expires_at: float, serialized: str):
+        self._memory[key] = (expires_at, serialized)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM results")
+                self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "entries": len(self._memory),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "persistent": self._db is not None,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 3) if lookups else 0.0,
+                "writes": self.writes,
+                "evictions": self.evictions,
+            }
+
+
+result_cache = ResultCache(
+    max_entries=config.RESULT_CACHE_MAX_ENTRIES,
+    ttl_seconds=config.RESULT_CACHE_TTL_SECONDS,
+    sqlite_path=config.RESULT_CACHE_SQLITE_PATH or None,
+)
+
+
+def cached_node(name: str, fn: Callable[[State], Any]) -> Callable[[State], Any]:
+    """
+    Wraps a graph node so its output is served from ``result_cache`` when the
+    same input (normalized note, image pixels) already went through this node
+    with the same prompt templates and model. Set ``payload["cache_bypass"]``
+    to force a fresh run; its result still refreshes the cache.
+    """
+
+    def run(state: State):
+        if not config.RESULT_CACHE_ENABLED:
+            return fn(state)
+
+        key = result_cache_key(state.payload, name)
+        bypass = bool(state.payload.get("cache_bypass"))
+        cached = None if bypass else result_cache.get(key)
+        if cached is not None:
+            logger.info("Result cache hit for %s", name)
+            state.payload.update(cached["payload_updates"])
+            output = State(type=cached["type"], payload=state.payload, result=cached["result"], error=None)
+            if cached["routing"] is not None:
+                # Only set when cached, so an agent hit keeps the router's decision
+                output.routing = RoutingDecision(**cached["routing"])
+            return output
+
+        before = {k: v for k, v in state.payload.items() if isinstance(v, str)}
+        output = fn(state)
+        if isinstance(output, State) and output.error is None:
+            dumped = output.model_dump(mode="json", include={"type", "result", "routing"})
+            dumped["payload_updates"] = {
+                k: v for k, v in output.payload.items() if isinstance(v, str) and before.get(k) != v
+            }
+            result_cache.put(key, dumped)
+        return output
+
+    return run
@@ -0,0 +1,98 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from app.utils.deadline import Cancellation, cancellation_scope
+from app.utils.logger import get_logger
+from app.utils.metrics import COALESCED_REQUESTS
+
+logger = get_logger(__name__)
+
+
+class Flight:
+    """One piece of work running for every request attached to it."""
+
+    __slots__ = ("key", "task", "cancellation", "waiters")
+
+    def __init__(self, key: Optional[str], task: asyncio.Task, cancellation: Cancellation):
+        self.key = key
+        self.task = task
+        self.cancellation = cancellation
+        self.waiters = 1
+
+
+def _retrieve(task: asyncio.Task):
+    # Every waiter may have left; retrieve the outcome so asyncio does not log it
+    if not task.cancelled():
+        task.exception()
+
+
+class SingleFlight:
+    """
+    Coalesces identical requests while their work runs: the first request
+    for a key starts it, and requests with the same key that arrive before it
+    finishes attach to it and get the same result (or exception). Nothing is
+    kept once it finishes; that is the result cache's job.
+
+    The work runs under its own ``Cancellation``, whose deadline is the
+    latest of the attached requests' deadlines, and is only cancelled when
+    every attached request has left (disconnected or timed out), so one
+    impatient client does not fail the others. Used from the event loop only.
+
+    Args:
+        name (str): Label of the coalescing metrics.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._flights: Dict[str, Flight] = {}
+        self._started = 0
+        self._coalesced = 0
+
+    def attach(
+        self, key: Optional[str], deadline: Optional[float], start: Callable[[], Awaitable]
+    ) -> Tuple[Flight, bool]:
+        """
+        Attaches to the running work for ``key``, or starts ``start()`` as new
+        work. A None key is never shared.
+
+        Returns:
+            Tuple[Flight, bool]: The work, and whether it was already running.
+        """
+        flight = self._flights.get(key) if key is not None else None
+        if flight is not None and not flight.task.done() and not flight.cancellation.cancelled:
+            flight.waiters += 1
+            # The work must not stop before this request's own deadline
+            flight.cancellation.extend(deadline)
+            self._coalesced += 1
+            COALESCED_REQUESTS.labels(self.name).inc()
+            logger.info("Attached to an identical %s request in flight (%d waiting)", self.name, flight.waiters)
+            return flight, True
+
+        cancellation = Cancellation(deadline)
+        # The task copies the context, so the work (and the threads it hands off to) runs under the cancellation
+        with cancellation_scope(cancellation):
+            task = asyncio.ensure_future(start())
+        flight = Flight(key, task, cancellation)
+        self._started += 1
+        task.add_done_callback(_retrieve)
+        if key is not None:
+            self._flights[key] = flight
+            task.add_done_callback(lambda _: self._forget(flight))
+        return flight, False
+
+    def _forget(self, flight: Flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def leave(self, flight: Flight, reason: str):
+        """
+        Detaches a request that stopped waiting; the work is cancelled with
+        ``reason`` when it was the last one.
+        """
+        flight.waiters -= 1
+        if flight.waiters <= 0 and not flight.task.done():
+            flight.cancellation.cancel(reason)
+            self._forget(flight)
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._flights), "started": self._started, "coalesced": self._coalesced}
@@ -0,0 +1,208 @@
+import threading
+from collections import deque
+from typing import Optional
+
+from app.config.config import config
+from app.utils.logger import get_logger
+from app.utils.metrics import SPECULATIVE_ACCEPTANCE, SPECULATIVE_ACCEPTED, SPECULATIVE_DRAFTED, SPECULATIVE_FALLBACKS
+from app.utils.model_loader import TEXT_MODEL_PREFIX, model_registry
+
+logger = get_logger(__name__)
+
+
+class _AgentState:
+    __slots__ = ("window", "drafted", "accepted", "enabled", "skipped", "fallbacks", "total_drafted", "total_accepted")
+
+    def __init__(self):
+        # (drafted, accepted) per generation, trimmed to the window
+        self.window = deque()
+        self.drafted = 0
+        self.accepted = 0
+        self.enabled = True
+        self.skipped = 0
+        self.fallbacks = 0
+        self.total_drafted = 0
+        self.total_accepted = 0
+
+    def reset(self):
+        self.window.clear()
+        self.drafted = self.accepted = 0
+
+
+class SpeculativeController:
+    """
+    Decides per agent whether to decode with the draft model, from the
+    acceptance rate (accepted / drafted tokens) over the last
+    ``window_tokens`` drafted tokens.
+
+    An agent whose rate falls under ``min_acceptance`` decodes normally;
+    every ``probe_every``-th of its generations is drafted again, and a probe
+    at or above the threshold switches it back.
+
+    Args:
+        window_tokens (int): Drafted tokens the rate is computed over.
+        min_acceptance (float): Rate under which drafting costs more than it saves.
+        probe_every (int): Generations between probes while switched off.
+    """
+
+    def __init__(self, window_tokens: int, min_acceptance: float, probe_every: int):
+        self.window_tokens = max(1, window_tokens)
+        self.min_acceptance = min_acceptance
+        self.probe_every = max(1, probe_every)
+        self._agents = {}
+        self._lock = threading.Lock()
+
+    def _state(self, agent: str) -> _AgentState:
+        if agent not in self._agents:
+            self._agents[agent] = _AgentState()
+        return self._agents[agent]
+
+    def should_draft(self, agent: str) -> bool:
+        with self._lock:
+            state = self._state(agent)
+            if state.enabled:
+                return True
+            state.skipped += 1
+            if state.skipped >= self.probe_every:
+                state.skipped = 0
+                return True
+            return False
+
+    def record(self, agent: str, drafted: int, accepted: int):
+        """Records one speculative generation of ``agent``."""
+        if drafted <= 0:
+            return
+        SPECULATIVE_DRAFTED.labels(agent).inc(drafted)
+        SPECULATIVE_ACCEPTED.labels(agent).inc(accepted)
+        with self._lock:
+            state = self._state(agent)
+            state.total_drafted += drafted
+            state.total_accepted += accepted
+            if not state.enabled:
+                # A probe: one good generation is enough to draft again
+                if accepted / drafted < self.min_acceptance:
+                    return
+                state.enabled = True
+                state.reset()
+                logger.info("Draft acceptance for %s recovered to %.2f; drafting again", agent, accepted / drafted)
+
+            state.window.append((drafted, accepted))
+            state.drafted += drafted
+            state.accepted += accepted
+            while len(state.window) > 1 and state.drafted - state.window[0][0] >= self.window_tokens:
+                old_drafted, old_accepted = state.window.popleft()
+                state.drafted -= old_drafted
+                state.accepted -= old_accepted
+            rate = state.accepted / state.drafted
+            SPECULATIVE_ACCEPTANCE.labels(agent).set(rate)
+
+            # Only judged on a full window, so a few short generations do not switch it off
+            if state.drafted >= self.window_tokens and rate < self.min_acceptance:
+                state.enabled = False
+                state.skipped = 0
+                state.fallbacks += 1
+                SPECULATIVE_FALLBACKS.labels(agent).inc()
+                logger.warning(
+                    "Draft acceptance for %s is %.2f (< %.2f); falling back to normal decoding",
+                    agent,
+                    rate,
+                    self.min_acceptance,
+                )
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                agent: {
+                    "enabled": state.enabled,
+                    "acceptance_rate": round(state.accepted / state.drafted, 3) if state.drafted else None,
+                    "drafted_tokens": state.total_drafted,
+                    "accepted_tokens": state.total_accepted,
+                    "fallbacks": state.fallbacks,
+                }
+                for agent, state in self._agents.items()
+            }
+
+
+speculative_controller = SpeculativeController(
+    config.SPECULATIVE_WINDOW_TOKENS, config.SPECULATIVE_MIN_ACCEPTANCE, config.SPECULATIVE_PROBE_EVERY
+)
+
+_compatible = {}
+_draft_failed = False
+
+
+def _vocab_size(tokenizer) -> int:
+    return len(tokenizer.get_vocab())
+
+
+def _sliding_window(model) -> Optional[int]:
+    for owner in (model, getattr(model, "language_model", None)):
+        for name in ("args", "config"):
+            window = getattr(getattr(owner, name, None), "sliding_window", None)
+            if window:
+                return window
+    return None
+
+
+def draft_model(tokenizer):
+    """
+    The ``DRAFT_MODEL`` language model from the model registry, or None if it
+    is not set, failed to load, or does not share ``tokenizer``'s vocabulary.
+    """
+    global _draft_failed
+
+    if not config.DRAFT_MODEL or _draft_failed:
+        return None
+    try:
+        backend, _, _ = model_registry.get(TEXT_MODEL_PREFIX + config.DRAFT_MODEL)
+    except Exception as e:
+        _draft_failed = True
+        logger.error("Could not load draft model %s; speculative decoding is off: %s", config.DRAFT_MODEL, e)
+        return None
+
+    key = id(tokenizer)
+    if key not in _compatible:
+        target_size, draft_size = _vocab_size(tokenizer), _vocab_size(backend.tokenizer)
+        _compatible[key] = target_size == draft_size
+        if not _compatible[key]:
+            logger.error(
+                "Draft model %s has a %d-token vocabulary, the target %d; speculative decoding is off for it",
+                config.DRAFT_MODEL,
+                draft_size,
+                target_size,
+            )
+    return backend.model if _compatible[key] else None
+
+
+def draft_options(agent: Optional[str], model, tokenizer, prompt_tokens: int, max_tokens: int) -> dict:
+    """
+    Extra ``mlx_lm.stream_generate`` options that decode ``agent``'s generation
+    speculatively, or ``{}`` to decode normally.
+
+    Drafting is skipped when the prompt plus ``max_tokens`` would pass either
+    model's sliding window: rejected draft tokens are rolled back by trimming
+    the KV caches, which a rotating cache cannot do once it has wrapped, and
+    the output would then differ from normal decoding.
+    """
+    if not config.DRAFT_MODEL or agent not in config.SPECULATIVE_AGENTS:
+        return {}
+    draft = draft_model(tokenizer)
+    if draft is None:
+        return {}
+    for window in (_sliding_window(model), _sliding_window(draft)):
+        if window and prompt_tokens + max_tokens > window:
+            return {}
+    if not speculative_controller.should_draft(agent):
+        return {}
+    return {"draft_model": draft, "num_draft_tokens": config.SPECULATIVE_DRAFT_TOKENS}
+
+
+def record_draft(agent: str, generation_tokens: int, from_draft: int, num_draft_tokens: int):
+    """
+    Records a speculative generation from its token counts. Every verification
+    round ends with one token from the target model, so the rounds are the
+    tokens not taken from the draft, each proposing ``num_draft_tokens``.
+    """
+    rounds = generation_tokens - from_draft
+    # A generation cut off by max_tokens may end inside a round
+    speculative_controller.record(agent, max(rounds * num_draft_tokens, from_draft), from_draft)
@@ -0,0 +1,179 @@
+import os
+import threading
+import time
+from typing import Optional
+
+from app.config.config import config
+from app.utils.logger import get_logger
+from app.utils.metrics import STARTUP_SECONDS
+
+logger = get_logger(__name__)
+
+STARTING = "starting"
+LOADING = "loading"
+WARMING = "warming"
+READY = "ready"
+FAILED = "failed"
+
+_imported_at = time.time()
+
+
+def _process_start() -> float:
+    """
+    Wall-clock start of this process (Linux), so the startup metrics include
+    interpreter start and imports; the time this module was imported elsewhere.
+    """
+    try:
+        with open("/proc/self/stat") as f:
+            # Fields after the parenthesised command name; starttime is field 22
+            start_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/stat") as f:
+            boot_time = next(int(line.split()[1]) for line in f if line.startswith("btime"))
+        return boot_time + start_ticks / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, StopIteration):
+        return _imported_at
+
+
+class Startup:
+    """
+    Tracks the startup lifecycle: the app answers /healthz as soon as it
+    listens, while a background thread loads the model, builds the graph and
+    runs one short generation per agent prompt shape. /readyz reports ready
+    only after that.
+    """
+
+    def __init__(self):
+        self.state = STARTING
+        self.error: Optional[str] = None
+        self.started_at = _process_start()
+        self.listen_seconds: Optional[float] = None
+        self.ready_seconds: Optional[float] = None
+        self.warmed: dict = {}
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def ready(self) -> bool:
+        if config.SERVING_PROCESSES:
+            from app.utils.dispatcher import get_dispatcher
+
+            # Ready only while some worker process can take a request
+            return self.state == READY and get_dispatcher().ready_workers() > 0
+        return self.state == READY
+
+    def listening(self):
+        """Records time-to-first-listen; called once the app can take connections."""
+        self.listen_seconds = time.time() - self.started_at
+        STARTUP_SECONDS.labels("listen").set(self.listen_seconds)
+        logger.info("Listening %.2fs after process start", self.listen_seconds)
+
+    def start(self):
+        """Loads and warms the model on a background thread."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, name="warmup", daemon=True)
+            self._thread.start()
+
+    def run(self):
+        """
+        Loads and warms the model on this thread. With ``SERVING_PROCESSES``,
+        starts the inference worker processes instead (each one runs this
+        itself) and waits for the first to be ready.
+        """
+        from app.graph.graph_builder import get_graph
+
+        try:
+            self.state = LOADING
+            if config.SERVING_PROCESSES:
+                wait_for_workers()
+            else:
+                get_graph()
+                self.state = WARMING
+                if config.WARMUP_ENABLED:
+                    warmup(self.warmed)
+        except Exception as e:
+            self.state, self.error = FAILED, str(e) or type(e).__name__
+            logger.error("Startup failed: %s", self.error)
+            return
+
+        self.ready_seconds = time.time() - self.started_at
+        STARTUP_SECONDS.labels("ready").set(self.ready_seconds)
+        self.state = READY
+        logger.info("Ready %.2fs after process start", self.ready_seconds)
+
+    def status(self) -> dict:
+        return {
+            "status": self.state,
+            "error": self.error,
+            "listen_seconds": round(self.listen_seconds, 3) if self.listen_seconds is not None else None,
+            "ready_seconds": round(self.ready_seconds, 3) if self.ready_seconds is not None else None,
+            "warmup_seconds": self.warmed,
+        }
+
+
+def wait_for_workers():
+    """
+    Starts the inference worker processes and blocks until one is ready.
+
+    Raises:
+        RuntimeError: If every worker failed to start.
+    """
+    from app.utils.dispatcher import get_dispatcher
+
+    dispatcher = get_dispatcher()
+    while not dispatcher.wait_ready(timeout=1.0):
+        errors = [worker["error"] for worker in dispatcher.stats()["workers"] if worker["error"]]
+        if len(errors) == dispatcher.num_workers:
+            raise RuntimeError(f"No inference worker could start: {errors[0]}")
+
+
+def warmup_requests() -> dict:
+    """
+    One representative request per agent: the agent's prompt builder, image
+    count and response schema, with a short placeholder input.
+
+    Returns:
+        dict: Agent name -> ``(prompt, image, generate_response kwargs)``.
+    """
+    from PIL import Image
+
+    from app.utils.constrained_decoding import ICD10_SCHEMA, RADIOLOGY_SCHEMA, SOAP_SCHEMA
+    from app.utils.prompt_builder import (
+        build_icd10_prompt,
+        build_image_analyzer_prompt,
+        build_router_prompt,
+        build_soap_generator_prompt,
+    )
+
+    note = "Patient reports a mild headache since yesterday."
+    image = Image.new("RGB", (config.IMAGE_TARGET_SIZE, config.IMAGE_TARGET_SIZE))
+    return {
+        "router": (build_router_prompt(note, None), None, {}),
+        "icd10": (build_icd10_prompt(note), None, {"json_schema": ICD10_SCHEMA}),
+        "soap": (build_soap_generator_prompt(note), None, {"json_schema": SOAP_SCHEMA}),
+        "image_analysis": (build_image_analyzer_prompt(image), image, {"json_schema": RADIOLOGY_SCHEMA}),
+    }
+
+
+def warmup(timings: dict):
+    """
+    Runs ``WARMUP_MAX_TOKENS`` of generation for each agent in ``WARMUP_AGENTS``
+    so the first real request does not pay for graph compilation, the prompt
+    prefix cache or lazy kernel setup. ``timings`` receives seconds per agent.
+    """
+    from app.utils.model_loader import apply_chat_template, load_agent_model
+    from app.utils.predictor import generate_response
+
+    requests = warmup_requests()
+    for agent in config.WARMUP_AGENTS:
+        if agent not in requests:
+            logger.warning("No warmup request for agent %s", agent)
+            continue
+        prompt, image, options = requests[agent]
+        tic = time.perf_counter()
+        model, processor, model_config = load_agent_model(agent)
+        formatted = apply_chat_template(processor, model_config, prompt, num_images=1 if image else 0)
+        generate_response(model, processor, formatted, image, agent=agent, max_tokens=config.WARMUP_MAX_TOKENS, **options)
+        timings[agent] = round(time.perf_counter() - tic, 3)
+        logger.info("Warmed up %s in %.2fs", agent, timings[agent])
+
+
+startup = Startup()
@@ -0,0 +1,131 @@
+import json
+from typing import Callable, List, Optional, Tuple
+
+from app.utils.logger import get_logger, payload_summary
+
+logger = get_logger(__name__)
+
+
+class IncrementalJSONParser:
+    """
+    Scans model output as it streams and reports each top-level member of the
+    JSON value as soon as it closes:
+
+    - top-level object (SOAP note, radiology report): ``("field", key, value)``
+      per completed key/value pair, e.g. ``"Subjective"`` before ``"Objective"``
+      has started;
+    - top-level array (ICD-10 codes): ``("item", index, value)`` per element.
+
+    Anything before the first ``{`` or ``[`` (markdown fences, chatter) is skipped.
+    Members that do not parse on their own are left for the final
+    ``clean_json_response`` pass.
+    """
+
+    def __init__(self):
+        self._buffer = []
+        self._root = None          # "{" or "["
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._member_start = None  # buffer index where the current member starts
+        self._key = None
+        self._expect_key = True
+        self._items = 0
+        self.closed = False
+
+    def feed(self, text: str) -> List[Tuple]:
+        events = []
+        for ch in text:
+            if self.closed:
+                break
+            if self._root is None:
+                if ch in "{[":
+                    self._root = ch
+                    self._depth = 1
+                    self._expect_key = ch == "{"
+                continue
+
+            self._buffer.append(ch)
+            pos = len(self._buffer) - 1
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        events.extend(self._close_member(pos + 1))
+                continue
+
+            if ch == '"':
+                self._in_string = True
+                if self._depth == 1 and self._member_start is None:
+                    self._member_start = pos
+            elif ch in "{[":
+                if self._depth == 1 and self._member_start is None:
+                    self._member_start = pos
+                self._depth += 1
+            elif ch in "}]":
+                self._depth -= 1
+                if self._depth == 1:
+                    events.extend(self._close_member(pos + 1))
+                elif self._depth == 0:
+                    # A bare literal (number/true/null) may still be open
+                    events.extend(self._close_member(pos))
+                    self.closed = True
+            elif self._depth == 1:
+                if ch == ":" and self._root == "{":
+                    self._expect_key = False
+                    self._member_start = None
+                elif ch == ",":
+                    events.extend(self._close_member(pos))
+                    self._expect_key = self._root == "{"
+                elif not ch.isspace() and self._member_start is None:
+                    self._member_start = pos
+        return events
+
+    def _close_member(self, end: int) -> List[Tuple]:
+        if self._member_start is None:
+            return []
+        raw = "".join(self._buffer[self._member_start:end]).strip()
+        self._member_start = None
+        if not raw:
+            return []
+        try:
+            value = json.loads(raw)
+        except json.JSONDecodeError:
+            logger.debug("Skipping unparsable streamed member: %s", payload_summary(raw))
+            return []
+
+        if self._root == "[":
+            index = self._items
+            self._items += 1
+            return [("item", index, value)]
+        if self._expect_key:
+            self._key = value
+            return []
+        key, self._key = self._key, None
+        self._expect_key = True
+        return [("field", key, value)]
+
+
+def make_stream_callback(emit: Optional[Callable[[dict], None]]) -> Optional[Callable[[str], None]]:
+    """
+    Builds an ``on_chunk`` callback that forwards raw tokens and parsed fields
+    to ``emit`` as streaming events. Returns None when nobody is listening.
+    """
+    if emit is None:
+        return None
+    parser = IncrementalJSONParser()
+
+    def on_chunk(text: str):
+        emit({"event": "token", "text": text})
+        for kind, name, value in parser.feed(text):
+            if kind == "field":
+                emit({"event": "field", "name": name, "value": value})
+            else:
+                emit({"event": "item", "index": name, "value": value})
+
+    return on_chunk
@@ -0,0 +1,156 @@
+import json
+import re
+import time
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from app.config.config import config
+from app.utils.deadline import check_cancelled
+from app.utils.model_loader import ModelBackend
+from app.utils.logger import get_logger
+
+logger = get_logger(__name__)
+
+_CANDIDATE_LINE = re.compile(r"^\s*-\s*([A-Z][0-9][0-9A-Z](?:\.[0-9A-Z]{1,4})?):\s*(.+)$", re.MULTILINE)
+_NOTE_SECTION = re.compile(r"Clinical note:\s*(.*?)(?:\n\s*Candidate codes:|\Z)", re.DOTALL)
+
+
+@dataclass
+class StubGenerationResult:
+    text: str
+    prompt_tokens: int = 0
+    generation_tokens: int = 0
+    total_tokens: int = 0
+    prompt_tps: float = 0.0
+    generation_tps: float = 0.0
+    peak_memory: float = 0.0
+
+
+class StubModel(ModelBackend):
+    """
+    Deterministic stand-in for MedGemma (``MODEL_BACKEND=stub``): no weights,
+    no accelerator, the same output for the same prompt. Used to exercise the
+    graph, the API and the evaluation harness on CPU-only machines.
+
+    - router: ``image_analysis`` with an image, ``soap`` for dialogue, else ``icd10``
+    - icd10: the retrieved candidates whose description shares a word with the
+      note (the first few candidates when none do), or ``[]`` without candidates
+    - soap / image_analysis: fixed-shape JSON built from the input
+    - soap_map / soap_reduce: patient and doctor lines as facts, then the facts
+      joined per section
+
+    Tokens are counted as whitespace-separated words. ``seconds_per_token``
+    adds a sleep per generated token to emulate decode time, which stops when
+    the request is cancelled.
+
+    Args:
+        seconds_per_token (Optional[float]): Simulated decode latency per output
+            token; defaults to ``STUB_SECONDS_PER_TOKEN``.
+        max_codes (int): Maximum number of ICD-10 codes returned.
+    """
+
+    config = {"model_type": "stub"}
+
+    def __init__(self, seconds_per_token: Optional[float] = None, max_codes: int = 3):
+        self.seconds_per_token = config.STUB_SECONDS_PER_TOKEN if seconds_per_token is None else seconds_per_token
+        self.max_codes = max_codes
+
+    def format_prompt(self, prompt: str, num_images: int = 0) -> str:
+        images = "<start_of_image>" * num_images
+        return f"<start_of_turn>user\n{images}{prompt}<end_of_turn>\n<start_of_turn>model\n"
+
+    def generate(self, formatted_prompt: str, image: Optional[Any] = None, agent: Optional[str] = None, on_chunk=None, **kwargs):
+        if agent == "router":
+            text = self._route(formatted_prompt, image)
+        elif agent == "icd10":
+            text = self._icd10(formatted_prompt)
+        elif agent == "soap":
+            text = self._soap(formatted_prompt)
+        elif agent == "soap_map":
+            text = self._soap_facts(formatted_prompt)
+        elif agent == "soap_reduce":
+            text = self._soap_from_facts(formatted_prompt)
+        else:
+            text = self._radiology(formatted_prompt)
+
+        max_tokens = kwargs.get("max_tokens")
+        words = text.split()
+        if max_tokens is not None and len(words) > max_tokens:
+            text = " ".join(words[:max_tokens])
+            words = words[:max_tokens]
+        if self.seconds_per_token:
+            for _ in words:
+                check_cancelled()
+                time.sleep(self.seconds_per_token)
+        if on_chunk is not None:
+            on_chunk(text)
+
+        prompt_tokens = len(formatted_prompt.split())
+        return StubGenerationResult(
+            text=text,
+            prompt_tokens=prompt_tokens,
+            generation_tokens=len(words),
+            total_tokens=prompt_tokens + len(words),
+        )
+
+    @staticmethod
+    def _route(prompt: str, image) -> str:
+        if image:
+            return "image_analysis"
+        speakers = re.findall(r"^\s*(?:doctor|patient|dr\.?|pt)\s*:", prompt, re.IGNORECASE | re.MULTILINE)
+        return "soap" if len(speakers) >= 2 else "icd10"
+
+    def _icd10(self, prompt: str) -> str:
+        match = _NOTE_SECTION.search(prompt)
+        note_words = set(re.findall(r"[a-z]{4,}", (match.group(1) if match else prompt).lower()))
+        candidates = _CANDIDATE_LINE.findall(prompt.split("Candidate codes:", 1)[-1]) if "Candidate codes:" in prompt else []
+
+        chosen = [(code, desc) for code, desc in candidates if note_words & set(re.findall(r"[a-z]{4,}", desc.lower()))]
+        chosen = (chosen or candidates)[: self.max_codes]
+        return json.dumps([{"code": code, "description": desc.strip()} for code, desc in chosen])
+
+    @staticmethod
+    def _soap(prompt: str) -> str:
+        lines = [line.strip() for line in prompt.splitlines() if ":" in line]
+        patient = next((line.split(":", 1)[1].strip() for line in lines if line.lower().startswith("patient")), "")
+        doctor = [line.split(":", 1)[1].strip() for line in lines if line.lower().startswith("doctor")]
+        return json.dumps({
+            "Subjective": patient or "Not documented.",
+            "Objective": doctor[1] if len(doctor) > 1 else "Not documented.",
+            "Assessment": doctor[-1] if doctor else "Not documented.",
+            "Plan": "Follow up as discussed.",
+        })
+
+    @staticmethod
+    def _soap_facts(prompt: str) -> str:
+        excerpt = prompt.split("Here is the excerpt:", 1)[-1]
+        lines = [line.strip() for line in excerpt.splitlines() if ":" in line]
+        patient = [line.split(":", 1)[1].strip() for line in lines if line.lower().startswith("patient")]
+        doctor = [line.split(":", 1)[1].strip() for line in lines if line.lower().startswith("doctor")]
+        return json.dumps({"Subjective": patient, "Objective": doctor[:1], "Assessment": doctor[1:], "Plan": []})
+
+    @staticmethod
+    def _soap_from_facts(prompt: str) -> str:
+        facts = prompt.split("Here are the extracted facts:", 1)[-1]
+        sections = dict(re.findall(r"^\s*(Subjective|Objective|Assessment|Plan):\n((?:\s*- .*\n?)*)", facts, re.MULTILINE))
+        note = {
+            name: "; ".join(line.strip()[2:] for line in sections.get(name, "").splitlines() if line.strip())
+            for name in ("Subjective", "Objective", "Assessment", "Plan")
+        }
+        return json.dumps({name: value or "Not documented." for name, value in note.items()})
+
+    @staticmethod
+    def _radiology(prompt: str) -> str:
+        question = re.search(r"Question:\s*(.+)", prompt)
+        question = question.group(1).strip() if question else ""
+        header = dict(re.findall(r"^\s*-\s*(Modality|Body part|View):\s*(.+)$", prompt, re.MULTILINE))
+        technique = " ".join(header[k] for k in ("Modality", "Body part", "View") if k in header)
+        report = {
+            "technique": f"{technique}." if technique else "Single frontal view.",
+            "findings": "No acute abnormality identified.",
+            "impression": "No acute findings.",
+            "recommendations": "Clinical correlation.",
+        }
+        if question and not question.startswith("No specific question"):
+            report["answer_to_user_question"] = "No abnormality is seen that answers this question."
+        return json.dumps(report)
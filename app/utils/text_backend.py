@@ -0,0 +1,107 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+from app.config.config import config
+from app.utils.constrained_decoding import JSONLogitsProcessor, JSONSchema
+from app.utils.deadline import check_cancelled
+from app.utils.logger import get_logger
+from app.utils.model_loader import ModelBackend, parameter_bytes
+from app.utils.speculative import draft_options, record_draft
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class TextGenerationResult:
+    text: str
+    prompt_tokens: int = 0
+    generation_tokens: int = 0
+    total_tokens: int = 0
+    prompt_tps: float = 0.0
+    generation_tps: float = 0.0
+    peak_memory: float = 0.0
+
+
+class MlxLMModel(ModelBackend):
+    """
+    A text-only ``mlx_lm`` model behind the ``ModelBackend`` interface, e.g. a
+    small instruct model for routing or a text LLM for ICD-10 and SOAP notes.
+    Selected with an ``"lm:<repo id>"`` model spec; it cannot take images.
+
+    Args:
+        repo (str): Hugging Face repo id or local path of an ``mlx_lm`` model.
+    """
+
+    def __init__(self, repo: str):
+        from mlx_lm import load
+
+        self.repo = repo
+        self.model, self.tokenizer = load(repo)
+        self.config = {"model_type": "mlx_lm", "model_id": repo}
+        self.memory_bytes = parameter_bytes(self.model)
+        # lm: models do not go through the batcher; one generation at a time per model
+        self._lock = threading.Lock()
+
+    def format_prompt(self, prompt: str, num_images: int = 0) -> str:
+        if num_images:
+            raise ValueError(f"{self.repo} is a text-only model and cannot analyze images.")
+        return self.tokenizer.apply_chat_template(
+            [{"role": "user", "content": prompt}], tokenize=False, add_generation_prompt=True
+        )
+
+    def generate(
+        self,
+        formatted_prompt: str,
+        image: Optional[Any] = None,
+        agent: Optional[str] = None,
+        on_chunk: Optional[Callable[[str], None]] = None,
+        json_schema: Optional[JSONSchema] = None,
+        **kwargs,
+    ) -> TextGenerationResult:
+        from mlx_lm import stream_generate
+
+        if image:
+            raise ValueError(f"{self.repo} is a text-only model and cannot analyze images.")
+        kwargs.setdefault("max_tokens", 256)
+        if json_schema is not None and config.CONSTRAINED_DECODING_ENABLED:
+            kwargs["logits_processors"] = [JSONLogitsProcessor(json_schema, self.tokenizer, self.tokenizer.eos_token_ids)]
+
+        # The chat template already carries <bos>
+        tokens = self.tokenizer.encode(formatted_prompt, add_special_tokens=False)
+        if self.repo != config.DRAFT_MODEL:
+            kwargs.update(draft_options(agent, self.model, self.tokenizer, len(tokens), kwargs["max_tokens"]))
+        text = ""
+        response = None
+        from_draft = 0
+        tic = time.perf_counter()
+        with self._lock:
+            for response in stream_generate(self.model, self.tokenizer, tokens, **kwargs):
+                check_cancelled()
+                text += response.text
+                from_draft += bool(getattr(response, "from_draft", False))
+                if on_chunk is not None and response.text:
+                    on_chunk(response.text)
+
+        if response is None:
+            return TextGenerationResult(text="", prompt_tokens=len(tokens), total_tokens=len(tokens))
+        if "draft_model" in kwargs:
+            record_draft(agent, response.generation_tokens, from_draft, kwargs["num_draft_tokens"])
+        logger.info(
+            "%s generation: %d prompt tokens, %d generated (%d from the draft model) in %.2fs",
+            self.repo,
+            len(tokens),
+            response.generation_tokens,
+            from_draft,
+            time.perf_counter() - tic,
+        )
+        return TextGenerationResult(
+            text=text,
+            prompt_tokens=len(tokens),
+            generation_tokens=response.generation_tokens,
+            total_tokens=len(tokens) + response.generation_tokens,
+            prompt_tps=response.prompt_tps,
+            generation_tps=response.generation_tps,
+            peak_memory=response.peak_memory,
+        )
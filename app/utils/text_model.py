@@ -0,0 +1,184 @@
+import time
+from typing import Callable, List, Optional
+
+import mlx.core as mx
+import mlx.nn as nn
+from mlx_lm.generate import stream_generate
+from mlx_lm.tokenizer_utils import TokenizerWrapper
+from mlx_vlm.generate import GenerationResult
+from mlx_vlm.utils import prepare_inputs
+from app.config.config import config
+from app.utils.logger import get_logger
+from app.utils.deadline import check_cancelled
+from app.utils.model_loader import model_registry
+from app.utils.speculative import draft_options, record_draft
+
+logger = get_logger(__name__)
+
+_text_models = {}
+
+
+class TextOnlyModel(nn.Module):
+    """
+    The language-model half of a VLM, shaped like an ``mlx_lm`` model.
+
+    ``mlx_lm`` expects ``model(tokens, cache=...)`` to return logits and the
+    model to expose ``layers``/``make_cache``. The VLM's language model returns
+    a ``LanguageModelOutput`` instead, so this wrapper unwraps it. Weights are
+    shared with the VLM; nothing is copied.
+    """
+
+    def __init__(self, vlm):
+        super().__init__()
+        self.language_model = vlm.language_model
+
+    @property
+    def layers(self):
+        return self.language_model.layers
+
+    def make_cache(self):
+        return self.language_model.make_cache()
+
+    def __call__(self, inputs: mx.array, cache=None, input_embeddings: Optional[mx.array] = None):
+        return self.language_model(inputs, inputs_embeds=input_embeddings, cache=cache).logits
+
+
+def get_text_model(model) -> TextOnlyModel:
+    key = id(model)
+    if key not in _text_models:
+        _text_models[key] = TextOnlyModel(model)
+    return _text_models[key]
+
+
+model_registry.on_evict(lambda model: _text_models.pop(id(model), None))
+
+
+def get_text_tokenizer(processor) -> TokenizerWrapper:
+    """
+    Wraps the processor's tokenizer for ``mlx_lm``, keeping the VLM's stop tokens
+    (e.g. ``<end_of_turn>`` for Gemma 3) rather than only ``eos_token_id``.
+    """
+    tokenizer = processor.tokenizer if hasattr(processor, "tokenizer") else processor
+    criteria = getattr(tokenizer, "stopping_criteria", None)
+    eos_token_ids = criteria.eos_token_ids if criteria is not None else None
+    return TokenizerWrapper(tokenizer, eos_token_ids=eos_token_ids)
+
+
+def encode_prompt(processor, formatted_prompt: str) -> List[int]:
+    """
+    Tokenizes a prompt that already has the chat template applied (it carries
+    its own ``<bos>``), so no special tokens are added.
+    """
+    tokenizer = processor.tokenizer if hasattr(processor, "tokenizer") else processor
+    return tokenizer.encode(formatted_prompt, add_special_tokens=False)
+
+
+def embed_prompt(model, processor, formatted_prompt: str, image) -> tuple:
+    """
+    Tokenizes a multimodal prompt and merges the image features into its
+    embeddings, so the language model can decode it without the VLM wrapper.
+
+    Returns:
+        tuple: ``(token_ids, input_embeddings)``, both without a batch axis.
+    """
+    inputs = prepare_inputs(
+        processor,
+        images=image,
+        prompts=formatted_prompt,
+        image_token_index=getattr(model.config, "image_token_index", None),
+    )
+    input_ids = inputs["input_ids"]
+    embeddings, _ = model.get_input_embeddings(input_ids, inputs.get("pixel_values"), inputs.get("attention_mask"))
+    return input_ids.reshape(-1), embeddings[0]
+
+
+def generate_text(
+    model,
+    processor,
+    formatted_prompt: str,
+    image=None,
+    agent: Optional[str] = None,
+    on_chunk: Optional[Callable[[str], None]] = None,
+    **kwargs,
+) -> GenerationResult:
+    """
+    Text-only generation: runs the prompt through the language model alone, so
+    no image processor, vision tower or image tokens are involved.
+
+    With ``image``, the VLM only computes the prompt embeddings (see
+    ``embed_prompt``) and decoding still goes through ``mlx_lm``, which is what
+    gives image prompts access to ``logits_processors``.
+
+    Args:
+        model: The loaded VLM.
+        processor: The processor for the model.
+        formatted_prompt (str): The prompt with the chat template applied.
+        image: Images referenced by the prompt, or None for a text-only prompt.
+        agent (Optional[str]): Agent whose static prompt prefix may be resumed from
+            the prefix cache (``"router"``, ``"icd10"``, ``"soap"``).
+        on_chunk (Optional[Callable]): Called with each decoded text segment.
+        **kwargs: Options forwarded to ``mlx_lm.generate.stream_generate`` (e.g.
+            ``max_tokens``, ``logits_processors``).
+
+    Returns:
+        GenerationResult: Same shape as ``mlx_vlm.generate`` returns.
+
+    Raises:
+        RequestCancelled: If the request is cancelled while it decodes.
+    """
+    kwargs.setdefault("max_tokens", 256)
+    if image:
+        tokens, kwargs["input_embeddings"] = embed_prompt(model, processor, formatted_prompt, image)
+        prompt_tokens = tokens.size
+    else:
+        tokens = encode_prompt(processor, formatted_prompt)
+        prompt_tokens = len(tokens)
+
+    # Image prompts are decoded from embeddings, which the speculative path does not take
+    if not image and "prompt_cache" not in kwargs:
+        kwargs.update(draft_options(agent, model, get_text_tokenizer(processor), prompt_tokens, kwargs["max_tokens"]))
+
+    # Image prompts start with image tokens, so there is no shared prefix to resume.
+    # The prefix cache only holds the target model's KV, so it is not used while drafting
+    if agent and not image and config.PREFIX_CACHE_ENABLED and "prompt_cache" not in kwargs and "draft_model" not in kwargs:
+        # Imported here: prompt_cache builds on this module
+        from app.utils.prompt_cache import prefix_cache
+
+        cache, tokens = prefix_cache.resume(agent, model, processor, tokens)
+        if cache is not None:
+            kwargs["prompt_cache"] = cache
+
+    text = ""
+    response = None
+    from_draft = 0
+    tic = time.perf_counter()
+    for response in stream_generate(get_text_model(model), get_text_tokenizer(processor), tokens, **kwargs):
+        # Leaving the loop closes the generator, which stops decoding
+        check_cancelled()
+        text += response.text
+        from_draft += bool(getattr(response, "from_draft", False))
+        if on_chunk is not None and response.text:
+            on_chunk(response.text)
+
+    if response is None:
+        return GenerationResult(text="", prompt_tokens=prompt_tokens, total_tokens=prompt_tokens)
+    if "draft_model" in kwargs:
+        record_draft(agent, response.generation_tokens, from_draft, kwargs["num_draft_tokens"])
+    logger.info(
+        "%s generation: %d prompt tokens (%d prefilled), %d generated (%d from the draft model) in %.2fs",
+        "Image" if image else "Text-only",
+        prompt_tokens,
+        len(tokens),
+        response.generation_tokens,
+        from_draft,
+        time.perf_counter() - tic,
+    )
+    return GenerationResult(
+        text=text,
+        prompt_tokens=prompt_tokens,
+        generation_tokens=response.generation_tokens,
+        total_tokens=prompt_tokens + response.generation_tokens,
+        prompt_tps=response.prompt_tps,
+        generation_tps=response.generation_tps,
+        peak_memory=response.peak_memory,
+    )
@@ -0,0 +1,163 @@
+import re
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+SOAP_SECTIONS = ("Subjective", "Objective", "Assessment", "Plan")
+
+# "Doctor:", "Patient:", "Dr. Smith:", "PT:" ... at the start of a line
+_SPEAKER = re.compile(r"^\s*([A-Za-z][\w .'-]{0,40}?)\s*:\s+(?=\S)")
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+_WORD = re.compile(r"[a-z0-9]+")
+
+# Facts sharing at least this fraction of their words are treated as duplicates
+DUPLICATE_OVERLAP = 0.8
+
+
+class Turn:
+    __slots__ = ("speaker", "text", "tokens")
+
+    def __init__(self, speaker: Optional[str], text: str, tokens: int = 0):
+        self.speaker = speaker
+        self.text = text
+        self.tokens = tokens
+
+    def render(self) -> str:
+        return f"{self.speaker}: {self.text}" if self.speaker else self.text
+
+
+def split_turns(transcript: str) -> List[Turn]:
+    """
+    Splits a transcript into speaker turns. A line starting with a speaker label
+    ("Doctor:", "Patient:") opens a turn and unlabelled lines continue it. A
+    transcript without labels is split into paragraphs instead.
+    """
+    lines = transcript.splitlines()
+    if not any(_SPEAKER.match(line) for line in lines):
+        return [Turn(None, " ".join(p.split())) for p in re.split(r"\n\s*\n", transcript) if p.strip()]
+
+    turns: List[Turn] = []
+    for line in lines:
+        match = _SPEAKER.match(line)
+        if match:
+            turns.append(Turn(match.group(1).strip(), line[match.end():].strip()))
+        elif line.strip() and turns:
+            turns[-1].text += " " + line.strip()
+        elif line.strip():
+            turns.append(Turn(None, line.strip()))
+    return turns
+
+
+def _split_long_turn(turn: Turn, max_tokens: int, count: Callable[[str], int]) -> List[Turn]:
+    # Sentences first, then runs of words; every piece keeps the speaker label,
+    # so the label's tokens come out of each piece's budget
+    budget = max(1, max_tokens - count(Turn(turn.speaker, "").render())) if turn.speaker else max_tokens
+    pieces: List[Turn] = []
+    current: List[str] = []
+    for sentence in _SENTENCE_END.split(turn.text):
+        tokens = count(sentence)
+        if tokens > budget:
+            words = sentence.split()
+            step = max(1, len(words) * budget // tokens)
+            parts = [" ".join(words[i:i + step]) for i in range(0, len(words), step)]
+        else:
+            parts = [sentence]
+        for part in parts:
+            candidate = " ".join(current + [part])
+            if current and count(candidate) > budget:
+                pieces.append(Turn(turn.speaker, " ".join(current)))
+                current = [part]
+            else:
+                current.append(part)
+    if current:
+        pieces.append(Turn(turn.speaker, " ".join(current)))
+    for piece in pieces:
+        piece.tokens = count(piece.render())
+    return pieces
+
+
+def chunk_transcript(
+    transcript: str, count: Callable[[str], int], chunk_tokens: int, overlap_tokens: int
+) -> List[str]:
+    """
+    Packs the transcript's speaker turns into chunks of at most
+    ``chunk_tokens`` tokens, never splitting a turn that fits in one chunk.
+    Each chunk after the first repeats the last turns of the previous one, up
+    to ``overlap_tokens``, so facts spanning a boundary are seen whole.
+
+    Chunks are packed greedily from the start, so when a transcript grows only
+    its last chunk changes and the earlier ones (and their cached facts) stay
+    the same.
+
+    Args:
+        transcript (str): The transcript.
+        count (Callable[[str], int]): Token count of a piece of text.
+        chunk_tokens (int): Token budget of a chunk.
+        overlap_tokens (int): Token budget of the repeated turns.
+
+    Returns:
+        List[str]: The chunks, one rendered turn per line.
+    """
+    turns: List[Turn] = []
+    for turn in split_turns(transcript):
+        turn.tokens = count(turn.render())
+        turns.extend(_split_long_turn(turn, chunk_tokens, count) if turn.tokens > chunk_tokens else [turn])
+
+    chunks: List[List[Turn]] = []
+    current: List[Turn] = []
+    size = 0
+    for turn in turns:
+        if current and size + turn.tokens > chunk_tokens:
+            chunks.append(current)
+            carried: List[Turn] = []
+            for previous in reversed(current):
+                if sum(t.tokens for t in carried) + previous.tokens > overlap_tokens:
+                    break
+                carried.insert(0, previous)
+            # The overlap must leave room for the next turn
+            while carried and sum(t.tokens for t in carried) + turn.tokens > chunk_tokens:
+                carried.pop(0)
+            current, size = carried, sum(t.tokens for t in carried)
+        current.append(turn)
+        size += turn.tokens
+    if current:
+        chunks.append(current)
+    return ["\n".join(turn.render() for turn in chunk) for chunk in chunks]
+
+
+def _words(fact: str) -> frozenset:
+    return frozenset(_WORD.findall(fact.lower()))
+
+
+def _is_duplicate(words: frozenset, other: frozenset) -> bool:
+    # Very short facts ("Cough.") only match exactly
+    if min(len(words), len(other)) < 3:
+        return words == other
+    return len(words & other) / min(len(words), len(other)) >= DUPLICATE_OVERLAP
+
+
+def merge_facts(chunk_facts: Iterable[Dict[str, List[str]]]) -> Dict[str, List[str]]:
+    """
+    Merges the facts extracted from each chunk, in transcript order. A fact
+    whose words mostly repeat an earlier fact of the same section (e.g. from
+    the overlap between chunks) is dropped, unless it is the longer of the two,
+    in which case it replaces the earlier one in place.
+
+    Returns:
+        Dict[str, List[str]]: Section name -> deduplicated facts.
+    """
+    merged: Dict[str, List[Tuple[frozenset, str]]] = {section: [] for section in SOAP_SECTIONS}
+    for facts in chunk_facts:
+        for section in SOAP_SECTIONS:
+            kept = merged[section]
+            for fact in facts.get(section) or []:
+                fact = str(fact).strip()
+                words = _words(fact)
+                if not fact or not words:
+                    continue
+                for i, (other, text) in enumerate(kept):
+                    if _is_duplicate(words, other):
+                        if len(fact) > len(text):
+                            kept[i] = (words, fact)
+                        break
+                else:
+                    kept.append((words, fact))
+    return {section: [text for _, text in kept] for section, kept in merged.items()}
@@ -0,0 +1,115 @@
+"""
+Compares the old image decoding path with the ingestion pipeline.
+
+  - full:   read the whole file, decode at native resolution, convert to RGB
+            (previous ``convert_uploadfile_to_image``)
+  - ingest: header checks, JPEG draft mode / reduced decoding down to
+            ``IMAGE_TARGET_SIZE`` (``app.utils.image_ingest.open_image``)
+
+Each decode runs in a fresh process; its peak RSS is reported above that of a
+process that imports the same modules and decodes nothing. Without
+``--image``, synthetic grayscale X-ray sized JPEG and PNG files are generated.
+
+Usage:
+    python -m evaluations.benchmark_image_ingest [--image a.jpg --image b.png] [--runs 5] [--json out.json]
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import resource
+import statistics
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+def _peak_rss() -> int:
+    # On Linux ru_maxrss survives exec, so a spawned child would report the
+    # parent's peak; VmHWM is the child's own
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _decode(method: str, path: str) -> dict:
+    from app.utils.image_ingest import open_image
+
+    tic = time.perf_counter()
+    image = None
+    if method == "full":
+        with open(path, "rb") as f:
+            image = Image.open(io.BytesIO(f.read())).convert("RGB")
+    elif method == "ingest":
+        with open(path, "rb") as f:
+            image = open_image(f)
+    return {
+        "seconds": time.perf_counter() - tic,
+        "peak_rss_mb": _peak_rss() / 2**20,
+        "size": list(image.size) if image is not None else None,
+    }
+
+
+def measure(method: str, path: str, runs: int, baseline_mb: float = 0.0) -> dict:
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for _ in range(runs):
+        with context.Pool(1) as pool:
+            results.append(pool.apply(_decode, (method, path)))
+    return {
+        "decode_ms": round(1000 * statistics.median(r["seconds"] for r in results), 2),
+        "peak_rss_mb": round(statistics.median(r["peak_rss_mb"] for r in results) - baseline_mb, 1),
+        "output_size": results[0]["size"],
+    }
+
+
+def synthetic_images(directory: str, size=(3000, 3600)) -> list:
+    # Smooth gradients plus noise, so the files compress like real radiographs
+    y, x = np.mgrid[0 : size[1], 0 : size[0]]
+    pixels = 128 + 60 * np.sin(x / 300.0) * np.cos(y / 400.0) + np.random.default_rng(0).normal(0, 8, (size[1], size[0]))
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    paths = [os.path.join(directory, "xray.jpg"), os.path.join(directory, "xray.png")]
+    image.save(paths[0], quality=95)
+    image.save(paths[1])
+    return paths
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", action="append", default=[])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", dest="json_path", default=None)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = args.image or synthetic_images(directory)
+        baseline = measure("none", paths[0], args.runs)["peak_rss_mb"]
+        rows = []
+        for path in paths:
+            full, ingest = measure("full", path, args.runs, baseline), measure("ingest", path, args.runs, baseline)
+            with Image.open(path) as image:
+                native = f"{image.width}x{image.height} {image.format} {image.mode}"
+            rows.append({"image": os.path.basename(path), "native": native, "full": full, "ingest": ingest})
+
+    print(f"{'image':<16} {'native':<22} {'full ms':>9} {'ingest ms':>10} {'full MB':>8} {'ingest MB':>10}")
+    for row in rows:
+        print(
+            f"{row['image']:<16} {row['native']:<22} {row['full']['decode_ms']:>9} {row['ingest']['decode_ms']:>10} "
+            f"{row['full']['peak_rss_mb']:>8} {row['ingest']['peak_rss_mb']:>10}"
+        )
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"runs": args.runs, "results": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Compares the old placeholder-image path with the text-only path, per agent.
+
+For each text agent the same prompt is generated twice:
+  - multimodal: a blank 224x224 image and ``num_images=1`` (previous behaviour)
+  - text-only:  no image and ``num_images=0`` (language model only)
+
+Usage:
+    python -m evaluations.benchmark_text_only [--runs 3] [--max-tokens 64] [--json out.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+
+import numpy as np
+from PIL import Image
+from mlx_vlm import generate
+from mlx_vlm.prompt_utils import apply_chat_template
+
+from app.utils.model_loader import load_medgemma_model
+from app.utils.prompt_builder import build_router_prompt, build_icd10_prompt, build_soap_generator_prompt
+from app.utils.text_model import generate_text
+
+DATASET = os.path.join(os.path.dirname(__file__), "synthetic_icd10_dataset.json")
+
+SAMPLE_TRANSCRIPT = """Doctor: Good morning, what brings you in today?
+Patient: I've had a sore throat and a fever for three days.
+Doctor: Any cough or trouble swallowing?
+Patient: It hurts to swallow, no cough.
+Doctor: Your temperature is 38.4 and your tonsils are swollen with exudate. The rapid strep test is positive.
+Doctor: I'll prescribe amoxicillin for ten days. Rest, fluids, and come back if it's not better in 48 hours."""
+
+
+def _time_generation(fn, runs):
+    latencies, result = [], None
+    for _ in range(runs):
+        tic = time.perf_counter()
+        result = fn()
+        latencies.append(time.perf_counter() - tic)
+    return result, statistics.median(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--json", dest="json_path", default=None)
+    args = parser.parse_args()
+
+    model, processor, config = load_medgemma_model()
+    with open(DATASET) as f:
+        note = json.load(f)[0]["note"]
+
+    prompts = {
+        "router": build_router_prompt(note, None),
+        "icd10": build_icd10_prompt(note),
+        "soap": build_soap_generator_prompt(SAMPLE_TRANSCRIPT),
+    }
+    blank = [Image.fromarray(np.zeros((224, 224, 3), dtype=np.uint8))]
+
+    rows = []
+    for agent, prompt in prompts.items():
+        multimodal_prompt = apply_chat_template(processor, config, prompt, num_images=1)
+        text_prompt = apply_chat_template(processor, config, prompt, num_images=0)
+
+        # One untimed call each so compilation and weight paging are not measured
+        generate(model, processor, multimodal_prompt, blank, max_tokens=1)
+        generate_text(model, processor, text_prompt, max_tokens=1)
+
+        mm, mm_latency = _time_generation(
+            lambda: generate(model, processor, multimodal_prompt, blank, max_tokens=args.max_tokens), args.runs
+        )
+        txt, txt_latency = _time_generation(
+            lambda: generate_text(model, processor, text_prompt, max_tokens=args.max_tokens), args.runs
+        )
+        rows.append({
+            "agent": agent,
+            "multimodal_prefill_tokens": mm.prompt_tokens,
+            "text_only_prefill_tokens": txt.prompt_tokens,
+            "multimodal_latency_s": round(mm_latency, 3),
+            "text_only_latency_s": round(txt_latency, 3),
+            "speedup": round(mm_latency / txt_latency, 2) if txt_latency else None,
+        })
+
+    print(f"{'agent':<8} {'prefill mm':>11} {'prefill txt':>12} {'latency mm':>11} {'latency txt':>12} {'speedup':>8}")
+    for row in rows:
+        print(
+            f"{row['agent']:<8} {row['multimodal_prefill_tokens']:>11} {row['text_only_prefill_tokens']:>12} "
+            f"{row['multimodal_latency_s']:>10.3f}s {row['text_only_latency_s']:>11.3f}s {row['speedup']:>7}x"
+        )
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump({"runs": args.runs, "max_tokens": args.max_tokens, "results": rows}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Measures the ICD-10 candidate retrieval stage on the synthetic dataset.
+
+For every note the top-k retrieved codes are compared with the gold codes
+(resolved to billable codes the same way agent output is), reporting
+recall@k and the latency of one batched query over all notes.
+
+Usage:
+    python -m evaluations.evaluate_icd10_retrieval [--k 20] [--runs 5] [--json out.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+
+from app.utils.icd10_retriever import get_icd10_retriever
+
+DATASET = os.path.join(os.path.dirname(__file__), "synthetic_icd10_dataset.json")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--k", type=int, default=20)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--json", dest="json_path", default=None)
+    args = parser.parse_args()
+
+    retriever = get_icd10_retriever()
+    if retriever is None:
+        raise SystemExit("No ICD-10-CM index; see the README for building it.")
+    with open(DATASET) as f:
+        dataset = json.load(f)
+    notes = [row["note"] for row in dataset]
+
+    latencies = []
+    for _ in range(args.runs):
+        tic = time.perf_counter()
+        results = retriever.search(notes, args.k)
+        latencies.append(time.perf_counter() - tic)
+
+    hits = total = 0
+    for row, candidates in zip(dataset, results):
+        retrieved = {code for code, _ in candidates}
+        gold = {retriever.index.resolve(c["code"]) for c in row["icd10_codes"]} - {None}
+        hits += len(gold & retrieved)
+        total += len(gold)
+
+    report = {
+        "notes": len(notes),
+        "k": args.k,
+        f"recall@{args.k}": round(hits / total, 3) if total else 0.0,
+        "batch_ms": round(1000 * statistics.median(latencies), 2),
+        "ms_per_note": round(1000 * statistics.median(latencies) / len(notes), 3),
+    }
+    for key, value in report.items():
+        print(f"{key:>12}: {value}")
+
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,285 @@
+"""
+Evaluation and benchmark harness over the synthetic ICD-10 dataset.
+
+Two suites, run with a configurable number of concurrent items:
+  - icd10: ``ICD10Agent.run`` on every note (code-level precision/recall/F1)
+  - graph: the compiled graph on every note (router accuracy, per-stage latency)
+
+Each reports p50/p95/p99 latency, prompt and output token counts and decode
+tokens/sec, and the whole report can be written as JSON. ``--compare`` diffs
+the report against a stored baseline and exits non-zero on regressions.
+
+``--backend stub`` swaps MedGemma for the deterministic ``StubModel``, so the
+harness runs on a CPU-only machine without downloading the model.
+
+Usage:
+    python -m evaluations.run_evaluation [--backend stub] [--suite all] [--concurrency 4]
+        [--limit 20] [--json report.json] [--compare baseline.json] [--tolerance 0.1]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from app.config.config import config
+
+DATASET = os.path.join(os.path.dirname(__file__), "synthetic_icd10_dataset.json")
+
+# Metrics where a drop is a regression; latency metrics regress when they grow
+HIGHER_IS_BETTER = ("precision", "recall", "f1", "accuracy", "tokens_per_sec", "items_per_sec")
+LOWER_IS_BETTER = ("p50_ms", "p95_ms", "p99_ms", "mean_ms", "errors")
+
+
+def code_key(code: str) -> str:
+    return str(code).replace(".", "").replace(" ", "").upper()
+
+
+def latency_summary(seconds: list) -> dict:
+    if not seconds:
+        return {"n": 0}
+    ms = 1000 * np.asarray(seconds)
+    return {
+        "n": len(seconds),
+        "mean_ms": round(float(ms.mean()), 2),
+        "p50_ms": round(float(np.percentile(ms, 50)), 2),
+        "p95_ms": round(float(np.percentile(ms, 95)), 2),
+        "p99_ms": round(float(np.percentile(ms, 99)), 2),
+    }
+
+
+def token_summary(generations: list) -> dict:
+    """
+    Token counts and decode speed per agent from ``record_generations`` records.
+    """
+    by_agent = {}
+    for record in generations:
+        by_agent.setdefault(record["agent"] or "unknown", []).append(record)
+
+    summary = {}
+    for agent, records in sorted(by_agent.items()):
+        generated = sum(r["generation_tokens"] or 0 for r in records)
+        seconds = sum(r["seconds"] for r in records)
+        summary[agent] = {
+            "calls": len(records),
+            "prompt_tokens_mean": round(float(np.mean([r["prompt_tokens"] or 0 for r in records])), 1),
+            "output_tokens_mean": round(generated / len(records), 1),
+            "tokens_per_sec": round(generated / seconds, 2) if seconds else 0.0,
+        }
+    return summary
+
+
+def code_scores(pairs: list) -> dict:
+    """
+    Micro-averaged precision/recall/F1 over ``(predicted, gold)`` code lists.
+    """
+    tp = fp = fn = exact = 0
+    for predicted, gold in pairs:
+        predicted = {code_key(c) for c in predicted}
+        gold = {code_key(c) for c in gold}
+        tp += len(predicted & gold)
+        fp += len(predicted - gold)
+        fn += len(gold - predicted)
+        exact += predicted == gold
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {
+        "precision": round(precision, 4),
+        "recall": round(recall, 4),
+        "f1": round(f1, 4),
+        "exact_match": round(exact / len(pairs), 4) if pairs else 0.0,
+    }
+
+
+def _result_codes(result) -> list:
+    if not isinstance(result, list):
+        return []
+    return [item["code"] if isinstance(item, dict) else item.code for item in result]
+
+
+def _field(value, name):
+    return value.get(name) if isinstance(value, dict) else getattr(value, name, None)
+
+
+def run_icd10_item(agent, row: dict) -> dict:
+    from app.graph.types import State
+    from app.utils.predictor import record_generations
+
+    state = State(type="icd10", payload={"note": row["note"], "clinical_note": row["note"]}, result=None, error=None)
+    with record_generations() as generations:
+        tic = time.perf_counter()
+        output = agent.run(state)
+        elapsed = time.perf_counter() - tic
+    error = _field(output, "error")
+    return {
+        "seconds": elapsed,
+        "codes": [] if error else _result_codes(_field(output, "result")),
+        "error": error,
+        "generations": generations,
+    }
+
+
+def run_graph_item(graph, row: dict) -> dict:
+    from app.graph.types import State
+    from app.utils.predictor import record_generations
+
+    state = State(type=None, payload={"note": row["note"]}, result=None, error=None)
+    stages, route, codes, error = {}, None, [], None
+    with record_generations() as generations:
+        start = last = time.perf_counter()
+        try:
+            for update in graph.stream(state, stream_mode="updates"):
+                now = time.perf_counter()
+                for node, value in update.items():
+                    stages[node] = now - last
+                    # The join of a single-agent request updates nothing
+                    if not value:
+                        continue
+                    if node == "router":
+                        routing = _field(value, "routing")
+                        route = _field(routing, "agent") if routing is not None else _field(value, "type")
+                    elif node == "icd10":
+                        # A fan-out branch reports its output under results["icd10"]
+                        branch = (_field(value, "results") or {}).get(node)
+                        codes = _result_codes(branch["result"] if branch is not None else _field(value, "result"))
+                    error = error or _field(value, "error")
+                last = now
+        except Exception as e:
+            error = str(e)
+        elapsed = time.perf_counter() - start
+    return {"seconds": elapsed, "stages": stages, "route": route, "codes": codes, "error": error, "generations": generations}
+
+
+def run_suite(fn, rows: list, concurrency: int) -> tuple:
+    tic = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(fn, rows))
+    return results, time.perf_counter() - tic
+
+
+def evaluate_icd10(rows: list, concurrency: int) -> dict:
+    from app.agents.icd10_agent import ICD10Agent
+
+    agent = ICD10Agent()
+    results, wall = run_suite(lambda row: run_icd10_item(agent, row), rows, concurrency)
+    pairs = [(r["codes"], [c["code"] for c in row["icd10_codes"]]) for r, row in zip(results, rows)]
+    return {
+        **code_scores(pairs),
+        "errors": sum(1 for r in results if r["error"]),
+        "latency": latency_summary([r["seconds"] for r in results]),
+        "tokens": token_summary([g for r in results for g in r["generations"]]),
+        "items_per_sec": round(len(rows) / wall, 3),
+    }
+
+
+def evaluate_graph(rows: list, concurrency: int) -> dict:
+    from app.graph.graph_builder import build_graph
+
+    graph = build_graph()
+    results, wall = run_suite(lambda row: run_graph_item(graph, row), rows, concurrency)
+
+    expected = [row.get("expected_agent", "icd10") for row in rows]
+    routed = sum(1 for r, agent in zip(results, expected) if r["route"] == agent)
+    stages = {}
+    for r in results:
+        for node, seconds in r["stages"].items():
+            stages.setdefault(node, []).append(seconds)
+    pairs = [(r["codes"], [c["code"] for c in row["icd10_codes"]]) for r, row in zip(results, rows)]
+    return {
+        "router_accuracy": round(routed / len(rows), 4) if rows else 0.0,
+        "icd10": code_scores(pairs),
+        "errors": sum(1 for r in results if r["error"]),
+        "latency": {"total": latency_summary([r["seconds"] for r in results])}
+        | {node: latency_summary(seconds) for node, seconds in sorted(stages.items())},
+        "tokens": token_summary([g for r in results for g in r["generations"]]),
+        "items_per_sec": round(len(rows) / wall, 3),
+    }
+
+
+def flatten(report: dict, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in report.items():
+        path = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{path}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[path] = value
+    return flat
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Prints every metric next to its baseline value and returns the ones that
+    got worse by more than ``tolerance`` (relative).
+    """
+    current, previous = flatten({k: v for k, v in report.items() if k != "meta"}), flatten(
+        {k: v for k, v in baseline.items() if k != "meta"}
+    )
+    regressions = []
+    print(f"\n{'metric':<48} {'baseline':>12} {'current':>12} {'change':>9}")
+    for key in sorted(set(current) & set(previous)):
+        old, new = previous[key], current[key]
+        change = (new - old) / abs(old) if old else (0.0 if new == old else float("inf"))
+        name = key.rsplit(".", 1)[-1]
+        worse = (
+            (name.endswith(HIGHER_IS_BETTER) and change < -tolerance)
+            or (name.endswith(LOWER_IS_BETTER) and change > tolerance)
+        )
+        if worse:
+            regressions.append(key)
+        print(f"{key:<48} {old:>12} {new:>12} {change:>+8.1%}{'  <- regression' if worse else ''}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", default=config.MODEL_BACKEND, help='"mlx", "stub" or "package.module:Class"')
+    parser.add_argument("--suite", choices=["icd10", "graph", "all"], default="all")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--use-cache", action="store_true", help="keep the result cache enabled")
+    parser.add_argument("--json", dest="json_path", default=None)
+    parser.add_argument("--compare", dest="baseline_path", default=None)
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+
+    config.MODEL_BACKEND = args.backend
+    config.RESULT_CACHE_ENABLED = args.use_cache
+
+    with open(DATASET) as f:
+        rows = json.load(f)[: args.limit]
+
+    report = {
+        "meta": {
+            "backend": args.backend,
+            "model_id": config.default_model(),
+            "agent_models": {agent: config.model_for(agent) for agent in config.MODEL_AGENTS},
+            "items": len(rows),
+            "concurrency": args.concurrency,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+    }
+    if args.suite in ("icd10", "all"):
+        report["icd10"] = evaluate_icd10(rows, args.concurrency)
+    if args.suite in ("graph", "all"):
+        report["graph"] = evaluate_graph(rows, args.concurrency)
+
+    print(json.dumps(report, indent=2))
+    if args.json_path:
+        with open(args.json_path, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline_path:
+        with open(args.baseline_path) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} metric(s) regressed beyond {args.tolerance:.0%}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()